@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     'main'
 ]
 
+# Add 'main.middleware.TimingMiddleware' first to get Server-Timing headers and histograms on /metrics/
 MIDDLEWARE_CLASSES = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -88,6 +89,30 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+# Serialized comment trees are cached here (see main.utils.get_cached_tree), use a shared backend
+# like memcached in production so all workers see the same tree versions
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Directory for cached history exports, None disables the cache. It should be on a local disk of the server.
+EXPORT_CACHE_DIR = os.path.join(BASE_DIR, 'export_cache')
+
+# History of comments is written by a background thread after changes are committed, see main.history. History
+# downloads get the records after they are written. Deletions are always written at once, tree_changes/ needs them.
+# Records queued in the last second may be lost if the process is killed; add 'main.middleware.HistoryFlushMiddleware'
+# to write them before each response.
+HISTORY_WRITE_BEHIND = False
+
+# Directory for archived months of comments history, see 'manage.py archive_history'. Archives are read by
+# history downloads, so it must be kept with the database.
+HISTORY_ARCHIVE_DIR = os.path.join(BASE_DIR, 'history_archive')
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -21,10 +21,14 @@ urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^login/', views.user_login),
     url(r'^create_comment/$', views.create_comment_view),
+    url(r'^create_comments/$', views.create_comments_view),
     url(r'^change_comment/$', views.change_comment_view),
     url(r'^delete_comment/$', views.delete_comment_view),
     url(r'^first_level/(?P<page>[0-9]+)/$', views.first_level_list),
+    url(r'^first_level/$', views.first_level_list),
     url(r'^get_tree/$', views.get_tree),
+    url(r'^tree_changes/$', views.tree_changes),
     url(r'^download_history/$', views.download_history),
-    url(r'^user_downloads/$', views.user_downloads)
+    url(r'^user_downloads/$', views.user_downloads),
+    url(r'^metrics/$', views.metrics)
 ]
@@ -7,8 +7,66 @@ OBJECT_TYPES = (
 
 NUM_OF_COMMENTS_ON_PAGE = 20
 
+# Number of downloads in one response of user_downloads/
+DOWNLOADS_ON_PAGE = 100
+
 COMMENT_HISTORY_TYPE = (
     ('0', 'txt'),
     ('1', 'json'),
     ('2', 'xml'),
-)
\ No newline at end of file
+    ('3', 'ndjson'),
+    ('4', 'csv'),
+)
+
+# Seconds to keep serialized comment trees in cache, old versions are never served anyway
+TREE_CACHE_TIMEOUT = 60 * 60
+
+# Number of comments read from database at once when a tree is built or streamed
+TREE_CHUNK_SIZE = 1000
+
+# Approximate size in characters of the chunks of streamed responses
+STREAM_BUFFER_SIZE = 64 * 1024
+
+# Maximum number of comments created by one request to create_comments/
+MAX_COMMENTS_IN_BATCH = 1000
+
+# Number of rows inserted or updated by one query in bulk operations
+BULK_BATCH_SIZE = 500
+
+# Default number of records imported in one transaction by 'manage.py import_comments'
+IMPORT_CHUNK_SIZE = 10000
+
+# Number of history rows read from database at once when history is downloaded
+HISTORY_CHUNK_SIZE = 2000
+
+# Resumable history downloads have a checkpoint after this number of changes
+HISTORY_CHECKPOINT_ROWS = 1000
+
+# Maximum size in bytes of cached history exports, least recently used exports are removed above it
+EXPORT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Upper bounds of buckets of per-endpoint histograms of main.middleware.TimingMiddleware, durations are in ms
+TIMING_DURATION_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+TIMING_QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Comments are committed later than their dates by at most this number of seconds, so changes of the last seconds
+# are returned by tree_changes/ again with the next 'since'
+TREE_CHANGES_LAG = 10
+
+# Write-behind of comments history (see settings.HISTORY_WRITE_BEHIND): maximum number of queued records,
+# the number of records that starts a flush, the maximum number of seconds between flushes and the number of
+# flushes that try to write a broken record before it's logged and dropped
+HISTORY_QUEUE_SIZE = 10000
+HISTORY_FLUSH_SIZE = 500
+HISTORY_FLUSH_INTERVAL = 1.0
+HISTORY_FLUSH_TRIES = 5
+
+# Monthly partitions of comments history created ahead by 'manage.py create_history_partitions' (PostgreSQL only)
+HISTORY_PARTITIONS_AHEAD = 3
+
+# Months of history kept in the database by 'manage.py archive_history', older partitions are archived
+HISTORY_KEEP_MONTHS = 12
+
+# Edits of comments history are stored in full once in this number of edits, other ones are stored as deltas (all
+# edits are stored in full with settings.HISTORY_WRITE_BEHIND)
+HISTORY_SNAPSHOT_VERSIONS = 10
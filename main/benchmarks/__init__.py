@@ -0,0 +1,4 @@
+# Reproducible benchmarks of comment trees, first level lists, history exports and download lists,
+# run them with 'manage.py benchmark'
+from main.benchmarks.suite import BENCHMARKS, run_benchmarks
+from main.benchmarks.workload import Workload
@@ -0,0 +1,91 @@
+import time
+from django.core.paginator import Paginator
+from Comments.vars import NUM_OF_COMMENTS_ON_PAGE
+from main.utils import *
+
+
+def tree_wide(workload):
+    tree = CommentTree('0', workload.wide_obj_id).get_tree()
+    return tree['comment_count']
+
+
+def stream_tree(obj_type, obj_id):
+    tree = CommentTree(obj_type, obj_id)
+    for data in IterTree(tree):
+        pass
+    return tree.root.comment_count
+
+
+def tree_wide_stream(workload):
+    return stream_tree('0', workload.wide_obj_id)
+
+
+def tree_deep_stream(workload):
+    # Deep chains are read in one pass with the stream, get_tree() keeps the whole chain
+    return stream_tree('1', workload.deep_obj_id)
+
+
+def tree_many_roots(workload):
+    for obj_id in workload.root_obj_ids:
+        CommentTree('2', obj_id).get_tree()
+    return len(workload.root_obj_ids)
+
+
+def first_level_last_page(workload):
+    pages = Paginator(first_level_comments('0', workload.wide_obj_id), NUM_OF_COMMENTS_ON_PAGE)
+    return len(pages.page(pages.num_pages))
+
+
+def first_level_all_pages(workload):
+    rows = 0
+    cursor = None
+    while True:
+        comments, start, cursor = first_level_page('0', workload.wide_obj_id, cursor)
+        rows += len(comments)
+        if cursor is None:
+            return rows
+
+
+def export_history(file_type):
+    def export(workload):
+        res = DownloadCommentsHistory(workload.author, workload.author, None, None, file_type)
+        for data in res.get_content():
+            pass
+        return workload.sizes['history']
+    export.__name__ = 'export_%s' % file_type
+    return export
+
+
+def user_downloads(workload):
+    rows = 0
+    cursor = None
+    while True:
+        downloads = UserDownloads(workload.auditor, cursor=cursor)
+        rows += len(downloads.data)
+        cursor = downloads.cursor
+        if cursor is None:
+            return rows
+
+
+# Each benchmark gets the generated workload and returns the number of processed rows
+BENCHMARKS = [
+    tree_wide, tree_wide_stream, tree_deep_stream, tree_many_roots, first_level_last_page, first_level_all_pages
+] + list(export_history(x[1]) for x in COMMENT_HISTORY_TYPE) + [user_downloads]
+
+
+def run_benchmarks(workload, repeat=3, names=None):
+    results = {}
+    for benchmark in BENCHMARKS:
+        if names is not None and benchmark.__name__ not in names:
+            continue
+        runs = []
+        for i in range(repeat):
+            started = time.perf_counter()
+            rows = benchmark(workload)
+            runs.append(time.perf_counter() - started)
+        best = min(runs)
+        results[benchmark.__name__] = {
+            'rows': rows, 'runs': runs, 'best': best, 'mean': sum(runs) / len(runs),
+            'rows_per_second': rows / best if best > 0 else None
+        }
+    return results
@@ -0,0 +1,147 @@
+import random
+from datetime import timedelta
+from Comments.vars import IMPORT_CHUNK_SIZE
+from main.utils import *
+
+
+class Workload:
+    # Synthetic data for benchmarks, the same seed and sizes give the same data:
+    # - a blog post with 'wide' first level comments and about 'replies' replies to each of them;
+    # - a user page with a chain of 'deep' nested comments;
+    # - 'roots' other objects with 'root_comments' comments each;
+    # - 'history' changes of the comments author and 'downloads' downloads of an auditor.
+    def __init__(self, seed=0, wide=10000, replies=2, deep=500, roots=1000, root_comments=5, history=100000,
+                 downloads=10000):
+        self.seed = seed
+        self.sizes = {
+            'wide': wide, 'replies': replies, 'deep': deep, 'roots': roots, 'root_comments': root_comments,
+            'history': history, 'downloads': downloads
+        }
+        self.random = random.Random(seed)
+        self.start_date = MOSCOW_TZ.localize(datetime(2017, 1, 1))
+        self.texts = list(self.__random_text() for i in range(1000))
+        self.author = None
+        self.auditor = None
+        self.wide_obj_id = None
+        self.deep_obj_id = None
+        self.root_obj_ids = []
+
+    def __random_text(self):
+        words = list(
+            ''.join(self.random.choice('abcdefghijklmnopqrstuvwxyz') for j in range(self.random.randint(1, 10)))
+            for i in range(self.random.randint(1, 60))
+        )
+        return ' '.join(words)
+
+    def __text(self):
+        return self.random.choice(self.texts)
+
+    def __date(self, num, total):
+        # Dates of 'total' comments are spread over a year in the order of 'num'
+        return self.start_date + timedelta(seconds=num * 365 * 24 * 3600 // max(total, 1))
+
+    def __comment(self, root_id, parent_id, date):
+        return Comment(
+            root_id=root_id, author_id=self.author.pk, parent_id=parent_id, text=self.__text(), date=date,
+            last_change=date
+        )
+
+    def generate(self):
+        prefix = 'bench-%s-' % uuid.uuid4().hex[:12]
+        self.author = User.objects.create(username=prefix + 'author')
+        self.auditor = User.objects.create(username=prefix + 'auditor')
+        self.__generate_wide()
+        self.__generate_deep()
+        self.__generate_roots(prefix)
+        self.__generate_history()
+        self.__generate_downloads(prefix)
+
+    def __generate_wide(self):
+        self.wide_obj_id = BlogPost.objects.create(name='Wide thread').pk
+        # Roots of deleted objects are not removed and SQLite reuses ids, so the root can exist
+        root = CommentRoot.objects.get_or_create(obj_type='0', obj_id=self.wide_obj_id)[0]
+        first_level = list(self.__comment(root.pk, None, self.__date(i, self.sizes['wide']))
+                           for i in range(self.sizes['wide']))
+        insert_comments(first_level, [''] * len(first_level))
+        replies = []
+        parent_paths = []
+        for comment in first_level:
+            for i in range(self.random.randint(0, 2 * self.sizes['replies'])):
+                replies.append(self.__comment(root.pk, comment.pk, comment.date + timedelta(minutes=i + 1)))
+                parent_paths.append(comment.path)
+        insert_comments(replies, parent_paths)
+        increase_counters(first_level + replies)
+
+    def __generate_deep(self):
+        self.deep_obj_id = UserPage.objects.create(name='Deep chain').pk
+        root = CommentRoot.objects.get_or_create(obj_type='1', obj_id=self.deep_obj_id)[0]
+        chain = []
+        parent = None
+        for i in range(self.sizes['deep']):
+            comment = self.__comment(root.pk, parent.pk if parent else None, self.__date(i, self.sizes['deep']))
+            insert_comments([comment], [parent.path if parent else ''])
+            chain.append(comment)
+            parent = comment
+        increase_counters(chain)
+
+    def __generate_roots(self, prefix):
+        objects = list(AnotherObject(name='%sobject%s' % (prefix, i)) for i in range(self.sizes['roots']))
+        AnotherObject.objects.bulk_create(objects, batch_size=BULK_BATCH_SIZE)
+        self.root_obj_ids = list(
+            AnotherObject.objects.filter(name__startswith=prefix).order_by('pk').values_list('pk', flat=True)
+        )
+        if len(self.root_obj_ids) == 0:
+            return
+        # The objects are new, so only their roots are in the range of their ids
+        roots = CommentRoot.objects.filter(
+            obj_type='2', obj_id__gte=self.root_obj_ids[0], obj_id__lte=self.root_obj_ids[-1]
+        ).order_by('pk')
+        existing = set(roots.values_list('obj_id', flat=True))
+        CommentRoot.objects.bulk_create(list(
+            CommentRoot(obj_type='2', obj_id=obj_id) for obj_id in self.root_obj_ids if obj_id not in existing
+        ), batch_size=BULK_BATCH_SIZE)
+        roots = roots.values_list('pk', flat=True)
+        comments = []
+        for root_id in roots:
+            for i in range(self.sizes['root_comments']):
+                comments.append(self.__comment(root_id, None, self.__date(i, self.sizes['root_comments'])))
+            if len(comments) >= IMPORT_CHUNK_SIZE:
+                insert_comments(comments, [''] * len(comments))
+                increase_counters(comments)
+                comments = []
+        if len(comments) > 0:
+            insert_comments(comments, [''] * len(comments))
+            increase_counters(comments)
+
+    def __generate_history(self):
+        # Written by chunks, so tens of millions of changes don't need much memory
+        comments = list(Comment.objects.filter(root__obj_type='0', root__obj_id=self.wide_obj_id)
+                        .values_list('pk', 'root_id')[:IMPORT_CHUNK_SIZE])
+        total = self.sizes['history']
+        changes = []
+        for i in range(total):
+            # Creations, editions and deletions
+            kind = self.random.randint(0, 5)
+            comment_id, root_id = self.random.choice(comments) if len(comments) > 0 else (None, None)
+            changes.append(CommentHistory(
+                comment_id=comment_id, root_id=root_id, author_id=self.author.pk, date=self.__date(i, total),
+                old_text=None if kind < 3 else self.__text(), new_text=None if kind == 5 else self.__text()
+            ))
+            if len(changes) >= IMPORT_CHUNK_SIZE:
+                CommentHistory.objects.bulk_create(changes, batch_size=BULK_BATCH_SIZE)
+                changes = []
+        CommentHistory.objects.bulk_create(changes, batch_size=BULK_BATCH_SIZE)
+
+    def __generate_downloads(self, prefix):
+        targets = []
+        for i in range(10):
+            targets.append(User.objects.create(username='%starget%s' % (prefix, i)))
+        downloads = []
+        for i in range(self.sizes['downloads']):
+            min_date = self.__date(self.random.randint(0, 100), 100)
+            downloads.append(DownloadHistory(
+                user=self.auditor, target=self.random.choice(targets), min_date=min_date,
+                max_date=min_date + timedelta(days=self.random.randint(1, 60)),
+                file_type=self.random.choice(COMMENT_HISTORY_TYPE)[0]
+            ))
+        DownloadHistory.objects.bulk_create(downloads, batch_size=BULK_BATCH_SIZE)
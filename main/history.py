@@ -0,0 +1,235 @@
+import atexit
+import json
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from django.conf import settings
+from django.db import transaction, close_old_connections, IntegrityError, DataError
+from django.db.models import Case, When, Value, TextField
+from django.utils.timezone import localtime, get_default_timezone
+from Comments.vars import BULK_BATCH_SIZE, HISTORY_QUEUE_SIZE, HISTORY_FLUSH_SIZE, HISTORY_FLUSH_INTERVAL, \
+    HISTORY_FLUSH_TRIES, HISTORY_SNAPSHOT_VERSIONS
+from main.models import Comment, CommentHistory
+
+logger = logging.getLogger(__name__)
+
+# Columns of history rows for readers, full_history_rows() turns them to (id, date, old_text, new_text)
+HISTORY_COLUMNS = ['id', 'date', 'old_text', 'new_text', 'comment_id', 'delta']
+
+
+class HistoryQueue:
+    # Write-behind of history records, see settings.HISTORY_WRITE_BEHIND. Records are queued after the transaction
+    # of the change is committed and are inserted by a background thread when 'flush_size' records are queued or
+    # 'interval' seconds passed, or by flush(). Records stay in the queue until they are written, so when it's full
+    # (e.g. the database is down) writers flush it themselves or wait for the thread, and writes are slowed down to
+    # the speed of the database instead of losing records. A record that can't be written is retried by 'tries'
+    # flushes, then it's logged and dropped.
+    def __init__(self, max_size=HISTORY_QUEUE_SIZE, flush_size=HISTORY_FLUSH_SIZE, interval=HISTORY_FLUSH_INTERVAL,
+                 tries=HISTORY_FLUSH_TRIES):
+        self.records = deque()
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.interval = interval
+        self.tries = tries
+        # Failed writes of records by id()
+        self.failures = {}
+        self.changed = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def put(self, records):
+        self.__start()
+        for record in records:
+            with self.changed:
+                full = len(self.records) >= self.max_size
+                if not full:
+                    self.records.append(record)
+            if full:
+                try:
+                    self.flush()
+                except Exception:
+                    # The thread retries the flush and logs the error
+                    pass
+                with self.changed:
+                    self.changed.wait_for(lambda: len(self.records) < self.max_size)
+                    self.records.append(record)
+        if len(self.records) >= self.flush_size:
+            self.wakeup.set()
+
+    def flush(self):
+        # Inserts all queued records, returns the number of written ones. Concurrent flushes wait for each other, so
+        # all records queued before the call are in the database after it, except the ones that failed.
+        with self.flush_lock:
+            with self.changed:
+                records = list(self.records)
+            if len(records) == 0:
+                return 0
+            written = []
+            dropped = []
+            try:
+                self.__detach_deleted(records)
+                try:
+                    # All batches are inserted in one transaction, so a failed flush writes nothing
+                    CommentHistory.objects.bulk_create(records, batch_size=BULK_BATCH_SIZE)
+                    written = records
+                except (IntegrityError, DataError):
+                    # Some records can't be written, other ones are written one by one
+                    for record in records:
+                        try:
+                            with transaction.atomic():
+                                CommentHistory.objects.bulk_create([record])
+                            written.append(record)
+                        except (IntegrityError, DataError):
+                            self.failures[id(record)] = self.failures.get(id(record), 0) + 1
+                            if self.failures[id(record)] >= self.tries:
+                                logger.exception('History record is dropped after %s tries: %r', self.tries,
+                                                 dict((f.attname, getattr(record, f.attname))
+                                                      for f in record._meta.concrete_fields))
+                                dropped.append(record)
+            finally:
+                self.__remove(records, written + dropped)
+            return len(written)
+
+    def __remove(self, records, done):
+        # Records of a flush are at the start of the queue, the failed ones are kept there
+        done = set(id(r) for r in done)
+        for record_id in done:
+            self.failures.pop(record_id, None)
+        with self.changed:
+            for _ in records:
+                self.records.popleft()
+            self.records.extendleft(reversed(list(r for r in records if id(r) not in done)))
+            self.changed.notify_all()
+
+    def __detach_deleted(self, records):
+        # Comments may be deleted after their changes were queued, the changes are written like delete_comment()
+        # leaves the older ones: without the comment. Queued edits are stored in full, see change_comment().
+        ids = set(r.comment_id for r in records if r.comment_id is not None)
+        existing = set(Comment.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        for record in records:
+            if record.comment_id is not None and record.comment_id not in existing:
+                record.comment_id = None
+
+    def __start(self):
+        with self.thread_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.__work, name='history-writer', daemon=True)
+                self.thread.start()
+
+    def __work(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                # The thread keeps its own connection, it's reopened if it was broken or is too old
+                close_old_connections()
+                self.flush()
+            except Exception:
+                # The records stay in the queue and are written again after the next interval
+                logger.exception('History records are not written')
+
+
+history_queue = HistoryQueue()
+
+# Records queued when the worker exits are written before it stops
+atexit.register(history_queue.flush)
+
+
+def write_history(records, queued=True):
+    # Writes CommentHistory records of the current transaction, in write-behind mode they are queued when it's
+    # committed and are not written if it's rolled back. Records with queued=False are always written at once.
+    if queued and settings.HISTORY_WRITE_BEHIND:
+        transaction.on_commit(lambda: history_queue.put(records))
+    else:
+        CommentHistory.objects.bulk_create(records, batch_size=BULK_BATCH_SIZE)
+
+
+def month_start(date):
+    # Months start at midnight in the time zone of the project
+    date = localtime(date)
+    return get_default_timezone().localize(datetime(date.year, date.month, 1))
+
+
+def next_month(start):
+    return month_start(start + timedelta(days=32))
+
+
+def is_snapshot(edit_num, previous_date, date):
+    # Edits are stored in full every HISTORY_SNAPSHOT_VERSIONS edits starting from the first one and in each new
+    # month, so a delta never depends on a change in another partition or archive, see main.partitions
+    return (edit_num - 1) % HISTORY_SNAPSHOT_VERSIONS == 0 or month_start(previous_date) != month_start(date)
+
+
+def make_delta(old_text, new_text):
+    # JSON list of [start, length] pieces of the old text and strings of the new one, or None if the texts are
+    # shorter than the delta
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_text, new_text).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2 - i1])
+        elif j2 > j1:
+            ops.append(new_text[j1:j2])
+    delta = json.dumps(ops, ensure_ascii=False, separators=(',', ':'))
+    return delta if len(delta) < len(old_text) + len(new_text) else None
+
+
+def apply_delta(text, delta):
+    return ''.join(text[op[0]:op[0] + op[1]] if isinstance(op, list) else op for op in json.loads(delta))
+
+
+def chain_texts(rows):
+    # Texts of delta-encoded edits by their ids. Rows (id, comment_id, new_text, delta) are ordered by
+    # (comment_id, date, id) and start with full versions of the comments.
+    texts = {}
+    current = {}
+    for ch_id, comment_id, new_text, delta in rows:
+        if delta is not None:
+            new_text = apply_delta(current[comment_id], delta)
+            texts[ch_id] = (current[comment_id], new_text)
+        current[comment_id] = new_text
+    return texts
+
+
+def history_texts(rows):
+    # Texts of delta-encoded edits of HISTORY_COLUMNS rows, their previous versions are read from the months of
+    # the edits
+    rows = list(r for r in rows if r[5] is not None)
+    if len(rows) == 0:
+        return {}
+    return chain_texts(CommentHistory.objects.filter(
+        comment_id__in=set(r[4] for r in rows), date__gte=month_start(min(r[1] for r in rows)),
+        date__lte=max(r[1] for r in rows)
+    ).order_by('comment_id', 'date', 'id').values_list('id', 'comment_id', 'new_text', 'delta'))
+
+
+def full_history_rows(rows):
+    texts = history_texts(rows)
+    return list((r[0], r[1]) + texts[r[0]] if r[5] is not None else r[:4] for r in rows)
+
+
+def texts_update(texts):
+    # Values of QuerySet.update() that write full texts to delta-encoded edits
+    return {
+        'old_text': Case(*list(When(pk=ch_id, then=Value(texts[ch_id][0])) for ch_id in texts),
+                         default='old_text', output_field=TextField()),
+        'new_text': Case(*list(When(pk=ch_id, then=Value(texts[ch_id][1])) for ch_id in texts),
+                         default='new_text', output_field=TextField()),
+        'delta': None
+    }
+
+
+def expand_deltas(history):
+    # Writes full texts to delta-encoded edits of the CommentHistory queryset, e.g. before rows leave the table
+    expanded = 0
+    while True:
+        rows = list(history.filter(delta__isnull=False).order_by('date', 'id')
+                    .values_list(*HISTORY_COLUMNS)[:BULK_BATCH_SIZE])
+        if len(rows) == 0:
+            return expanded
+        texts = history_texts(rows)
+        CommentHistory.objects.filter(pk__in=list(texts)).update(**texts_update(texts))
+        expanded += len(texts)
@@ -0,0 +1,43 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+from Comments.vars import HISTORY_KEEP_MONTHS
+from main.models import HistoryArchive
+from main.partitions import is_history_partitioned, history_partitions, archive_history_partition, month_start, \
+    partition_name, finish_history_archive
+
+
+class Command(BaseCommand):
+    help = 'Moves monthly partitions of comments history older than the kept months to compressed files in ' \
+           'HISTORY_ARCHIVE_DIR (PostgreSQL only). History downloads read the archives.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-months', type=int, default=HISTORY_KEEP_MONTHS,
+            help='Number of months before the current one that stay in the database'
+        )
+
+    def handle(self, *args, **options):
+        if options['keep_months'] < 0:
+            raise CommandError('Wrong number of months')
+        if not is_history_partitioned():
+            raise CommandError('History is partitioned only on PostgreSQL')
+        first_kept = month_start(now())
+        for i in range(options['keep_months']):
+            first_kept = month_start(first_kept - timedelta(days=1))
+        archived = 0
+        # Archives of interrupted runs are finished first
+        for archive in HistoryArchive.objects.filter(pending=True).order_by('start'):
+            self.__report(finish_history_archive(archive))
+            archived += 1
+        for start in history_partitions():
+            if start >= first_kept:
+                break
+            self.__report(archive_history_partition(start))
+            archived += 1
+        self.stdout.write('%s partitions were archived' % archived)
+
+    def __report(self, archive):
+        self.stdout.write('%s: %s changes were archived to %s' % (
+            partition_name(archive.start), archive.rows, archive.file_name
+        ))
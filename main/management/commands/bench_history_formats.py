@@ -0,0 +1,55 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from main.utils import *
+
+
+class Command(BaseCommand):
+    help = 'Measures how many history rows per second are exported in each format. Synthetic history is written ' \
+           'to the database in a transaction that is rolled back after the measurements.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000, help='Number of history rows')
+        parser.add_argument('--text-length', type=int, default=200, help='Length of texts of the changes')
+        parser.add_argument('--repeat', type=int, default=3, help='The best of this number of runs is reported')
+
+    def handle(self, *args, **options):
+        if options['rows'] <= 0 or options['text_length'] <= 0 or options['repeat'] <= 0:
+            raise CommandError('Wrong arguments')
+        with transaction.atomic():
+            history = self.__fill_history(options['rows'], options['text_length'])
+            for ftype, ftype_name in COMMENT_HISTORY_TYPE:
+                best = None
+                for i in range(options['repeat']):
+                    started = time.time()
+                    size = sum(len(x) for x in IterContent(ftype, history))
+                    spent = time.time() - started
+                    best = spent if best is None else min(best, spent)
+                self.stdout.write('%-6s %10.0f rows/s %10.1f MB/s' % (
+                    ftype_name, options['rows'] / best, size / best / 1024 / 1024
+                ))
+            transaction.set_rollback(True)
+
+    def __fill_history(self, rows, text_length):
+        author = User.objects.create(username='bench-%s' % uuid.uuid4().hex[:20])
+        root = CommentRoot.objects.create(obj_type='c', obj_id=0)
+        comment = Comment.objects.create(root=root, author=author, text='Benchmark')
+        # Texts with quotes, markup, new lines and non-ASCII letters, they need escaping in most formats
+        alphabet = 'abcdefghij klmnop "<>&\n\tжзий'
+        rnd = random.Random(0)
+        texts = list(''.join(rnd.choice(alphabet) for j in range(text_length)) for i in range(100))
+        first_date = now()
+        changes = []
+        for i in range(rows):
+            # Creations, editions and deletions
+            old_text = None if i % 3 == 0 else texts[i % 100]
+            new_text = None if i % 3 == 2 else texts[(i + 1) % 100]
+            changes.append(CommentHistory(
+                comment=comment, author=author, old_text=old_text, new_text=new_text,
+                date=first_date + timedelta(seconds=i // 2)
+            ))
+        CommentHistory.objects.bulk_create(changes, batch_size=BULK_BATCH_SIZE)
+        return CommentHistory.objects.filter(author=author).order_by('date', 'id').values_list(*HISTORY_COLUMNS)
@@ -0,0 +1,61 @@
+import json
+import subprocess
+import time
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from main.benchmarks import BENCHMARKS, Workload, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Generates a seeded synthetic workload, times comment trees, first level lists, history exports and ' \
+           'download lists on it and prints the results as JSON. The workload is written in a transaction that ' \
+           'is rolled back at the end, run it on a local database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--wide', type=int, default=10000, help='First level comments of the wide thread')
+        parser.add_argument('--replies', type=int, default=2, help='Average replies to each of them')
+        parser.add_argument('--deep', type=int, default=500, help='Length of the chain of nested comments')
+        parser.add_argument('--roots', type=int, default=1000, help='Number of other commented objects')
+        parser.add_argument('--root-comments', type=int, default=5, help='Comments of each of them')
+        parser.add_argument('--history', type=int, default=100000, help='Number of history rows')
+        parser.add_argument('--downloads', type=int, default=10000, help='Number of downloads of the auditor')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark')
+        parser.add_argument(
+            '--only', nargs='+', choices=list(b.__name__ for b in BENCHMARKS), help='Run only these benchmarks'
+        )
+        parser.add_argument('--output', help='File for the results instead of stdout')
+
+    def handle(self, *args, **options):
+        sizes = ['wide', 'replies', 'deep', 'roots', 'root_comments', 'history', 'downloads']
+        if options['repeat'] <= 0 or any(options[x] < 0 for x in sizes):
+            raise CommandError('Wrong arguments')
+        workload = Workload(options['seed'], **dict((x, options[x]) for x in sizes))
+        with transaction.atomic():
+            started = time.perf_counter()
+            workload.generate()
+            generation = time.perf_counter() - started
+            results = run_benchmarks(workload, options['repeat'], options['only'])
+            transaction.set_rollback(True)
+        report = json.dumps({
+            'commit': self.__get_commit(),
+            'database': connection.vendor,
+            'django': django.get_version(),
+            'seed': workload.seed,
+            'workload': workload.sizes,
+            'generation': generation,
+            'results': results
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], mode='w', encoding='utf8') as fp:
+                fp.write(report)
+        else:
+            self.stdout.write(report)
+
+    def __get_commit(self):
+        # Results of different commits are compared, so the commit is saved with them if it is known
+        try:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from main.history import apply_delta, is_snapshot, make_delta
+from main.utils import *
+
+
+class Command(BaseCommand):
+    help = 'Converts full texts of edits in comments history to deltas like new edits are stored (see ' \
+           'main.history.is_snapshot()) and reports the saved space. Changes of deleted comments stay in full. ' \
+           'It can be interrupted and started again, converted edits are skipped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=BULK_BATCH_SIZE, help='Comments converted in one transaction'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] <= 0:
+            raise CommandError('Wrong batch size')
+        self.edits = self.converted = self.size_before = self.size_after = 0
+        last_id = comments = 0
+        while True:
+            with transaction.atomic():
+                # New edits of the comments wait for the batch, so their counters stay right
+                ids = list(Comment.objects.select_for_update().filter(pk__gt=last_id).order_by('pk')
+                           .values_list('pk', flat=True)[:options['batch_size']])
+                if len(ids) == 0:
+                    break
+                self.__convert(ids)
+            last_id = ids[-1]
+            comments += len(ids)
+            self.stdout.write('%s comments: %s of %s edits are converted' % (comments, self.converted, self.edits))
+        saved = self.size_before - self.size_after
+        self.stdout.write('Texts of converted edits took %s bytes, deltas take %s bytes, %s bytes (%.1f%%) saved' % (
+            self.size_before, self.size_after, saved, 100.0 * saved / self.size_before if self.size_before else 0
+        ))
+
+    def __convert(self, ids):
+        rows = CommentHistory.objects.filter(comment_id__in=ids).order_by('comment_id', 'date', 'id')\
+            .values_list('id', 'comment_id', 'date', 'old_text', 'new_text', 'delta')
+        deltas = {}
+        edits = dict((c_id, 0) for c_id in ids)
+        current_id = text = date = None
+        for ch_id, comment_id, ch_date, old_text, new_text, delta in rows.iterator():
+            if comment_id != current_id:
+                current_id, text, date = comment_id, None, None
+            if old_text is None and delta is None:
+                # Creation of the comment
+                text, date = new_text, ch_date
+                continue
+            edits[comment_id] += 1
+            self.edits += 1
+            if delta is not None:
+                text, date = apply_delta(text, delta), ch_date
+                continue
+            # Edits that don't follow the known previous version (e.g. lost history) stay in full
+            if not is_snapshot(edits[comment_id], date, ch_date) and text == old_text:
+                delta = make_delta(old_text, new_text)
+                if delta is not None:
+                    deltas[ch_id] = delta
+                    self.size_before += len(old_text.encode('utf8')) + len(new_text.encode('utf8'))
+                    self.size_after += len(delta.encode('utf8'))
+            text, date = new_text, ch_date
+        delta_ids = list(deltas)
+        for start in range(0, len(delta_ids), BULK_BATCH_SIZE):
+            chunk = delta_ids[start:start + BULK_BATCH_SIZE]
+            CommentHistory.objects.filter(pk__in=chunk).update(
+                old_text=None, new_text=None,
+                delta=Case(
+                    *list(When(pk=ch_id, then=Value(deltas[ch_id])) for ch_id in chunk), output_field=TextField()
+                )
+            )
+        self.converted += len(deltas)
+        # Following edits are stored like the comments were edited after the conversion
+        counts = {}
+        for c_id in edits:
+            counts.setdefault(edits[c_id], []).append(c_id)
+        for count, c_ids in counts.items():
+            Comment.objects.filter(pk__in=c_ids).update(edits=count)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from Comments.vars import HISTORY_PARTITIONS_AHEAD
+from main.partitions import is_history_partitioned, create_history_partitions
+
+
+class Command(BaseCommand):
+    help = 'Creates monthly partitions of comments history for the current month and the next ones ' \
+           '(PostgreSQL only). Run it at least once a month, e.g. by cron.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', type=int, default=HISTORY_PARTITIONS_AHEAD, help='Number of months after the current one'
+        )
+
+    def handle(self, *args, **options):
+        if options['months'] < 0:
+            raise CommandError('Wrong number of months')
+        if not is_history_partitioned():
+            raise CommandError('History is partitioned only on PostgreSQL')
+        created = create_history_partitions(options['months'])
+        for name in created:
+            self.stdout.write('Created %s' % name)
+        self.stdout.write('%s partitions were created' % len(created))
@@ -0,0 +1,209 @@
+import csv
+import json
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from Comments.vars import IMPORT_CHUNK_SIZE
+from main.utils import *
+
+
+class Command(BaseCommand):
+    help = 'Imports comments from a JSONL or CSV dump with fields: id, parent, obj_type, obj_id, author (username), ' \
+           'text, date and last_change (ISO 8601). Parents must go before their replies in the dump. ' \
+           'The import can be interrupted and started again with the same name, it resumes after the last ' \
+           'imported chunk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dump', help='Path to the dump')
+        parser.add_argument(
+            '--format', choices=['jsonl', 'csv'], help='Format of the dump, taken from the extension by default'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help='Records imported in one transaction'
+        )
+        parser.add_argument(
+            '--name', help='Name of the import that is resumed by next runs, the absolute path of the dump by default'
+        )
+        parser.add_argument('--no-history', action='store_true', help="Don't write history of the imported comments")
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or os.path.splitext(options['dump'])[1].lstrip('.')
+        if file_format not in ['jsonl', 'csv']:
+            raise CommandError('Unsupported format of the dump')
+        if options['chunk_size'] <= 0:
+            raise CommandError('Wrong chunk size')
+        self.name = options['name'] or os.path.abspath(options['dump'])
+        self.with_history = not options['no_history']
+        # Each imported record has its ImportedComment, records are imported in the order of the dump
+        done = ImportedComment.objects.filter(name=self.name).count()
+        if done > 0:
+            self.stdout.write('Resuming after %s records' % done)
+
+        started = time.time()
+        imported = 0
+        with open(options['dump'], encoding='utf8', newline='') as fp:
+            records = self.__read_jsonl(fp) if file_format == 'jsonl' else csv.DictReader(fp)
+            chunk = []
+            for num, record in enumerate(records, 1):
+                if num <= done:
+                    continue
+                chunk.append(record)
+                if len(chunk) < options['chunk_size']:
+                    continue
+                self.__import_chunk(chunk, done + 1)
+                done += len(chunk)
+                imported += len(chunk)
+                chunk = []
+                self.stdout.write('%s records imported (%.0f records/s)' % (done, imported / (time.time() - started)))
+            if len(chunk) > 0:
+                self.__import_chunk(chunk, done + 1)
+                done += len(chunk)
+                imported += len(chunk)
+        self.stdout.write('Import finished: %s records, %s in this run' % (done, imported))
+
+    def __read_jsonl(self, fp):
+        for line in fp:
+            if len(line.strip()) > 0:
+                yield json.loads(line)
+
+    def __parse_date(self, value, num):
+        date = parse_datetime(value) if isinstance(value, str) else None
+        if date is None:
+            raise CommandError('Record %s: wrong date' % num)
+        if date.tzinfo is None:
+            date = MOSCOW_TZ.localize(date)
+        return date
+
+    def __get_imported(self, legacy_ids):
+        # Legacy id -> comment id of imported records, the comment may be deleted since then
+        imported = {}
+        legacy_ids = list(legacy_ids)
+        for start in range(0, len(legacy_ids), BULK_BATCH_SIZE):
+            imported.update(ImportedComment.objects.filter(
+                name=self.name, legacy_id__in=legacy_ids[start:start + BULK_BATCH_SIZE]
+            ).values_list('legacy_id', 'comment_id'))
+        return imported
+
+    def __get_parents(self, imported):
+        # Legacy id -> (root id, path) of imported comments that were not deleted
+        parents = {}
+        legacy_ids = dict((c_id, legacy_id) for legacy_id, c_id in imported.items())
+        comment_ids = list(legacy_ids)
+        for start in range(0, len(comment_ids), BULK_BATCH_SIZE):
+            parents.update(
+                (legacy_ids[c_id], (root_id, path)) for c_id, root_id, path
+                in Comment.objects.filter(pk__in=comment_ids[start:start + BULK_BATCH_SIZE])
+                .values_list('id', 'root_id', 'path')
+            )
+        return parents
+
+    def __parse_chunk(self, records, first):
+        parsed = []
+        in_chunk = set()
+        targets = {}
+        parent_ids = set(str(r.get('parent') or '') for r in records)
+        imported = self.__get_imported(set(str(r.get('id') or '') for r in records) | parent_ids)
+        parents = self.__get_parents(dict((p, imported[p]) for p in parent_ids if p in imported))
+        for num, record in enumerate(records, first):
+            legacy_id = str(record.get('id') or '')
+            if len(legacy_id) == 0 or legacy_id in imported or legacy_id in in_chunk:
+                raise CommandError('Record %s: wrong or duplicate id' % num)
+            parent = record.get('parent')
+            parent = str(parent) if parent not in [None, ''] else None
+            if parent is None:
+                obj_type = str(record.get('obj_type'))
+                if obj_type not in COMMENT_TABLES:
+                    raise CommandError('Record %s: unsupported comment type' % num)
+                try:
+                    obj_id = int(record.get('obj_id'))
+                except (TypeError, ValueError):
+                    raise CommandError('Record %s: wrong parent object id' % num)
+                targets.setdefault(obj_type, set()).add(obj_id)
+            elif parent in parents or parent in in_chunk:
+                obj_type = obj_id = None
+            elif parent in imported:
+                raise CommandError('Record %s: the parent comment was deleted after it was imported' % num)
+            else:
+                raise CommandError('Record %s: the parent comment was not found before the record' % num)
+            if not isinstance(record.get('text'), str):
+                raise CommandError('Record %s: wrong text' % num)
+            date = self.__parse_date(record.get('date'), num)
+            parsed.append({
+                'id': legacy_id, 'parent': parent, 'obj_type': obj_type, 'obj_id': obj_id,
+                'author': str(record.get('author')), 'text': record['text'], 'date': date,
+                'last_change': self.__parse_date(record['last_change'], num) if record.get('last_change') else date
+            })
+            in_chunk.add(legacy_id)
+        return parsed, targets, parents
+
+    def __import_chunk(self, records, first):
+        records, targets, parents = self.__parse_chunk(records, first)
+        authors = dict(
+            User.objects.filter(username__in=set(r['author'] for r in records)).values_list('username', 'id')
+        )
+        for num, record in enumerate(records, first):
+            if record['author'] not in authors:
+                raise CommandError('Record %s: the author was not found' % num)
+        for obj_type in targets:
+            found = set(COMMENT_TABLES[obj_type].objects.filter(pk__in=targets[obj_type]).values_list('pk', flat=True))
+            if len(targets[obj_type] - found) > 0:
+                raise CommandError('Parent objects were not found: %s' % sorted(targets[obj_type] - found))
+
+        with transaction.atomic():
+            roots = {}
+            for obj_type in targets:
+                roots.update(
+                    ((obj_type, obj_id), root_id) for root_id, obj_id
+                    in CommentRoot.objects.filter(obj_type=obj_type, obj_id__in=targets[obj_type])
+                    .values_list('id', 'obj_id')
+                )
+                for obj_id in targets[obj_type]:
+                    if (obj_type, obj_id) not in roots:
+                        roots[(obj_type, obj_id)] = CommentRoot.objects\
+                            .get_or_create(obj_type=obj_type, obj_id=obj_id)[0].pk
+
+            # Replies to comments of the same chunk are inserted after them, so their parents have ids
+            created = {}
+            levels = {}
+            for record in records:
+                levels[record['id']] = levels[record['parent']] + 1 if record['parent'] in levels else 0
+            for level in range(max(levels.values()) + 1):
+                level_records = list(r for r in records if levels[r['id']] == level)
+                comments = []
+                parent_paths = []
+                for record in level_records:
+                    if record['parent'] is None:
+                        root_id, parent_id, parent_path = roots[(record['obj_type'], record['obj_id'])], None, ''
+                    elif record['parent'] in created:
+                        parent = created[record['parent']]
+                        root_id, parent_id, parent_path = parent.root_id, parent.pk, parent.path
+                    else:
+                        root_id, parent_path = parents[record['parent']]
+                        parent_id = get_path_ids(parent_path)[-1]
+                    comments.append(Comment(
+                        root_id=root_id, author_id=authors[record['author']], parent_id=parent_id,
+                        text=record['text'], date=record['date'], last_change=record['last_change']
+                    ))
+                    parent_paths.append(parent_path)
+                insert_comments(comments, parent_paths)
+                for record, comment in zip(level_records, comments):
+                    created[record['id']] = comment
+            increase_counters(list(created.values()))
+            if self.with_history:
+                CommentHistory.objects.bulk_create(list(
+                    CommentHistory(
+                        comment_id=c.pk, root_id=c.root_id, author_id=c.author_id, new_text=c.text, date=c.date
+                    )
+                    for c in created.values()
+                ), batch_size=BULK_BATCH_SIZE)
+            # The progress is committed with the comments, so an interrupted chunk is imported again on resume
+            ImportedComment.objects.bulk_create(list(
+                ImportedComment(name=self.name, legacy_id=legacy_id, comment_id=created[legacy_id].pk)
+                for legacy_id in created
+            ), batch_size=BULK_BATCH_SIZE)
+
+        for root_type, root_id in CommentRoot.objects.filter(pk__in=set(c.root_id for c in created.values()))\
+                .values_list('obj_type', 'obj_id'):
+            bump_tree_version(root_type, root_id)
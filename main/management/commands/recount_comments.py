@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from main.utils import *
+
+
+class Command(BaseCommand):
+    help = 'Recomputes reply and thread counters of comments if they drifted'
+
+    def handle(self, *args, **options):
+        roots = fixed = 0
+        for root in CommentRoot.objects.order_by('pk').iterator():
+            fixed += recount_comments(root)
+            roots += 1
+        self.stdout.write('%s comments were fixed in %s roots' % (fixed, roots))
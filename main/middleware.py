@@ -0,0 +1,58 @@
+import logging
+from django.conf import settings
+from main.history import history_queue
+from main.timing import RequestTimer, histograms, timing
+
+logger = logging.getLogger(__name__)
+
+
+class TimingMiddleware:
+    # Opt-in, add it first to MIDDLEWARE_CLASSES. Sends query count, database time and durations of timed
+    # sections (see main.timing.timing()) in the Server-Timing header and adds them to per-endpoint histograms.
+    # The header of a streamed response has only the time before streaming, the histograms get the whole time
+    # after the content is sent.
+    def process_request(self, request):
+        request.timer = RequestTimer()
+        request.timer.start()
+
+    def process_response(self, request, response):
+        timer = getattr(request, 'timer', None)
+        if timer is None or timer.started is None:
+            return response
+        timer.stop()
+        response['Server-Timing'] = timer.server_timing()
+        endpoint = request.resolver_match.view_name if request.resolver_match is not None else request.path
+        if response.streaming:
+            response.streaming_content = self.__timed_stream(timer, endpoint, response.streaming_content)
+        else:
+            histograms.record(endpoint, timer.values())
+        return response
+
+    def __timed_stream(self, timer, endpoint, content):
+        content = iter(content)
+        try:
+            while True:
+                timer.start()
+                try:
+                    with timing('stream'):
+                        data = next(content)
+                except StopIteration:
+                    break
+                finally:
+                    timer.stop()
+                yield data
+        finally:
+            histograms.record(endpoint, timer.values())
+
+
+class HistoryFlushMiddleware:
+    # Opt-in with settings.HISTORY_WRITE_BEHIND, add it first to MIDDLEWARE_CLASSES. History records of the request
+    # are written before the response is sent, they are still inserted by one query after the view's transaction.
+    def process_response(self, request, response):
+        if settings.HISTORY_WRITE_BEHIND:
+            try:
+                history_queue.flush()
+            except Exception:
+                # Changes of the request are committed, their records stay in the queue for the background thread
+                logger.exception('History records are not written')
+        return response
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 02:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+PATH_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def get_path_step(pk):
+    # Frozen copy of main.utils.get_path_step()
+    step = ''
+    while pk > 0:
+        pk, rest = divmod(pk, len(PATH_DIGITS))
+        step = PATH_DIGITS[rest] + step
+    return step.rjust(6, '0')
+
+
+def fill_paths(apps, schema_editor):
+    Comment = apps.get_model('main', 'Comment')
+    paths = {}
+    # Parents are always created before their children, so ordering by pk gives parents first
+    for pk, parent_id in Comment.objects.order_by('pk').values_list('pk', 'parent_id').iterator():
+        paths[pk] = paths.get(parent_id, '') + get_path_step(pk)
+        Comment.objects.filter(pk=pk).update(path=paths[pk])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.TextField(db_index=True, default=''),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
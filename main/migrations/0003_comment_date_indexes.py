@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 02:39
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_comment_path'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='comment',
+            index_together=set([('parent', 'date'), ('root', 'date')]),
+        ),
+    ]
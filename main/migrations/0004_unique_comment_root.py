@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 02:41
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_roots(apps, schema_editor):
+    CommentRoot = apps.get_model('main', 'CommentRoot')
+    Comment = apps.get_model('main', 'Comment')
+    duplicates = CommentRoot.objects.values('obj_type', 'obj_id')\
+        .annotate(roots_num=Count('id'), main_root=Min('id')).filter(roots_num__gt=1)
+    for root in duplicates:
+        other_roots = CommentRoot.objects.filter(obj_type=root['obj_type'], obj_id=root['obj_id'])\
+            .exclude(id=root['main_root'])
+        Comment.objects.filter(root__in=other_roots).update(root_id=root['main_root'])
+        other_roots.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_comment_date_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_roots, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='commentroot',
+            unique_together=set([('obj_type', 'obj_id')]),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 02:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_comments(apps, schema_editor):
+    # Frozen copy of main.utils.recount_comments()
+    CommentRoot = apps.get_model('main', 'CommentRoot')
+    Comment = apps.get_model('main', 'Comment')
+    for root in CommentRoot.objects.iterator():
+        rows = Comment.objects.filter(root=root).order_by('-path').values_list('id', 'parent_id')
+        children = {}
+        descendants = {}
+        for c_id, p_id in rows.iterator():
+            child_count = children.pop(c_id, 0)
+            descendant_count = descendants.pop(c_id, 0)
+            if child_count > 0:
+                Comment.objects.filter(pk=c_id).update(child_count=child_count, descendant_count=descendant_count)
+            if p_id is not None:
+                children[p_id] = children.get(p_id, 0) + 1
+                descendants[p_id] = descendants.get(p_id, 0) + descendant_count + 1
+        CommentRoot.objects.filter(pk=root.pk).update(comment_count=rows.count())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_unique_comment_root'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='child_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='descendant_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='commentroot',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_comments, migrations.RunPython.noop),
+    ]
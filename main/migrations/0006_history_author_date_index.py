@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 02:47
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_comment_counters'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='commenthistory',
+            index_together=set([('author', 'date')]),
+        ),
+    ]
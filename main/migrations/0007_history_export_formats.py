@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 02:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_history_author_date_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='downloadhistory',
+            name='file_type',
+            field=models.CharField(choices=[('0', 'txt'), ('1', 'json'), ('2', 'xml'), ('3', 'ndjson'), ('4', 'csv')], max_length=1),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 03:03
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_history_export_formats'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='downloadhistory',
+            index_together=set([('user', 'date')]),
+        ),
+    ]
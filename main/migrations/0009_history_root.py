@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 03:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_history_roots(apps, schema_editor):
+    # Roots of deleted comments are unknown, so only changes of existing comments get roots
+    CommentRoot = apps.get_model('main', 'CommentRoot')
+    CommentHistory = apps.get_model('main', 'CommentHistory')
+    for root_id in CommentRoot.objects.values_list('pk', flat=True).iterator():
+        CommentHistory.objects.filter(comment__root_id=root_id).update(root_id=root_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_download_user_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commenthistory',
+            name='deleted_comment',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='commenthistory',
+            name='root',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='history', to='main.CommentRoot'),
+        ),
+        migrations.AlterIndexTogether(
+            name='comment',
+            index_together=set([('root', 'last_change'), ('parent', 'date'), ('root', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='commenthistory',
+            index_together=set([('author', 'date'), ('root', 'date')]),
+        ),
+        migrations.RunPython(fill_history_roots, migrations.RunPython.noop),
+    ]
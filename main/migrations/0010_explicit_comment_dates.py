@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 03:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_history_root'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='comment',
+            name='date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='last_change',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
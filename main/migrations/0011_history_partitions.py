@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 03:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+from datetime import datetime, timedelta
+from django.utils.timezone import localtime, get_default_timezone, now
+
+# Partitions of months after the current one, later they are created by 'manage.py create_history_partitions'
+PARTITIONS_AHEAD = 3
+
+
+def month_start(date):
+    date = localtime(date)
+    return get_default_timezone().localize(datetime(date.year, date.month, 1))
+
+
+def partition_history(apps, schema_editor):
+    # The table of CommentHistory becomes partitioned by months of 'date' on PostgreSQL 11+, other databases keep
+    # the plain table. Partitions get all rows, indexes and foreign keys of the old table, and rows outside of the
+    # monthly partitions go to the default one. The primary key has to include 'date', so it is (id, date).
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = 'main_commenthistory'
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = %s::regclass AND NOT indisprimary',
+            [table]
+        )
+        indexes = list(row[0] for row in cursor.fetchall())
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass "
+            "AND contype = 'f'", [table]
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id'), min(date) FROM {0}".format(table), [table])
+        sequence, first_date = cursor.fetchone()
+
+        cursor.execute('ALTER TABLE {0} RENAME TO {0}_unpartitioned'.format(table))
+        cursor.execute(
+            'CREATE TABLE {0} (LIKE {0}_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+            'PARTITION BY RANGE (date)'.format(table)
+        )
+        cursor.execute('ALTER SEQUENCE {0} OWNED BY {1}.id'.format(sequence, table))
+        cursor.execute('ALTER TABLE {0} ADD PRIMARY KEY (id, date)'.format(table))
+        cursor.execute('CREATE TABLE {0}_default PARTITION OF {0} DEFAULT'.format(table))
+        start = month_start(first_date or now())
+        last = month_start(now() + timedelta(days=31 * PARTITIONS_AHEAD))
+        while start <= last:
+            end = month_start(start + timedelta(days=32))
+            cursor.execute(
+                'CREATE TABLE {0}_y{1:04d}m{2:02d} PARTITION OF {0} FOR VALUES FROM (%s) TO (%s)'.format(
+                    table, start.year, start.month
+                ), [start.isoformat(), end.isoformat()]
+            )
+            start = end
+        cursor.execute('INSERT INTO {0} SELECT * FROM {0}_unpartitioned'.format(table))
+        cursor.execute('DROP TABLE {0}_unpartitioned'.format(table))
+        for index in indexes:
+            cursor.execute(index)
+        for name, definition in foreign_keys:
+            cursor.execute('ALTER TABLE {0} ADD CONSTRAINT {1} {2}'.format(table, name, definition))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_explicit_comment_dates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(unique=True)),
+                ('end', models.DateTimeField()),
+                ('file_name', models.CharField(max_length=255)),
+                ('rows', models.PositiveIntegerField()),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        # Partitioned table works as the plain one, so it isn't converted back
+        migrations.RunPython(partition_history, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 03:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_history_partitions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='edits',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='commenthistory',
+            name='delta',
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 03:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Frozen copy of main.utils.PATH_KEY_LENGTH
+PATH_KEY_LENGTH = 2400
+
+
+def create_path_index(apps, schema_editor):
+    # Whole paths of deep comments are too long for btree entries of PostgreSQL, so it indexes only their first
+    # levels. The expression is the same as Substr() of main.utils.with_path_key() in queries.
+    if schema_editor.connection.vendor == 'postgresql':
+        key = 'SUBSTRING(path, 1, %s)' % PATH_KEY_LENGTH
+    else:
+        key = 'path'
+    schema_editor.execute('CREATE INDEX main_comment_root_path_key ON main_comment (root_id, %s)' % key)
+
+
+def drop_path_index(apps, schema_editor):
+    schema_editor.execute('DROP INDEX main_comment_root_path_key')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_history_deltas'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='comment',
+            name='path',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(create_path_index, drop_path_index),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 03:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_comment_path_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historyarchive',
+            name='pending',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 04:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_history_archive_pending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportedComment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('legacy_id', models.CharField(max_length=255)),
+                ('comment', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='main.Comment')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='importedcomment',
+            unique_together=set([('name', 'legacy_id')]),
+        ),
+    ]
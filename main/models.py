@@ -1,5 +1,6 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils.timezone import now
 from Comments.vars import OBJECT_TYPES, COMMENT_HISTORY_TYPE
 
 
@@ -18,27 +19,77 @@ class AnotherObject(models.Model):
 class CommentRoot(models.Model):
     obj_type = models.CharField(max_length=1, choices=OBJECT_TYPES, db_index=True)
     obj_id = models.PositiveIntegerField(db_index=True)
+    comment_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         db_table = 'comment_root'
+        unique_together = ('obj_type', 'obj_id')
 
 
 class Comment(models.Model):
     root = models.ForeignKey(CommentRoot)
     author = models.ForeignKey(User)
     parent = models.ForeignKey('self', null=True, related_name='children')
-    date = models.DateTimeField(auto_now_add=True)
-    last_change = models.DateTimeField(auto_now=True)
+    # Dates are written explicitly, so the comment and its history get the same date, see main.utils.create_comment()
+    date = models.DateTimeField(default=now)
+    last_change = models.DateTimeField(default=now)
     text = models.TextField()
+    # Materialized path: ids of all ancestors and of the comment itself, see main.utils.get_path_step(). It is
+    # indexed with the root by migration 0013_comment_path_key, see main.utils.PATH_KEY_LENGTH.
+    path = models.TextField(default='')
+    child_count = models.PositiveIntegerField(default=0)
+    descendant_count = models.PositiveIntegerField(default=0)
+    # Number of changes of the text, it decides which ones are stored in full, see main.history.is_snapshot()
+    edits = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # For keyset pagination of first level comments, see main.utils.first_level_page(),
+        # and for changes of threads, see main.utils.get_tree_changes()
+        index_together = [['root', 'date'], ['parent', 'date'], ['root', 'last_change']]
 
 
 class CommentHistory(models.Model):
     comment = models.ForeignKey(Comment, null=True, on_delete=models.SET_NULL, related_name='history')
+    # Root of the comment, it is kept after the comment is deleted. Changes before it was added have no root.
+    root = models.ForeignKey(CommentRoot, null=True, related_name='history')
+    # Id of the deleted comment for deletions
+    deleted_comment = models.PositiveIntegerField(null=True)
     author = models.ForeignKey(User)
     old_text = models.TextField(null=True)
     new_text = models.TextField(null=True)
+    # Delta-encoded edits have no texts, the delta changes the previous version of the comment to the new text.
+    # See main.history.make_delta().
+    delta = models.TextField(null=True)
     date = models.DateTimeField(db_index=True)
 
+    class Meta:
+        # History is downloaded by author for a range of dates, see main.utils.DownloadCommentsHistory,
+        # deletions are read by root for changes of threads, see main.utils.get_tree_changes()
+        index_together = [['author', 'date'], ['root', 'date']]
+
+
+class HistoryArchive(models.Model):
+    # Changes with dates in [start, end) moved from a detached partition of CommentHistory to a compressed file
+    # in settings.HISTORY_ARCHIVE_DIR, see main.partitions.archive_history_partition()
+    start = models.DateTimeField(unique=True)
+    end = models.DateTimeField()
+    file_name = models.CharField(max_length=255)
+    rows = models.PositiveIntegerField()
+    date = models.DateTimeField(default=now)
+    # The partition is detached but the file is not written yet, its rows are read from the detached table
+    pending = models.BooleanField(default=False)
+
+
+class ImportedComment(models.Model):
+    # Comments created by 'manage.py import_comments' by their ids in the import. Records are saved with the
+    # comments, so the import resumes after the last committed chunk. Deleted comments keep their records.
+    name = models.CharField(max_length=255)
+    legacy_id = models.CharField(max_length=255)
+    comment = models.ForeignKey(Comment, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+
+    class Meta:
+        unique_together = [['name', 'legacy_id']]
+
 
 class DownloadHistory(models.Model):
     user = models.ForeignKey(User)
@@ -47,3 +98,7 @@ class DownloadHistory(models.Model):
     min_date = models.DateTimeField()
     max_date = models.DateTimeField()
     file_type = models.CharField(max_length=1, choices=COMMENT_HISTORY_TYPE)
+
+    class Meta:
+        # Downloads are listed by user for a range of dates, see main.utils.UserDownloads
+        index_together = [['user', 'date']]
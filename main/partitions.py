@@ -0,0 +1,232 @@
+import gzip
+import json
+import os
+import re
+import tempfile
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import get_default_timezone, localtime, now
+from Comments.vars import HISTORY_CHUNK_SIZE, HISTORY_PARTITIONS_AHEAD
+from main.history import month_start, next_month, expand_deltas
+from main.models import CommentHistory, HistoryArchive
+
+# History is partitioned by months of CommentHistory.date on PostgreSQL, see migration 0011_history_partitions
+HISTORY_TABLE = CommentHistory._meta.db_table
+
+# Columns of archived changes, rows of archives are ordered by (author_id, date, id)
+ARCHIVE_COLUMNS = ['id', 'comment_id', 'root_id', 'deleted_comment', 'author_id', 'old_text', 'new_text', 'date']
+
+ARCHIVED_END_KEY = 'history_archive:end'
+
+
+def partition_name(start):
+    # Months start in the time zone of the project, dates read from database may be in UTC
+    start = localtime(start)
+    return '%s_y%04dm%02d' % (HISTORY_TABLE, start.year, start.month)
+
+
+def get_archived_end():
+    # End of the last archived month or None, changes before it are not in CommentHistory. It's cached until the
+    # next archive is saved.
+    value = cache.get(ARCHIVED_END_KEY)
+    if value is None:
+        value = [HistoryArchive.objects.aggregate(end=Max('end'))['end']]
+        cache.set(ARCHIVED_END_KEY, value, None)
+    return value[0]
+
+
+def reset_archived_end():
+    # Removed again after the commit, a reader may cache the value of an older snapshot in between
+    cache.delete(ARCHIVED_END_KEY)
+    transaction.on_commit(lambda: cache.delete(ARCHIVED_END_KEY))
+
+
+def is_history_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [HISTORY_TABLE])
+        return cursor.fetchone() is not None
+
+
+def history_partitions():
+    # Starts of months of attached monthly partitions in ascending order
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname FROM pg_inherits i INNER JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass', [HISTORY_TABLE]
+        )
+        names = list(row[0] for row in cursor.fetchall())
+    starts = []
+    for name in names:
+        m = re.match(r'^%s_y(\d{4})m(\d{2})$' % HISTORY_TABLE, name)
+        if m is not None:
+            starts.append(get_default_timezone().localize(datetime(int(m.group(1)), int(m.group(2)), 1)))
+    return sorted(starts)
+
+
+def create_history_partitions(months=HISTORY_PARTITIONS_AHEAD):
+    # Partitions of the current month and of 'months' next ones, returns names of created partitions
+    existing = set(history_partitions())
+    created = []
+    start = month_start(now())
+    for i in range(months + 1):
+        if start not in existing:
+            create_history_partition(start)
+            created.append(partition_name(start))
+        start = next_month(start)
+    return created
+
+
+def create_history_partition(start):
+    # A partition can't be created while the default one has rows of its month, so they are moved to a new table
+    # that is attached as the partition. Writes to the default partition wait for the commit, so no rows of the
+    # month come in between.
+    name = partition_name(start)
+    bounds = [start.isoformat(), next_month(start).isoformat()]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('LOCK TABLE {0}_default IN EXCLUSIVE MODE'.format(HISTORY_TABLE))
+        cursor.execute('SELECT 1 FROM {0}_default WHERE date >= %s AND date < %s LIMIT 1'.format(HISTORY_TABLE), bounds)
+        if cursor.fetchone() is None:
+            cursor.execute('CREATE TABLE {0} PARTITION OF {1} FOR VALUES FROM (%s) TO (%s)'.format(
+                name, HISTORY_TABLE
+            ), bounds)
+            return
+        cursor.execute('CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(
+            name, HISTORY_TABLE
+        ))
+        cursor.execute(
+            'WITH moved AS (DELETE FROM {0}_default WHERE date >= %s AND date < %s RETURNING *) '
+            'INSERT INTO {1} SELECT * FROM moved'.format(HISTORY_TABLE, name), bounds
+        )
+        # Indexes and foreign keys of the history table are created for the attached partition
+        cursor.execute('ALTER TABLE {0} ATTACH PARTITION {1} FOR VALUES FROM (%s) TO (%s)'.format(
+            HISTORY_TABLE, name
+        ), bounds)
+
+
+def iterate_partition(name, chunk_size=HISTORY_CHUNK_SIZE):
+    # Rows of a detached partition in the order of archives, read by chunks seeking from the last row
+    last_row = None
+    with connection.cursor() as cursor:
+        while True:
+            query = 'SELECT {0} FROM {1}'.format(', '.join(ARCHIVE_COLUMNS), name)
+            params = []
+            if last_row is not None:
+                query += ' WHERE (author_id, date, id) > (%s, %s, %s)'
+                params = [last_row[4], last_row[7], last_row[0]]
+            cursor.execute(query + ' ORDER BY author_id, date, id LIMIT %s', params + [chunk_size])
+            chunk = cursor.fetchall()
+            for row in chunk:
+                yield row
+            if len(chunk) < chunk_size:
+                break
+            last_row = chunk[-1]
+
+
+def write_history_archive(rows, start, end):
+    # Writes rows with ARCHIVE_COLUMNS ordered by (author_id, date, id) to the archive of [start, end), a pending
+    # one becomes complete. The file is complete before the archive is saved, so readers never see a partial one.
+    os.makedirs(settings.HISTORY_ARCHIVE_DIR, exist_ok=True)
+    file_name = '%s.jsonl.gz' % partition_name(start)
+    fd, tmp_path = tempfile.mkstemp(dir=settings.HISTORY_ARCHIVE_DIR, suffix='.tmp')
+    num = 0
+    try:
+        with open(fd, mode='wb') as raw, gzip.open(raw, mode='wt', encoding='utf8') as fp:
+            for row in rows:
+                row = list(row)
+                row[7] = row[7].isoformat()
+                fp.write(json.dumps(row) + '\n')
+                num += 1
+        os.replace(tmp_path, os.path.join(settings.HISTORY_ARCHIVE_DIR, file_name))
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    archive = HistoryArchive.objects.update_or_create(start=start, defaults={
+        'end': end, 'file_name': file_name, 'rows': num, 'pending': False
+    })[0]
+    reset_archived_end()
+    return archive
+
+
+def detach_history_partition(start):
+    # Detaches the partition of the month and saves its pending archive. Archives have only full texts, so deltas
+    # are expanded while the partition is locked against changes; deltas of the month don't depend on other months.
+    # Foreign keys of the detached table are dropped, so comments can be deleted until it's archived. The table of
+    # history is locked by the detach only until the commit.
+    name = partition_name(start)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE {0} IN SHARE MODE'.format(name))
+        expand_deltas(CommentHistory.objects.filter(date__gte=start, date__lt=next_month(start)))
+        with connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE {0} DETACH PARTITION {1}'.format(HISTORY_TABLE, name))
+            cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'", [name])
+            for constraint in list(row[0] for row in cursor.fetchall()):
+                cursor.execute('ALTER TABLE {0} DROP CONSTRAINT {1}'.format(name, constraint))
+        archive = HistoryArchive.objects.create(
+            start=start, end=next_month(start), file_name='', rows=0, pending=True
+        )
+        reset_archived_end()
+        return archive
+
+
+def finish_history_archive(archive):
+    # Writes the file of the pending archive and drops its detached table
+    with transaction.atomic():
+        archive = write_history_archive(iterate_partition(partition_name(archive.start)), archive.start, archive.end)
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE {0}'.format(partition_name(archive.start)))
+    return archive
+
+
+def archive_history_partition(start):
+    # Moves rows of the month to an archive. The file is written after the detach is committed, so writes and reads
+    # of history don't wait for it. If it's interrupted, 'manage.py archive_history' finishes the pending archive.
+    return finish_history_archive(detach_history_partition(start))
+
+
+def read_detached_partition(archive, author_id, from_date=None, to_date=None, position=None):
+    # Rows of the pending archive like read_history_archive() returns them
+    query = 'SELECT id, date, old_text, new_text, comment_id FROM {0} WHERE author_id = %s'.format(
+        partition_name(archive.start)
+    )
+    params = [author_id]
+    if from_date is not None:
+        query += ' AND date >= %s'
+        params.append(from_date)
+    if to_date is not None:
+        query += ' AND date <= %s'
+        params.append(to_date)
+    if position is not None:
+        query += ' AND (date, id) > (%s, %s)'
+        params.extend(position)
+    # The model converts values like for the table of history
+    for change in CommentHistory.objects.raw(query + ' ORDER BY date, id', params):
+        yield change.id, change.date, change.old_text, change.new_text, change.comment_id, None
+
+
+def read_history_archive(archive, author_id, from_date=None, to_date=None, position=None):
+    # Rows with main.history.HISTORY_COLUMNS of the author's changes ordered by (date, id) like in
+    # main.utils.DownloadCommentsHistory, 'position' is the (date, id) of the last row that is not needed
+    if archive.pending:
+        for row in read_detached_partition(archive, author_id, from_date, to_date, position):
+            yield row
+        return
+    with gzip.open(os.path.join(settings.HISTORY_ARCHIVE_DIR, archive.file_name), mode='rt', encoding='utf8') as fp:
+        for line in fp:
+            row = json.loads(line)
+            if row[4] < author_id:
+                continue
+            if row[4] > author_id:
+                break
+            date = parse_datetime(row[7])
+            if (from_date is not None and date < from_date) or (to_date is not None and date > to_date):
+                continue
+            if position is not None and (date, row[0]) <= tuple(position):
+                continue
+            yield row[0], date, row[5], row[6], row[1], None
@@ -1,14 +1,40 @@
+import csv
+import gzip
 import json
-from io import BytesIO
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction, OperationalError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.test import Client
+from django.http import FileResponse
+from django.core.cache import cache
 from django.utils.timezone import now
-from main.models import *
+from django.conf import settings
+from main.benchmarks import BENCHMARKS
+from main.history import history_queue, month_start, next_month, is_snapshot, make_delta, apply_delta, expand_deltas
+from main.partitions import ARCHIVE_COLUMNS, write_history_archive, is_history_partitioned, history_partitions, \
+    partition_name, detach_history_partition, get_archived_end, reset_archived_end
+from main.timing import histograms
+from main.utils import *
 
 
 class TestApi(TestCase):
     def setUp(self):
         super(TestApi, self).setUp()
+        cache.clear()
+        self.export_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.export_cache, True)
+        export_settings = self.settings(EXPORT_CACHE_DIR=self.export_cache)
+        export_settings.enable()
+        self.addCleanup(export_settings.disable)
         self.author = User.objects.get_or_create(username='test')[0]
         self.author.set_password('1234')
         self.author.save()
@@ -131,7 +157,9 @@ class TestApi(TestCase):
         content = json.loads(str(res.content, encoding='utf8'))
         self.assertNotIn('error', content)
         comment_list = json.loads(content['comments'])
-        self.assertEqual(comment_list, [[1, {'text': 'Comment 1'}]])
+        self.assertEqual(comment_list, [
+            [1, {'id': comments[0].pk, 'text': 'Comment 1', 'child_count': 0, 'descendant_count': 0}]
+        ])
 
         res = self.client.get('/first_level/1/', {'obj': comments[1].pk, 'type': 'c'})
         self.assertEqual(res.status_code, 200)
@@ -139,7 +167,10 @@ class TestApi(TestCase):
         content = json.loads(str(res.content, encoding='utf8'))
         self.assertNotIn('error', content)
         comment_list = json.loads(content['comments'])
-        self.assertEqual(comment_list, [[1, {'text': 'Comment 3'}], [2, {'text': 'Comment 4'}]])
+        self.assertEqual(comment_list, [
+            [1, {'id': comments[2].pk, 'text': 'Comment 3', 'child_count': 0, 'descendant_count': 0}],
+            [2, {'id': comments[3].pk, 'text': 'Comment 4', 'child_count': 1, 'descendant_count': 1}]
+        ])
 
         res = self.client.get('/first_level/1/', {'obj': self.ids[2], 'type': '2'})
         self.assertEqual(res.status_code, 200)
@@ -231,6 +262,1044 @@ class TestApi(TestCase):
         self.assertEqual(user_download.file_type, '1')
         # TODO: test 'txt' and 'xml' formats
 
+    def test_7_paths(self):
+        # 1[2[4], 3], 5
+        self.client.post('/create_comment/', {'obj_type': '0', 'obj_id': self.ids[0], 'text': 'Comment 1'})
+        comment1 = Comment.objects.get()
+        self.client.post('/create_comment/', {'obj_type': 'c', 'obj_id': comment1.pk, 'text': 'Comment 2'})
+        comment2 = Comment.objects.get(text='Comment 2')
+        self.client.post('/create_comment/', {'obj_type': 'c', 'obj_id': comment1.pk, 'text': 'Comment 3'})
+        self.client.post('/create_comment/', {'obj_type': 'c', 'obj_id': comment2.pk, 'text': 'Comment 4'})
+        self.client.post('/create_comment/', {'obj_type': '0', 'obj_id': self.ids[0], 'text': 'Comment 5'})
+
+        comment2 = Comment.objects.get(pk=comment2.pk)
+        self.assertEqual(comment2.path, get_path_step(comment1.pk) + get_path_step(comment2.pk))
+        self.assertEqual(
+            list(subtree_comments(comment1).values_list('text', flat=True)),
+            ['Comment 1', 'Comment 2', 'Comment 4', 'Comment 3']
+        )
+        self.assertEqual(list(subtree_comments(comment2).values_list('text', flat=True)), ['Comment 2', 'Comment 4'])
+
+    def test_8_deep_tree(self):
+        # Paths of the deepest comments are longer than PATH_KEY_LENGTH and than a btree entry of PostgreSQL
+        depth = 2100
+        first = parent = create_comment(self.author, '0', self.ids[0], 'Comment 0')
+        chain = [first]
+        for i in range(1, depth):
+            parent = create_comment(self.author, 'c', parent.pk, 'Comment %s' % i)
+            chain.append(parent)
+        self.assertGreater(len(parent.path), PATH_KEY_LENGTH)
+
+        node = CommentTree('c', first.pk).get_tree()
+        for i in range(depth):
+            self.assertEqual(node['text'], 'Comment %s' % i)
+            self.assertEqual(len(node['children']), 0 if i == depth - 1 else 1)
+            if len(node['children']) > 0:
+                node = node['children'][0]
+
+        tree = CommentTree('0', self.ids[0]).get_tree()
+        self.assertEqual(tree['name'], 'Blog post')
+        self.assertEqual(len(tree['comments']), 1)
+        self.assertEqual(tree['comments'][0]['text'], 'Comment 0')
+
+        # Subtrees below the indexed levels share the key of their ancestor
+        sibling = create_comment(self.author, 'c', chain[1500].pk, 'Sibling')
+        tree = CommentTree('c', chain[1500].pk).get_tree(max_depth=2)
+        self.assertEqual(list(c['text'] for c in tree['children']), ['Comment 1501', 'Sibling'])
+        self.assertEqual(expand_tree(tree['children'][0]['cursor'], max_depth=1)['comments'][0]['text'],
+                         'Comment 1502')
+        self.assertEqual(list(subtree_comments(sibling).values_list('text', flat=True)), ['Sibling'])
+        delete_comment(self.author, sibling.pk)
+
+        # The chain is too deep for json.loads() too, so the response is compared with the stream
+        for obj_type, obj_id in [('c', first.pk), ('0', self.ids[0])]:
+            res = self.client.post('/get_tree/', {'obj_type': obj_type, 'obj_id': obj_id})
+            self.assertEqual(json.loads(str(res.content, encoding='utf8'))['comments'],
+                             ''.join(IterTree(CommentTree(obj_type, obj_id))))
+
+    def test_9_tree_cache(self):
+        self.client.post('/create_comment/', {'obj_type': '0', 'obj_id': self.ids[0], 'text': 'Comment 1'})
+        comment = Comment.objects.get()
+
+        for i in range(2):
+            res = self.client.post('/get_tree/', {'obj_id': self.ids[0], 'obj_type': '0'})
+            comment_tree = json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])
+            self.assertEqual(len(comment_tree['comments']), 1)
+        self.assertEqual(tree_cache_stats(), {'hits': 1, 'misses': 1})
+
+        self.client.post('/create_comment/', {'obj_type': 'c', 'obj_id': comment.pk, 'text': 'Comment 2'})
+        res = self.client.post('/get_tree/', {'obj_id': self.ids[0], 'obj_type': '0'})
+        comment_tree = json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])
+        self.assertEqual(comment_tree['comments'][0]['children'][0]['text'], 'Comment 2')
+        self.assertEqual(tree_cache_stats(), {'hits': 1, 'misses': 2})
+
+        res = self.client.post('/get_tree/', {'obj_id': comment.pk, 'obj_type': 'c'})
+        self.assertEqual(json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])['text'], 'Comment 1')
+        self.client.post('/change_comment/', {'comment_id': comment.pk, 'text': 'New comment 1'})
+        res = self.client.post('/get_tree/', {'obj_id': comment.pk, 'obj_type': 'c'})
+        self.assertEqual(json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])['text'], 'New comment 1')
+
+        self.client.post('/delete_comment/', {'comment_id': Comment.objects.get(parent=comment).pk})
+        res = self.client.post('/get_tree/', {'obj_id': self.ids[0], 'obj_type': '0'})
+        comment_tree = json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])
+        self.assertEqual(comment_tree['comments'][0]['children'], [])
+        self.assertEqual(tree_cache_stats(), {'hits': 1, 'misses': 5})
+
+    def test_10_first_level_cursor(self):
+        comments = list(create_comment(self.author, '0', self.ids[0], 'Comment %s' % i) for i in range(25))
+        for i in range(3):
+            create_comment(self.author, 'c', comments[0].pk, 'Reply %s' % i)
+
+        res = self.client.get('/first_level/', {'obj': self.ids[0], 'type': '0'})
+        self.assertEqual(res.status_code, 200)
+        content = json.loads(str(res.content, encoding='utf8'))
+        self.assertNotIn('error', content)
+        comment_list = json.loads(content['comments'])
+        comments[0] = Comment.objects.get(pk=comments[0].pk)
+        # Items are [position, data] like in pages
+        self.assertEqual(comment_list, list([i + 1, {
+            'id': c.pk, 'text': c.text, 'child_count': c.child_count, 'descendant_count': c.descendant_count
+        }] for i, c in enumerate(comments[:20])))
+        self.assertIsNotNone(content['cursor'])
+
+        res = self.client.get('/first_level/', {'obj': self.ids[0], 'type': '0', 'cursor': content['cursor']})
+        content = json.loads(str(res.content, encoding='utf8'))
+        self.assertNotIn('error', content)
+        comment_list = json.loads(content['comments'])
+        self.assertEqual(comment_list, list([i + 21, {
+            'id': c.pk, 'text': c.text, 'child_count': 0, 'descendant_count': 0
+        }] for i, c in enumerate(comments[20:])))
+        self.assertIsNone(content['cursor'])
+
+        res = self.client.get('/first_level/', {'obj': comments[0].pk, 'type': 'c'})
+        content = json.loads(str(res.content, encoding='utf8'))
+        self.assertEqual(list(x[1]['text'] for x in json.loads(content['comments'])), ['Reply 0', 'Reply 1', 'Reply 2'])
+        self.assertIsNone(content['cursor'])
+
+        res = self.client.get('/first_level/', {'obj': self.ids[0], 'type': '0', 'cursor': 'wrong'})
+        self.assertEqual(json.loads(str(res.content, encoding='utf8'))['error'], 'Wrong cursor')
+
+    def test_11_tree_stream(self):
+        # 1[2[3, 4[5]], 6], 7
+        comment1 = create_comment(self.author, '0', self.ids[0], 'Comment 1')
+        comment2 = create_comment(self.author, 'c', comment1.pk, 'Comment "2"')
+        create_comment(self.author, 'c', comment2.pk, 'Comment 3')
+        comment4 = create_comment(self.author, 'c', comment2.pk, 'Comment 4')
+        create_comment(self.author, 'c', comment4.pk, 'Comment 5')
+        create_comment(self.author, 'c', comment1.pk, 'Comment 6')
+        create_comment(self.author, '0', self.ids[0], 'Comment 7')
+
+        res = self.client.post('/get_tree/', {'obj_id': self.ids[0], 'obj_type': '0', 'stream': '1'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], 'application/json')
+        content = json.loads(b''.join(res.streaming_content).decode('utf8'))
+        self.assertEqual(content, CommentTree('0', self.ids[0]).get_tree())
+
+        for chunk_size in [1, 2, 100]:
+            for obj_type, obj_id in [('0', self.ids[0]), ('c', comment1.pk), ('c', comment2.pk)]:
+                tree = CommentTree(obj_type, obj_id)
+                self.assertEqual(json.loads(''.join(IterTree(tree, chunk_size))), tree.get_tree())
+        self.assertEqual(json.loads(''.join(IterTree(CommentTree('2', self.ids[2])))), {
+            'name': 'Another object', 'obj_type': 'Another object', 'comment_count': 0, 'comments': []
+        })
+
+    def test_12_single_root(self):
+        for i in range(3):
+            self.client.post('/create_comment/', {'obj_type': '0', 'obj_id': self.ids[0], 'text': 'Comment %s' % i})
+        self.client.post('/create_comment/', {'obj_type': '1', 'obj_id': self.ids[1], 'text': 'Comment 3'})
+        self.assertEqual(CommentRoot.objects.filter(obj_type='0', obj_id=self.ids[0]).count(), 1)
+        self.assertEqual(CommentRoot.objects.count(), 2)
+        self.assertEqual(root_comments('0', self.ids[0]).count(), 3)
+        self.assertEqual(root_comments('2', self.ids[2]).count(), 0)
+
+    def test_13_counters(self):
+        # 1[2[3, 4[5]], 6], 7
+        comment1 = create_comment(self.author, '0', self.ids[0], 'Comment 1')
+        comment2 = create_comment(self.author, 'c', comment1.pk, 'Comment 2')
+        create_comment(self.author, 'c', comment2.pk, 'Comment 3')
+        comment4 = create_comment(self.author, 'c', comment2.pk, 'Comment 4')
+        comment5 = create_comment(self.author, 'c', comment4.pk, 'Comment 5')
+        create_comment(self.author, 'c', comment1.pk, 'Comment 6')
+        create_comment(self.author, '0', self.ids[0], 'Comment 7')
+
+        def get_counters():
+            return dict((c.text, [c.child_count, c.descendant_count]) for c in Comment.objects.all())
+
+        self.assertEqual(get_counters(), {
+            'Comment 1': [2, 5], 'Comment 2': [2, 3], 'Comment 3': [0, 0], 'Comment 4': [1, 1],
+            'Comment 5': [0, 0], 'Comment 6': [0, 0], 'Comment 7': [0, 0]
+        })
+        self.assertEqual(CommentRoot.objects.get().comment_count, 7)
+
+        tree = CommentTree('0', self.ids[0]).get_tree()
+        self.assertEqual(tree['comment_count'], 7)
+        self.assertEqual(tree['comments'][0]['child_count'], 2)
+        self.assertEqual(tree['comments'][0]['descendant_count'], 5)
+
+        delete_comment(self.author, comment5.pk)
+        counters = get_counters()
+        self.assertEqual(counters['Comment 1'], [2, 4])
+        self.assertEqual(counters['Comment 2'], [2, 2])
+        self.assertEqual(counters['Comment 4'], [0, 0])
+        self.assertEqual(CommentRoot.objects.get().comment_count, 6)
+
+        Comment.objects.update(child_count=10, descendant_count=10)
+        CommentRoot.objects.update(comment_count=0)
+        self.assertEqual(recount_comments(CommentRoot.objects.get()), 6)
+        self.assertEqual(get_counters(), counters)
+        self.assertEqual(CommentRoot.objects.get().comment_count, 6)
+
+    def test_14_batch_creation(self):
+        comment1 = create_comment(self.author, '0', self.ids[0], 'Comment 1')
+        entries = [
+            {'obj_type': '0', 'obj_id': self.ids[0], 'text': 'Comment 2'},
+            {'obj_type': 'c', 'obj_id': comment1.pk, 'text': 'Comment 3'},
+            {'parent': 0, 'text': 'Comment 4'},
+            {'parent': 2, 'text': 'Comment 5'},
+            {'obj_type': '1', 'obj_id': self.ids[1], 'text': 'Comment 6'}
+        ]
+        res = self.client.post('/create_comments/', {'comments': json.dumps(entries)})
+        self.assertEqual(res.status_code, 200)
+        content = json.loads(str(res.content, encoding='utf8'))
+        self.assertNotIn('error', content)
+        self.assertNotIn('errors', content)
+        self.assertEqual(len(content['ids']), 5)
+        comments = list(Comment.objects.get(pk=c_id) for c_id in content['ids'])
+        self.assertEqual(list(c.text for c in comments), list(e['text'] for e in entries))
+        self.assertIsNone(comments[0].parent)
+        self.assertEqual(comments[1].parent, comment1)
+        self.assertEqual(comments[2].parent, comments[0])
+        self.assertEqual(comments[3].parent, comments[2])
+        self.assertEqual(comments[3].path, get_path_step(comments[0].pk) + get_path_step(comments[2].pk)
+                         + get_path_step(comments[3].pk))
+        self.assertEqual([comments[0].child_count, comments[0].descendant_count], [1, 2])
+        self.assertEqual(Comment.objects.get(pk=comment1.pk).child_count, 1)
+        self.assertEqual(CommentRoot.objects.get(obj_type='0', obj_id=self.ids[0]).comment_count, 5)
+        self.assertEqual(CommentRoot.objects.get(obj_type='1', obj_id=self.ids[1]).comment_count, 1)
+        self.assertEqual(
+            set(CommentHistory.objects.filter(new_text__in=list(e['text'] for e in entries))
+                .values_list('comment_id', flat=True)),
+            set(content['ids'])
+        )
+        self.assertEqual(len(CommentTree('0', self.ids[0]).get_tree()['comments']), 2)
+
+        res = self.client.post('/create_comments/', {'comments': json.dumps([
+            {'obj_type': '0', 'obj_id': self.ids[0], 'text': 'Comment 7'},
+            {'obj_type': 'c', 'obj_id': 100000, 'text': 'Comment 8'},
+            {'parent': 1, 'text': 'Comment 9'},
+            {'parent': 5, 'text': 'Comment 10'}
+        ])})
+        content = json.loads(str(res.content, encoding='utf8'))
+        self.assertEqual(content['errors'], [
+            [1, 'The parent comment was not found'], [2, 'The parent comment is wrong'], [3, 'Wrong parent index']
+        ])
+        self.assertEqual(Comment.objects.count(), 6)
+
+    def test_15_import(self):
+        # a[b[d], c], e
+        records = [
+            {'id': 'a', 'obj_type': '0', 'obj_id': self.ids[0], 'author': 'test', 'text': 'Comment a',
+             'date': '2016-11-20T16:00:00', 'last_change': '2016-11-21T16:00:00'},
+            {'id': 'b', 'parent': 'a', 'author': 'test', 'text': 'Comment b', 'date': '2016-11-20T16:01:00'},
+            {'id': 'c', 'parent': 'a', 'author': 'test', 'text': 'Comment c', 'date': '2016-11-20T16:02:00'},
+            {'id': 'd', 'parent': 'b', 'author': 'test', 'text': 'Comment d', 'date': '2016-11-20T16:03:00'},
+            {'id': 'e', 'obj_type': '0', 'obj_id': self.ids[0], 'author': 'test', 'text': 'Comment e',
+             'date': '2016-11-20T16:04:00'}
+        ]
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        dump = os.path.join(work_dir, 'dump.jsonl')
+        with open(dump, mode='w', encoding='utf8') as fp:
+            for record in records[:3]:
+                fp.write(json.dumps(record) + '\n')
+        call_command('import_comments', dump, chunk_size=2, stdout=StringIO())
+        self.assertEqual(Comment.objects.count(), 3)
+        self.assertEqual(CommentHistory.objects.count(), 3)
+        # The progress is in the database with the comments
+        self.assertEqual(dict(ImportedComment.objects.filter(name=dump).values_list('legacy_id', 'comment__text')),
+                         {'a': 'Comment a', 'b': 'Comment b', 'c': 'Comment c'})
+
+        # The second run resumes after already imported records
+        with open(dump, mode='a', encoding='utf8') as fp:
+            for record in records[3:]:
+                fp.write(json.dumps(record) + '\n')
+        out = StringIO()
+        call_command('import_comments', dump, chunk_size=2, stdout=out)
+        self.assertIn('Resuming after 3 records', out.getvalue())
+        self.assertEqual(Comment.objects.count(), 5)
+
+        tree = CommentTree('0', self.ids[0]).get_tree()
+        self.assertEqual(tree['comment_count'], 5)
+        self.assertEqual(list(c['text'] for c in tree['comments']), ['Comment a', 'Comment e'])
+        self.assertEqual(list(c['text'] for c in tree['comments'][0]['children']), ['Comment b', 'Comment c'])
+        self.assertEqual(tree['comments'][0]['children'][0]['children'][0]['text'], 'Comment d')
+        self.assertEqual(tree['comments'][0]['date'], [2016, 11, 20, 16, 0, 0, 0])
+        self.assertEqual(tree['comments'][0]['last_change'], [2016, 11, 21, 16, 0, 0, 0])
+        self.assertEqual(tree['comments'][0]['descendant_count'], 3)
+
+        # Deleted comments keep their legacy ids, but they can't be parents of new ones
+        delete_comment(self.author, Comment.objects.get(text='Comment c').pk)
+        next_dump = os.path.join(work_dir, 'next_dump.jsonl')
+        for record, error in [
+            ({'id': 'c', 'parent': 'a', 'author': 'test', 'text': 'Comment c', 'date': '2016-11-20T16:05:00'},
+             'Record 6: wrong or duplicate id'),
+            ({'id': 'f', 'parent': 'c', 'author': 'test', 'text': 'Comment f', 'date': '2016-11-20T16:05:00'},
+             'Record 6: the parent comment was deleted after it was imported')
+        ]:
+            with open(next_dump, mode='w', encoding='utf8') as fp:
+                for r in records + [record]:
+                    fp.write(json.dumps(r) + '\n')
+            with self.assertRaisesMessage(CommandError, error):
+                call_command('import_comments', next_dump, '--name=' + dump, stdout=StringIO())
+        self.assertEqual(Comment.objects.count(), 4)
+
+        dump = os.path.join(work_dir, 'dump.csv')
+        with open(dump, mode='w', encoding='utf8') as fp:
+            fp.write('id,parent,obj_type,obj_id,author,text,date\n')
+            fp.write('1,,1,%s,test,"Comment, 1",2016-11-20 16:00\n' % self.ids[1])
+            fp.write('2,1,,,test,Comment 2,2016-11-20 16:05\n')
+        call_command('import_comments', dump, no_history=True, stdout=StringIO())
+        self.assertEqual(CommentHistory.objects.count(), 6)
+        tree = CommentTree('1', self.ids[1]).get_tree()
+        self.assertEqual(tree['comments'][0]['text'], 'Comment, 1')
+        self.assertEqual(tree['comments'][0]['children'][0]['text'], 'Comment 2')
+
+    def test_16_history_content(self):
+        comment = create_comment(self.author, '0', self.ids[0], 'Comment 1')
+        change_comment(self.author, comment.pk, 'New comment 1')
+        comment = create_comment(self.author, 'c', comment.pk, 'Comment 2')
+        delete_comment(self.author, comment.pk)
+        history = DownloadCommentsHistory(self.author, self.author, None, None, 'txt').history
+
+        content = ''.join(IterContent('1', history, 3))
+        self.assertEqual(content, ''.join(IterContent('1', history)))
+        content = json.loads(content)
+        self.assertEqual(list([ch['old_text'], ch['new_text']] for ch in content), [
+            [None, 'Comment 1'], ['Comment 1', 'New comment 1'], [None, 'Comment 2'], ['Comment 2', None]
+        ])
+
+        content = ''.join(IterContent('0', history, 1))
+        self.assertEqual(content, ''.join(IterContent('0', history)))
+        self.assertEqual(content.count('TYPE: <CREATION>'), 2)
+        self.assertEqual(content.count('TYPE: <EDITION>'), 1)
+        self.assertEqual(content.count('TYPE: <DELETION>'), 1)
+
+        content = ''.join(IterContent('2', history, 2))
+        self.assertEqual(content, ''.join(IterContent('2', history)))
+        self.assertTrue(content.startswith('<?xml'))
+        self.assertEqual(content.count('<change>'), 4)
+        self.assertIn('<old>Comment 1</old>', content)
+
+    def test_17_compressed_downloads(self):
+        for i in range(3):
+            create_comment(self.author, '0', self.ids[0], 'Comment %s' % i)
+        res = self.client.post('/download_history/', {'file_type': 'json', 'target_id': self.author.pk})
+        plain_content = b''.join(res.streaming_content)
+        self.assertEqual(len(json.loads(plain_content.decode('utf8'))), 3)
+
+        res = self.client.post('/download_history/', {
+            'file_type': 'json', 'target_id': self.author.pk, 'compress': 'gzip'
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], 'application/gzip')
+        self.assertEqual(res['Content-Disposition'], 'attachment; filename=history-%s.json.gz' % self.author.pk)
+        self.assertFalse(res.has_header('Content-Encoding'))
+        self.assertEqual(gzip.decompress(b''.join(res.streaming_content)), plain_content)
+
+        res = self.client.post('/download_history/', {
+            'file_type': 'json', 'target_id': self.author.pk
+        }, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(res['Content-Encoding'], 'gzip')
+        self.assertEqual(res['Content-Disposition'], 'attachment; filename=history-%s.json' % self.author.pk)
+        self.assertEqual(gzip.decompress(b''.join(res.streaming_content)), plain_content)
+
+        res = self.client.post('/download_history/', {
+            'file_type': 'json', 'target_id': self.author.pk, 'compress': 'zip'
+        })
+        self.assertEqual(json.loads(str(res.content, encoding='utf8'))['error'], 'Unsupported compression')
+        self.assertEqual(DownloadHistory.objects.count(), 3)
+
+    def test_18_resumable_downloads(self):
+        for i in range(5):
+            create_comment(self.author, '0', self.ids[0], 'Comment %s' % i)
+        res = DownloadCommentsHistory(self.author, self.author, None, None, 'json')
+        for ftype in ['0', '1', '2', '3', '4']:
+            full_content = ''.join(IterContent(ftype, res.history))
+            content = ''.join(IterContent(ftype, res.history, download=res.download, checkpoint_rows=2))
+            self.assertEqual(content.count(get_continue_token(res.download.pk, *CommentHistory.objects.order_by(
+                'date', 'id').values_list('date', 'id')[1])), 1)
+            if ftype == '1':
+                content = json.loads(content)
+                self.assertEqual(len(content), 7)
+                self.assertEqual(list(x for x in content if 'checkpoint' not in x), json.loads(full_content))
+
+        res = self.client.post('/download_history/', {
+            'file_type': 'json', 'target_id': self.author.pk, 'resumable': '1'
+        })
+        content = b''.join(res.streaming_content).decode('utf8')
+        self.assertEqual(len(json.loads(content)), 5)
+
+        # Cut the content after the second change as if the connection was dropped
+        history = CommentHistory.objects.order_by('date', 'id').values_list('date', 'id')
+        token = get_continue_token(DownloadHistory.objects.order_by('-pk').first().pk, *history[1])
+        content = json.dumps(json.loads(content)[:2], indent=2)[:-2] + ',\n' + json.dumps({'checkpoint': token})
+        res = self.client.post('/download_history/', {'continue': token})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Disposition'], 'attachment; filename=history-%s.json' % self.author.pk)
+        content = json.loads(content + b''.join(res.streaming_content).decode('utf8'))
+        self.assertEqual(list(x['new_text'] for x in content if 'checkpoint' not in x), list(
+            'Comment %s' % i for i in range(5)
+        ))
+        self.assertEqual(DownloadHistory.objects.count(), 2)
+
+        res = self.client.post('/download_history/', {'continue': token + 'x'})
+        self.assertEqual(json.loads(str(res.content, encoding='utf8'))['error'], 'Wrong continuation token')
+
+    def test_19_stream_formats(self):
+        comment = create_comment(self.author, '0', self.ids[0], 'Comment "1",\nsecond line')
+        change_comment(self.author, comment.pk, 'New comment 1')
+        delete_comment(self.author, comment.pk)
+        res = DownloadCommentsHistory(self.author, self.author, None, None, 'ndjson')
+        self.assertEqual(res.download.get_file_type_display(), 'ndjson')
+
+        content = ''.join(IterContent('3', res.history, 1))
+        self.assertEqual(content, ''.join(IterContent('3', res.history)))
+        self.assertEqual(list(json.loads(line) for line in content.splitlines()), list(
+            {'date': x['date'], 'old_text': x['old_text'], 'new_text': x['new_text']}
+            for x in json.loads(''.join(IterContent('1', res.history)))
+        ))
+
+        content = ''.join(IterContent('4', res.history, 2))
+        self.assertEqual(content, ''.join(IterContent('4', res.history)))
+        rows = list(csv.reader(StringIO(content)))
+        self.assertEqual(rows[0], ['date', 'type', 'old_text', 'new_text'])
+        self.assertEqual(list(row[1:] for row in rows[1:]), [
+            ['CREATION', '', 'Comment "1",\nsecond line'],
+            ['EDITION', 'Comment "1",\nsecond line', 'New comment 1'],
+            ['DELETION', 'New comment 1', '']
+        ])
+
+        content = ''.join(IterContent('4', res.history, download=res.download, checkpoint_rows=2))
+        rows = list(csv.reader(StringIO(content)))
+        self.assertEqual(rows[3][:3], ['', 'CHECKPOINT', ''])
+        self.assertEqual(len(rows), 5)
+
+        for file_type, content_type in [('ndjson', 'application/x-ndjson'), ('csv', 'text/csv')]:
+            res = self.client.post('/download_history/', {'file_type': file_type, 'target_id': self.author.pk})
+            self.assertEqual(res['Content-Type'], content_type)
+            self.assertEqual(
+                res['Content-Disposition'], 'attachment; filename=history-%s.%s' % (self.author.pk, file_type)
+            )
+
+        out = StringIO()
+        call_command('bench_history_formats', rows=10, repeat=1, stdout=out)
+        self.assertEqual(list(line.split()[0] for line in out.getvalue().splitlines()), list(
+            x[1] for x in COMMENT_HISTORY_TYPE
+        ))
+
+    def test_20_export_cache(self):
+        for i in range(3):
+            create_comment(self.author, '0', self.ids[0], 'Comment %s' % i)
+        res = self.client.post('/download_history/', {'file_type': 'xml', 'target_id': self.author.pk})
+        self.assertNotIsInstance(res, FileResponse)
+        content = b''.join(res.streaming_content)
+        self.assertEqual(len(os.listdir(self.export_cache)), 1)
+
+        res = self.client.post('/download_history/', {'file_type': 'xml', 'target_id': self.author.pk})
+        self.assertIsInstance(res, FileResponse)
+        self.assertEqual(res['Content-Type'], 'application/xml')
+        self.assertEqual(b''.join(res.streaming_content), content)
+        res.close()
+        res = self.client.post('/download_history/', {
+            'file_type': 'xml', 'target_id': self.author.pk, 'compress': 'gzip'
+        })
+        self.assertEqual(gzip.decompress(b''.join(res.streaming_content)), content)
+        self.assertEqual(DownloadHistory.objects.count(), 3)
+
+        # A new change makes another export, the old one is removed first when the cache is full
+        create_comment(self.author, '0', self.ids[0], 'Comment 3')
+        res = self.client.post('/download_history/', {'file_type': 'xml', 'target_id': self.author.pk})
+        self.assertNotIsInstance(res, FileResponse)
+        self.assertEqual(b''.join(res.streaming_content).count(b'<change>'), 4)
+        self.assertEqual(len(os.listdir(self.export_cache)), 2)
+        new_export = DownloadCommentsHistory(self.author, self.author, None, None, 'xml').get_export_key()
+        evict_exports(max_size=len(content) * 3 // 2)
+        self.assertEqual(os.listdir(self.export_cache), [new_export])
+
+        # Interrupted downloads are not cached
+        res = self.client.post('/download_history/', {'file_type': 'txt', 'target_id': self.author.pk})
+        next(res.streaming_content)
+        res.close()
+        self.assertEqual(os.listdir(self.export_cache), [new_export])
+
+        # So does a change with an earlier date, e.g. an imported one
+        CommentHistory.objects.create(author=self.author, new_text='Imported', date=now() - timedelta(days=1))
+        self.assertNotEqual(DownloadCommentsHistory(self.author, self.author, None, None, 'xml').get_export_key(),
+                            new_export)
+
+    def test_21_benchmarks(self):
+        create_comment(self.author, '0', self.ids[0], 'Comment 1')
+        output = os.path.join(self.export_cache, 'results.json')
+        call_command(
+            'benchmark', seed=1, wide=5, replies=1, deep=4, roots=3, root_comments=2, history=10, downloads=6,
+            repeat=2, output=output
+        )
+        with open(output, encoding='utf8') as fp:
+            report = json.load(fp)
+        self.assertEqual(report['seed'], 1)
+        self.assertEqual(set(report['results']), set(b.__name__ for b in BENCHMARKS))
+        self.assertEqual(report['results']['tree_deep_stream']['rows'], 4)
+        self.assertEqual(report['results']['tree_many_roots']['rows'], 3)
+        self.assertEqual(report['results']['export_csv']['rows'], 10)
+        self.assertEqual(report['results']['user_downloads']['rows'], 6)
+        self.assertEqual(len(report['results']['tree_wide']['runs']), 2)
+        # The workload is removed
+        self.assertEqual(Comment.objects.count(), 1)
+        self.assertEqual(CommentHistory.objects.count(), 1)
+
+    def test_22_timing(self):
+        histograms.clear()
+        for i in range(3):
+            create_comment(self.author, '0', self.ids[0], 'Comment %s' % i)
+        with self.settings(MIDDLEWARE_CLASSES=['main.middleware.TimingMiddleware'] + settings.MIDDLEWARE_CLASSES):
+            # The middleware of a client is loaded by its first request
+            self.client = Client()
+            self.client.force_login(self.author)
+            res = self.client.post('/get_tree/', {'obj_type': '0', 'obj_id': self.ids[0]})
+            metrics = dict(x.strip().split(';', 1) for x in res['Server-Timing'].split(','))
+            self.assertEqual(set(metrics), {'db', 'build', 'encode', 'total'})
+            self.assertRegex(metrics['db'], r'^dur=[0-9.]+;desc="[0-9]+ queries"$')
+            res = self.client.post('/download_history/', {'file_type': 'json', 'target_id': self.author.pk})
+            self.assertIn('total;dur=', res['Server-Timing'])
+            self.assertEqual(len(json.loads(b''.join(res.streaming_content).decode('utf8'))), 3)
+            self.assertFalse(connection.force_debug_cursor)
+
+            # Only for staff
+            res = self.client.get('/metrics/')
+            self.assertEqual(res.status_code, 302)
+            self.author.is_staff = True
+            self.author.save()
+            res = self.client.get('/metrics/')
+        endpoints = json.loads(str(res.content, encoding='utf8'))['endpoints']
+        self.assertEqual(endpoints['main.views.get_tree']['total']['count'], 1)
+        self.assertEqual(endpoints['main.views.get_tree']['build']['count'], 1)
+        self.assertEqual(sum(x[1] for x in endpoints['main.views.get_tree']['queries']['buckets']), 1)
+        self.assertEqual(endpoints['main.views.get_tree']['queries']['buckets'][-1][0], '+Inf')
+        self.assertEqual(endpoints['main.views.download_history']['stream']['count'], 1)
+        self.assertGreater(endpoints['main.views.download_history']['queries']['sum'], 0)
+
+    def test_23_user_downloads_pages(self):
+        target = User.objects.create(username='target')
+        DownloadHistory.objects.bulk_create(list(DownloadHistory(
+            user=self.author, target=target, min_date=now(), max_date=now(), file_type=str(i % 2)
+        ) for i in range(250)))
+        downloads = []
+        data = {'user_id': self.author.pk}
+        while True:
+            res = json.loads(str(self.client.post('/user_downloads/', data).content, encoding='utf8'))
+            self.assertLessEqual(len(json.loads(res['data'])), DOWNLOADS_ON_PAGE)
+            downloads.extend(json.loads(res['data']))
+            if res['cursor'] is None:
+                break
+            data['cursor'] = res['cursor']
+        self.assertEqual(len(downloads), 250)
+        self.assertEqual(downloads[0]['target'], [target.pk, 'target'])
+
+        res = self.client.post('/user_downloads/', {'user_id': self.author.pk, 'file_type': 'json'})
+        res = json.loads(str(res.content, encoding='utf8'))
+        self.assertEqual(len(json.loads(res['data'])), 100)
+        self.assertEqual(set(x['file_type'] for x in json.loads(res['data'])), {'json'})
+        res = self.client.post('/user_downloads/', {
+            'user_id': self.author.pk, 'file_type': 'json', 'cursor': res['cursor']
+        })
+        res = json.loads(str(res.content, encoding='utf8'))
+        self.assertEqual(len(json.loads(res['data'])), 25)
+        self.assertIsNone(res['cursor'])
+
+        res = self.client.post('/user_downloads/', {
+            'user_id': self.author.pk, 'date_to': json.dumps([2016, 1, 1])
+        })
+        self.assertEqual(json.loads(json.loads(str(res.content, encoding='utf8'))['data']), [])
+        res = self.client.post('/user_downloads/', {'user_id': self.author.pk, 'cursor': 'x'})
+        self.assertEqual(json.loads(str(res.content, encoding='utf8'))['error'], 'Wrong cursor')
+
+    def test_24_limited_trees(self):
+        a = create_comment(self.author, '0', self.ids[0], 'A')
+        a1 = create_comment(self.author, 'c', a.pk, 'A1')
+        a1a = create_comment(self.author, 'c', a1.pk, 'A1a')
+        create_comment(self.author, 'c', a1a.pk, 'A1a1')
+        create_comment(self.author, 'c', a.pk, 'A2')
+        create_comment(self.author, 'c', a.pk, 'A3')
+        for text in ['B', 'C']:
+            create_comment(self.author, '0', self.ids[0], text)
+
+        def texts(comments):
+            return list([c['text'], texts(c['children'])] + (['cursor'] if 'cursor' in c else []) for c in comments)
+
+        tree = CommentTree('0', self.ids[0]).get_tree()
+        self.assertNotIn('cursor', tree)
+        self.assertEqual(texts(tree['comments']), [
+            ['A', [['A1', [['A1a', [['A1a1', []]]]]], ['A2', []], ['A3', []]]], ['B', []], ['C', []]
+        ])
+        tree = CommentTree('0', self.ids[0]).get_tree(max_depth=2, max_children=2)
+        self.assertEqual(encode_tree(tree), json.dumps(tree))
+        self.assertEqual(tree['comment_count'], 8)
+        self.assertEqual(texts(tree['comments']), [
+            ['A', [['A1', [], 'cursor'], ['A2', []]], 'cursor'], ['B', []]
+        ])
+        self.assertEqual(tree['comments'][0]['child_count'], 3)
+
+        self.assertEqual(texts(expand_tree(tree['cursor'])['comments']), [['C', []]])
+        self.assertEqual(texts(expand_tree(tree['comments'][0]['cursor'])['comments']), [['A3', []]])
+        res = expand_tree(tree['comments'][0]['children'][0]['cursor'], max_depth=1)
+        self.assertEqual(texts(res['comments']), [['A1a', [], 'cursor']])
+        self.assertIsNone(res['cursor'])
+        self.assertEqual(texts([CommentTree('c', a.pk).get_tree(max_depth=1)]), [['A', [], 'cursor']])
+        self.assertEqual(texts([CommentTree('c', a.pk).get_tree(max_children=1)]), [
+            ['A', [['A1', [['A1a', [['A1a1', []]]]]]], 'cursor']
+        ])
+
+        res = self.client.post('/get_tree/', {'obj_type': '0', 'obj_id': self.ids[0], 'max_depth': 1})
+        tree = json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])
+        self.assertEqual(texts(tree['comments']), [['A', [], 'cursor'], ['B', []], ['C', []]])
+        res = self.client.post('/get_tree/', {'cursor': tree['comments'][0]['cursor'], 'max_children': 1})
+        res = json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])
+        self.assertEqual(texts(res['comments']), [['A1', [['A1a', [['A1a1', []]]]]]])
+        res = self.client.post('/get_tree/', {'cursor': res['cursor']})
+        self.assertEqual(texts(json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])['comments']), [
+            ['A2', []], ['A3', []]
+        ])
+        res = self.client.post('/get_tree/', {'obj_type': '0', 'obj_id': self.ids[0], 'max_depth': 0})
+        self.assertEqual(json.loads(str(res.content, encoding='utf8'))['error'], 'Wrong max_depth')
+        res = self.client.post('/get_tree/', {'cursor': 'x'})
+        self.assertEqual(json.loads(str(res.content, encoding='utf8'))['error'], 'Wrong cursor')
+
+    def test_25_tree_changes(self):
+        def changes(since):
+            res = self.client.get('/tree_changes/', {
+                'obj_type': '0', 'obj_id': self.ids[0], 'since': json.dumps(since)
+            })
+            return json.loads(json.loads(str(res.content, encoding='utf8'))['changes'])
+
+        comment = create_comment(self.author, '0', self.ids[0], 'Comment 1')
+        self.assertEqual(CommentTree('0', self.ids[0]).get_tree()['comments'][0]['id'], comment.pk)
+        res = changes([2016, 1, 1])
+        self.assertEqual(list(c['id'] for c in res['comments']), [comment.pk])
+        self.assertEqual(res['deleted'], [])
+        # The change may be committed after transactions with later dates, so it's returned again next time
+        self.assertLess(res['since'], get_date_list(Comment.objects.get(pk=comment.pk).last_change))
+
+        reply = create_comment(self.author, 'c', comment.pk, 'Comment 2')
+        change_comment(self.author, comment.pk, 'New comment 1')
+        deleted = create_comment(self.author, 'c', comment.pk, 'Comment 3')
+        delete_comment(self.author, deleted.pk)
+        res = changes(res['since'])
+        self.assertEqual(list([c['id'], c['parent'], c['text']] for c in res['comments']), [
+            [reply.pk, comment.pk, 'Comment 2'], [comment.pk, None, 'New comment 1']
+        ])
+        self.assertEqual(res['deleted'], [deleted.pk])
+        self.assertEqual(res['comment_count'], 2)
+        self.assertEqual(CommentHistory.objects.filter(root=None).count(), 0)
+
+        self.assertEqual(len(changes(res['since'])['comments']), 2)
+
+        # Changes older than TREE_CHANGES_LAG seconds are returned once
+        past = timedelta(seconds=TREE_CHANGES_LAG + 1)
+        for model, field in [(Comment, 'last_change'), (CommentHistory, 'date')]:
+            for pk, date in model.objects.values_list('pk', field):
+                model.objects.filter(pk=pk).update(**{field: date - past})
+        res = changes([2016, 1, 1])
+        self.assertEqual(res['since'], get_date_list(CommentHistory.objects.get(deleted_comment=deleted.pk).date))
+        since = res['since']
+        res = changes(since)
+        self.assertEqual([res['comments'], res['deleted'], res['since']], [[], [], since])
+        res = self.client.get('/tree_changes/', {'obj_type': '0', 'obj_id': self.ids[0], 'since': 'x'})
+        self.assertEqual(json.loads(str(res.content, encoding='utf8'))['error'], 'Wrong date')
+
+        # Deletions of archived months are not in the database, clients that synced before them reload the tree
+        validator = get_tree_validator('0', self.ids[0])
+        end = get_date_obj(since) + timedelta(microseconds=1)
+        HistoryArchive.objects.create(start=month_start(end), end=end, file_name='archive.json.gz', rows=0)
+        reset_archived_end()
+        res = self.client.get('/tree_changes/', {'obj_type': '0', 'obj_id': self.ids[0], 'since': json.dumps(since)})
+        self.assertEqual(json.loads(str(res.content, encoding='utf8'))['error'], 'Since is too old, reload the tree')
+        self.assertEqual(changes(get_date_list(end))['comments'], [])
+        self.assertEqual(get_tree_validator('0', self.ids[0]), (validator[0], end))
+
+    def test_26_conditional_get(self):
+        comment = create_comment(self.author, '0', self.ids[0], 'Comment 1')
+        reply = create_comment(self.author, 'c', comment.pk, 'Comment 2')
+        data = {'obj_type': '0', 'obj_id': self.ids[0]}
+        res = self.client.get('/get_tree/', data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('no-cache', res['Cache-Control'])
+        etag = res['ETag']
+        self.assertEqual(json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])['comments'][0]['id'],
+                         comment.pk)
+        # The tree isn't built for unchanged roots
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get('/get_tree/', data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertLessEqual(len(queries), 2)
+        # Only the ETag has the microseconds of the last change
+        self.assertFalse(res.has_header('Last-Modified'))
+        # Other limits are another representation of the tree
+        res = self.client.get('/get_tree/', dict(data, max_depth=1), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+
+        change_comment(self.author, reply.pk, 'New comment 2')
+        res = self.client.get('/get_tree/', data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res['ETag'], etag)
+        etag = res['ETag']
+        delete_comment(self.author, reply.pk)
+        res = self.client.get('/get_tree/', data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res['ETag'], etag)
+        res = self.client.get('/get_tree/', {'obj_type': 'c', 'obj_id': comment.pk}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get('/get_tree/', {'obj_type': 'c', 'obj_id': comment.pk}, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client.get('/first_level/', {'type': '0', 'obj': self.ids[0]})
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get('/first_level/', {'type': '0', 'obj': self.ids[0]}, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, 304)
+        # POST responses have no validators
+        res = self.client.post('/get_tree/', data)
+        self.assertFalse(res.has_header('ETag'))
+        self.assertEqual(len(json.loads(json.loads(str(res.content, encoding='utf8'))['comments'])['comments']), 1)
+
+    def test_27_write_queries(self):
+        # Queries of writes in one transaction: SAVEPOINT and RELEASE (the test is in a transaction) and statements
+        comment = create_comment(self.author, '0', self.ids[0], 'Comment 1')
+        with self.assertNumQueries(8):
+            reply = create_comment(self.author, 'c', comment.pk, 'Comment 2')
+        reply = Comment.objects.get(pk=reply.pk)
+        self.assertEqual(reply.date, reply.last_change)
+        self.assertEqual(CommentHistory.objects.get(comment=reply).date, reply.date)
+        with self.assertNumQueries(8):
+            create_comment(self.author, '0', self.ids[0], 'Comment 3')
+
+        with self.assertNumQueries(5):
+            change_comment(self.author, reply.pk, 'New comment 2')
+        # Only the row of the comment is locked, its root is read by subqueries
+        self.assertNotIn('JOIN', str(locked_comment(reply.pk).query))
+        reply = Comment.objects.get(pk=reply.pk)
+        self.assertEqual(reply.text, 'New comment 2')
+        self.assertEqual(CommentHistory.objects.get(comment=reply, old_text='Comment 2').date, reply.last_change)
+        with self.assertNumQueries(3):
+            change_comment(self.author, reply.pk, 'New comment 2')
+
+        # Rolled back to the savepoint, the root is locked before the comment
+        with self.assertNumQueries(5):
+            self.assertRaises(ValueError, delete_comment, self.author, comment.pk)
+        # Model.delete() looks for replies and changes of the comment
+        with self.assertNumQueries(10):
+            delete_comment(self.author, reply.pk)
+        self.assertEqual(Comment.objects.get(pk=comment.pk).child_count, 0)
+        self.assertEqual(CommentRoot.objects.get().comment_count, 2)
+        self.assertEqual(CommentHistory.objects.filter(comment=None, deleted_comment=reply.pk).count(), 1)
+        self.assertEqual(CommentHistory.objects.filter(comment=None).count(), 3)
+        with self.assertNumQueries(4):
+            self.assertRaises(ValueError, create_comment, self.author, 'c', reply.pk, 'Comment 4')
+        self.assertRaises(ValueError, change_comment, self.author, reply.pk, 'Comment 4')
+        self.assertRaises(ValueError, delete_comment, self.author, reply.pk)
+
+    def test_28_history_archive(self):
+        archive_dir = os.path.join(self.export_cache, 'archive')
+        archive_settings = self.settings(HISTORY_ARCHIVE_DIR=archive_dir)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+        other = User.objects.create(username='other')
+        for i in range(4):
+            create_comment(self.author, '0', self.ids[0], 'Comment %s' % i)
+            create_comment(other, '0', self.ids[0], 'Other comment %s' % i)
+        # The first two changes of both users were made in January 2017
+        start = month_start(MOSCOW_TZ.localize(datetime(2017, 1, 1)))
+        for i, ch_id in enumerate(CommentHistory.objects.order_by('id').values_list('id', flat=True)[:4]):
+            CommentHistory.objects.filter(pk=ch_id).update(date=start + timedelta(days=i, hours=1))
+
+        def download(data):
+            data.update({'file_type': 'json', 'target_id': self.author.pk})
+            res = self.client.post('/download_history/', data)
+            return json.loads(b''.join(res.streaming_content).decode('utf8'))
+
+        full = download({})
+        self.assertEqual(len(full), 4)
+        archived = CommentHistory.objects.filter(date__gte=start, date__lt=next_month(start))
+        rows = list(archived.order_by('author_id', 'date', 'id').values_list(*ARCHIVE_COLUMNS))
+        # Rows of a pending archive are read from the detached partition until the file is written
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE {0} AS SELECT * FROM main_commenthistory WHERE date >= %s AND date < %s'
+                           .format(partition_name(start)), [start, next_month(start)])
+        HistoryArchive.objects.create(start=start, end=next_month(start), file_name='', rows=0, pending=True)
+        archived.delete()
+        self.assertEqual(download({}), full)
+        self.assertEqual(download({'date_from': json.dumps([2017, 1, 2])}), full[1:])
+        archive = write_history_archive(rows, start, next_month(start))
+        self.assertEqual(archive.rows, 4)
+        self.assertFalse(HistoryArchive.objects.get().pending)
+        self.assertTrue(os.path.exists(os.path.join(archive_dir, archive.file_name)))
+        self.assertEqual(CommentHistory.objects.filter(author=self.author).count(), 2)
+        self.assertEqual(download({}), full)
+        self.assertEqual(download({'date_from': json.dumps([2017, 1, 2])}), full[1:])
+        self.assertEqual(download({'date_from': json.dumps([2017, 2, 1])}), full[2:])
+        self.assertEqual(download({'date_to': json.dumps([2017, 1, 31])}), full[:2])
+
+        # Resumed after an archived change
+        res = DownloadCommentsHistory(self.author, self.author, None, None, 'txt')
+        history = list(res.get_archived_rows())
+        self.assertEqual(list(x[3] for x in history), ['Comment 0', 'Comment 1'])
+        res = resume_comments_history(self.author, get_continue_token(res.download.pk, history[0][1], history[0][0]))
+        content = ''.join(res.get_content(download=res.download, resumed=True))
+        self.assertEqual(list(x for x in ['Comment 0', 'Comment 1', 'Comment 2', 'Comment 3'] if x in content),
+                         ['Comment 1', 'Comment 2', 'Comment 3'])
+
+    def test_29_history_partitions(self):
+        if not is_history_partitioned():
+            self.skipTest('History is partitioned only on PostgreSQL')
+        archive_settings = self.settings(HISTORY_ARCHIVE_DIR=os.path.join(self.export_cache, 'archive'))
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+        call_command('create_history_partitions', months=1, stdout=StringIO())
+        current = month_start(now())
+        self.assertIn(current, history_partitions())
+        self.assertIn(next_month(current), history_partitions())
+        # A change of a month without partition is in the default one until the partition is created
+        later = next_month(next_month(current))
+        CommentHistory.objects.create(author=self.author, new_text='Later', date=later + timedelta(hours=1))
+        call_command('create_history_partitions', months=2, stdout=StringIO())
+        self.assertIn(later, history_partitions())
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT new_text FROM {0}'.format(partition_name(later)))
+            self.assertEqual(cursor.fetchall(), [('Later',)])
+        previous = month_start(current - timedelta(days=1))
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE {0} PARTITION OF main_commenthistory FOR VALUES FROM (%s) TO (%s)'.format(
+                partition_name(previous)
+            ), [previous.isoformat(), current.isoformat()])
+        create_comment(self.author, '0', self.ids[0], 'Comment 1')
+        comment = create_comment(self.author, '0', self.ids[0], 'Comment 2')
+        change = CommentHistory.objects.get(comment=comment)
+        # The change is moved to the partition of the previous month
+        CommentHistory.objects.filter(pk=change.pk).update(date=previous + timedelta(hours=1))
+        full = ''.join(DownloadCommentsHistory(self.author, self.author, None, None, 'txt').get_content())
+        # The interrupted archive is read from the detached partition and is finished by the next run
+        self.assertTrue(detach_history_partition(previous).pending)
+        self.assertNotIn(previous, history_partitions())
+        self.assertEqual(''.join(DownloadCommentsHistory(self.author, self.author, None, None, 'txt').get_content()),
+                         full)
+        call_command('archive_history', keep_months=0, stdout=StringIO())
+        self.assertNotIn(previous, history_partitions())
+        self.assertFalse(CommentHistory.objects.filter(pk=change.pk).exists())
+        self.assertEqual(HistoryArchive.objects.get(start=previous).rows, 1)
+        self.assertEqual(''.join(DownloadCommentsHistory(self.author, self.author, None, None, 'txt').get_content()),
+                         full)
+
+    def test_30_history_deltas(self):
+        other = User.objects.create(username='other')
+        base = ' '.join('word%s' % i for i in range(200))
+        texts = list('%s edit %s' % (base, i) for i in range(13))
+        comment = create_comment(self.author, '0', self.ids[0], texts[0])
+        for i in range(1, 13):
+            # Previous versions of edits are read regardless of their authors
+            change_comment(other if i == 3 else self.author, comment.pk, texts[i])
+        self.assertEqual(Comment.objects.get(pk=comment.pk).edits, 12)
+        edits = CommentHistory.objects.filter(comment=comment).exclude(old_text=None, delta=None).order_by('date', 'id')
+        # The first edit and each 10th after it are stored in full
+        self.assertEqual(list(x.delta is None for x in edits), list(i in [1, 11] for i in range(1, 13)))
+        self.assertEqual(list(x.old_text for x in edits if x.delta is not None), [None] * 10)
+        self.assertLess(sum(len(x.delta or x.old_text + x.new_text) for x in edits), len(base) * 5)
+
+        def download():
+            res = self.client.post('/download_history/', {'file_type': 'json', 'target_id': self.author.pk})
+            return json.loads(b''.join(res.streaming_content).decode('utf8'))
+
+        expected = [[None, texts[0]]] + list([texts[i - 1], texts[i]] for i in range(1, 13) if i != 3)
+        self.assertEqual(list([x['old_text'], x['new_text']] for x in download()), expected)
+        self.assertEqual(apply_delta(texts[0], make_delta(texts[0], texts[1])), texts[1])
+        self.assertIsNone(make_delta('a', 'b'))
+        first = MOSCOW_TZ.localize(datetime(2017, 1, 31, 23))
+        self.assertTrue(is_snapshot(2, first, first + timedelta(hours=1)))
+        self.assertFalse(is_snapshot(2, first, first + timedelta(minutes=1)))
+
+        # Full texts are restored in the database and the comment counters are recomputed
+        self.assertEqual(expand_deltas(CommentHistory.objects.all()), 10)
+        Comment.objects.filter(pk=comment.pk).update(edits=0)
+        out = StringIO()
+        call_command('compact_history', batch_size=1, stdout=out)
+        self.assertIn('10 of 12 edits are converted', out.getvalue())
+        self.assertIn('saved', out.getvalue())
+        self.assertEqual(CommentHistory.objects.exclude(delta=None).count(), 10)
+        self.assertEqual(Comment.objects.get(pk=comment.pk).edits, 12)
+        self.assertEqual(list([x['old_text'], x['new_text']] for x in download()), expected)
+
+        # Changes of deleted comments can't be found by the comment, so they get full texts
+        # One more query for versions of the comment, there are no ancestors
+        with self.assertNumQueries(10):
+            delete_comment(self.author, comment.pk)
+        self.assertEqual(CommentHistory.objects.exclude(delta=None).count(), 0)
+        self.assertEqual(list([x['old_text'], x['new_text']] for x in download()), expected + [[texts[12], None]])
+
+    def test_31_subtree_seek(self):
+        # Ids of A and B are consecutive, so the path of B is the one seeked after the subtree of A
+        a = create_comment(self.author, '0', self.ids[0], 'A')
+        create_comment(self.author, '0', self.ids[0], 'B')
+        a1 = create_comment(self.author, 'c', a.pk, 'A1')
+        create_comment(self.author, 'c', a1.pk, 'A1a')
+        create_comment(self.author, 'c', a.pk, 'A2')
+        # The database orders paths like Python with any collation, e.g. the default ones of PostgreSQL
+        paths = list(Comment.objects.order_by('path').values_list('path', flat=True))
+        self.assertEqual(paths, sorted(paths))
+        for path in paths:
+            next_path = get_next_path(path)
+            self.assertEqual(list(Comment.objects.filter(path__gte=next_path).values_list('path', flat=True)
+                                  .order_by('path')), list(p for p in paths if p >= next_path))
+
+        # Every comment is returned once when replies are expanded one by one
+        texts = []
+
+        def collect(comments, cursor):
+            for c in comments:
+                texts.append(c['text'])
+                collect(c['children'], c.get('cursor'))
+            if cursor is not None:
+                res = expand_tree(cursor, max_children=1)
+                collect(res['comments'], res['cursor'])
+
+        tree = CommentTree('0', self.ids[0]).get_tree(max_children=1)
+        collect(tree['comments'], tree.get('cursor'))
+        self.assertEqual(texts, ['A', 'A1', 'A1a', 'A2', 'B'])
+
+
+class TestPerformance(TestCase):
+    # Upper bounds of SQL queries of the views on realistic data. Plans of the queries are checked on PostgreSQL,
+    # a sequential scan of a big table means a missing index. SQLite plans are not checked.
+    PLAN_TABLES = ['main_comment', 'main_commenthistory', 'comment_root']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='test', password='1234')
+        cls.auditor = User.objects.create_user(username='auditor', password='1234')
+        cls.post_id = BlogPost.objects.create(name='Blog post').pk
+        cls.page_id = UserPage.objects.create(name='User page').pk
+
+        # A wide thread with replies and a deep chain
+        entries = []
+        for i in range(40):
+            entries.append({'obj_type': '0', 'obj_id': cls.post_id, 'text': 'Comment %s' % i})
+            entries.append({'parent': len(entries) - 1, 'text': 'Reply 1 to %s' % i})
+            entries.append({'parent': len(entries) - 2, 'text': 'Reply 2 to %s' % i})
+        entries.append({'obj_type': '1', 'obj_id': cls.page_id, 'text': 'Level 0'})
+        for i in range(1, 30):
+            entries.append({'parent': len(entries) - 1, 'text': 'Level %s' % i})
+        cls.comment_ids = create_comments(cls.author, entries)[0]
+        for comment_id in cls.comment_ids[:10]:
+            change_comment(cls.author, comment_id, 'Changed')
+        for i in range(30):
+            DownloadCommentsHistory(cls.auditor, cls.author, None, None, COMMENT_HISTORY_TYPE[i % 3][1])
+
+    def setUp(self):
+        super(TestPerformance, self).setUp()
+        cache.clear()
+        # The end of history archives is cached until the next archive, as it is in a running server
+        get_archived_end()
+        self.export_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.export_cache, True)
+        export_settings = self.settings(EXPORT_CACHE_DIR=self.export_cache)
+        export_settings.enable()
+        self.addCleanup(export_settings.disable)
+        self.client = Client()
+        self.client.post('/login/', {'username': 'test', 'password': '1234'})
+
+    def __check_queries(self, max_queries, path, data, method='post'):
+        with CaptureQueriesContext(connection) as queries:
+            res = getattr(self.client, method)(path, data)
+            if res.streaming:
+                content = b''.join(res.streaming_content)
+                res.close()
+            else:
+                content = res.content
+        self.assertLessEqual(len(queries), max_queries, '\n'.join(q['sql'] for q in queries.captured_queries))
+        if connection.vendor == 'postgresql':
+            self.__check_plans(list(q['sql'] for q in queries.captured_queries))
+        return content
+
+    def __check_plans(self, queries):
+        with connection.cursor() as cursor:
+            # Tables of the test are small, so only scans without usable index are sequential after this
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            for sql in queries:
+                if sql.split(' ', 1)[0] not in ['SELECT', 'UPDATE', 'DELETE']:
+                    continue
+                cursor.execute('EXPLAIN ' + sql)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                for table in self.PLAN_TABLES:
+                    self.assertNotIn('Seq Scan on %s ' % table, plan + ' ', '%s\n%s' % (sql, plan))
+
+    def test_creation(self):
+        self.__check_queries(10, '/create_comment/', {'obj_type': '0', 'obj_id': self.post_id, 'text': 'New'})
+        self.__check_queries(10, '/create_comment/', {'obj_type': 'c', 'obj_id': self.comment_ids[-1], 'text': 'New'})
+        content = self.__check_queries(12, '/create_comments/', {'comments': json.dumps(list(
+            {'obj_type': 'c', 'obj_id': self.comment_ids[0], 'text': 'New %s' % i} for i in range(20)
+        ))})
+        self.assertEqual(len(json.loads(content.decode('utf8'))['ids']), 20)
+
+    def test_changes(self):
+        self.__check_queries(7, '/change_comment/', {'comment_id': self.comment_ids[-1], 'text': 'New text'})
+        self.__check_queries(12, '/delete_comment/', {'comment_id': self.comment_ids[-1]})
+        self.assertFalse(Comment.objects.filter(pk=self.comment_ids[-1]).exists())
+
+    def test_first_level(self):
+        data = {'type': '0', 'obj': self.post_id}
+        # Two of the queries are for the validators of the conditional GET
+        self.__check_queries(6, '/first_level/2/', data, method='get')
+        content = self.__check_queries(5, '/first_level/', data, method='get')
+        data['cursor'] = json.loads(content.decode('utf8'))['cursor']
+        self.__check_queries(5, '/first_level/', data, method='get')
+
+    def test_tree(self):
+        for obj_type, obj_id in [('0', self.post_id), ('1', self.page_id)]:
+            data = {'obj_type': obj_type, 'obj_id': obj_id}
+            self.__check_queries(4, '/get_tree/', data)
+            # Cached tree
+            self.__check_queries(0, '/get_tree/', data)
+            self.__check_queries(2, '/get_tree/', data, method='get')
+            data['stream'] = '1'
+            self.__check_queries(4, '/get_tree/', data)
+        # First paint of the wide thread, truncated comments are skipped by one more query
+        content = self.__check_queries(5, '/get_tree/', {
+            'obj_type': '0', 'obj_id': self.post_id, 'max_depth': 2, 'max_children': 1
+        })
+        tree = json.loads(json.loads(content.decode('utf8'))['comments'])
+        self.assertEqual(len(tree['comments']), 1)
+        self.__check_queries(3, '/get_tree/', {'cursor': tree['cursor'], 'max_depth': 1, 'max_children': 10})
+
+    def test_tree_changes(self):
+        content = self.__check_queries(3, '/tree_changes/', {
+            'obj_type': '0', 'obj_id': self.post_id, 'since': json.dumps([2016, 1, 1])
+        }, method='get')
+        self.assertEqual(len(json.loads(json.loads(content.decode('utf8'))['changes'])['comments']), 120)
+
+    def test_downloads(self):
+        for file_type, name in COMMENT_HISTORY_TYPE:
+            data = {'file_type': name, 'target_id': self.author.pk}
+            # One of the queries is for archives of history
+            self.__check_queries(7, '/download_history/', data)
+            # Cached export
+            self.__check_queries(6, '/download_history/', data)
+        self.__check_queries(6, '/download_history/', {
+            'file_type': 'txt', 'target_id': self.author.pk, 'resumable': '1'
+        })
+        history = CommentHistory.objects.filter(author=self.author).order_by('date', 'id').values_list('date', 'id')
+        token = get_continue_token(DownloadHistory.objects.order_by('-pk').first().pk, *history[50])
+        self.__check_queries(5, '/download_history/', {'continue': token})
+
+    def test_user_downloads(self):
+        content = self.__check_queries(4, '/user_downloads/', {'user_id': self.auditor.pk})
+        self.assertEqual(len(json.loads(json.loads(content.decode('utf8'))['data'])), 30)
+
 
 class MyToy:
     def __init__(self):
@@ -322,3 +1391,179 @@ class MyToy:
         if res['Content-Type'] != 'application/json':
             raise ValueError('Content is not json')
         return json.loads(str(res.content, encoding='utf8'))
+
+
+class TestHistoryQueue(TransactionTestCase):
+    # Records are queued when transactions are committed, so tests of write-behind are not in a transaction
+    def setUp(self):
+        super(TestHistoryQueue, self).setUp()
+        cache.clear()
+        self.export_cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.export_cache, True)
+        write_settings = self.settings(EXPORT_CACHE_DIR=self.export_cache, HISTORY_WRITE_BEHIND=True)
+        write_settings.enable()
+        self.addCleanup(write_settings.disable)
+        # Only explicit flushes write the records in these tests
+        for name, value in [('flush_size', 1000), ('interval', 3600)]:
+            self.addCleanup(setattr, history_queue, name, getattr(history_queue, name))
+            setattr(history_queue, name, value)
+        self.addCleanup(history_queue.flush)
+        self.author = User.objects.create(username='test')
+        self.author.set_password('1234')
+        self.author.save()
+        self.post_id = BlogPost.objects.create(name='Blog post').pk
+        self.client = Client()
+        self.client.post('/login/', {'username': 'test', 'password': '1234'})
+
+    def __download(self):
+        res = self.client.post('/download_history/', {'file_type': 'json', 'target_id': self.author.pk})
+        return json.loads(b''.join(res.streaming_content).decode('utf8'))
+
+    def test_flush(self):
+        comment = create_comment(self.author, '0', self.post_id, 'Comment 1')
+        change_comment(self.author, comment.pk, 'New comment 1')
+        reply = create_comment(self.author, 'c', comment.pk, 'Comment 2')
+        delete_comment(self.author, reply.pk)
+        create_comments(self.author, list({'obj_type': '0', 'obj_id': self.post_id, 'text': 'Comment %s' % i}
+                                          for i in range(3, 6)))
+        # Only the deletion is written at once
+        self.assertEqual(CommentHistory.objects.count(), 1)
+        self.assertEqual(get_tree_changes('0', self.post_id, comment.date)['deleted'], [reply.pk])
+        self.assertEqual(history_queue.flush(), 6)
+        content = self.__download()
+        self.assertEqual(list([c['old_text'], c['new_text']] for c in content), [
+            [None, 'Comment 1'], ['Comment 1', 'New comment 1'], [None, 'Comment 2'], ['Comment 2', None],
+            [None, 'Comment 3'], [None, 'Comment 4'], [None, 'Comment 5']
+        ])
+        self.assertEqual(history_queue.flush(), 0)
+
+        # Records of rolled back transactions are not queued
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                change_comment(self.author, comment.pk, 'Rolled back')
+                raise ValueError
+        self.assertEqual(history_queue.flush(), 0)
+
+    def test_deleted_comment(self):
+        comment = create_comment(self.author, '0', self.post_id, 'Comment 1 ' * 10)
+        for i in range(2, 4):
+            change_comment(self.author, comment.pk, 'Comment %s ' % i * 10)
+        # Queued edits may be lost, so they are not stored as deltas of each other
+        self.assertEqual(history_queue.flush(), 3)
+        self.assertEqual(CommentHistory.objects.filter(delta__isnull=False).count(), 0)
+        change_comment(self.author, comment.pk, 'Comment 4 ' * 10)
+        delete_comment(self.author, comment.pk)
+        # Queued changes of the deleted comment are written without it
+        history_queue.flush()
+        self.assertEqual(CommentHistory.objects.filter(comment_id=comment.pk).count(), 0)
+        self.assertEqual(list([c['old_text'], c['new_text']] for c in self.__download()), [
+            [None, 'Comment 1 ' * 10], ['Comment 1 ' * 10, 'Comment 2 ' * 10], ['Comment 2 ' * 10, 'Comment 3 ' * 10],
+            ['Comment 3 ' * 10, 'Comment 4 ' * 10], ['Comment 4 ' * 10, None]
+        ])
+
+    def test_failed_flush(self):
+        self.addCleanup(setattr, history_queue, 'max_size', history_queue.max_size)
+        history_queue.max_size = 2
+        with mock.patch.object(CommentHistory.objects, 'bulk_create', side_effect=OperationalError('Connection lost')):
+            create_comment(self.author, '0', self.post_id, 'Comment 1')
+            create_comment(self.author, '0', self.post_id, 'Comment 2')
+            with self.assertRaises(OperationalError):
+                history_queue.flush()
+            # Records of the failed flush fill the queue, so the next writer waits until they are written
+            writer = threading.Thread(target=history_queue.put, args=([
+                CommentHistory(root_id=CommentRoot.objects.get().pk, author=self.author, new_text='Comment 3',
+                               date=now())
+            ],))
+            writer.start()
+            writer.join(0.5)
+            self.assertTrue(writer.is_alive())
+        self.assertEqual(CommentHistory.objects.count(), 0)
+        self.assertEqual(history_queue.flush(), 2)
+        writer.join()
+        self.assertEqual(history_queue.flush(), 1)
+        self.assertEqual(list(c['new_text'] for c in self.__download()), ['Comment 1', 'Comment 2', 'Comment 3'])
+
+    def test_broken_record(self):
+        create_comment(self.author, '0', self.post_id, 'Comment 1')
+        history_queue.put([CommentHistory(author=self.author, new_text='Broken', date=None)])
+        create_comment(self.author, '0', self.post_id, 'Comment 2')
+        # Other records are written one by one, the broken one is retried by the next flushes and then dropped
+        self.assertEqual(history_queue.flush(), 2)
+        for i in range(history_queue.tries - 2):
+            self.assertEqual(history_queue.flush(), 0)
+        with self.assertLogs('main.history', 'ERROR') as logs:
+            self.assertEqual(history_queue.flush(), 0)
+        self.assertIn('Broken', logs.output[0])
+        create_comment(self.author, '0', self.post_id, 'Comment 3')
+        self.assertEqual(history_queue.flush(), 1)
+        self.assertEqual(list(c['new_text'] for c in self.__download()), ['Comment 1', 'Comment 2', 'Comment 3'])
+
+    def test_backpressure(self):
+        self.addCleanup(setattr, history_queue, 'max_size', history_queue.max_size)
+        history_queue.max_size = 2
+        for i in range(5):
+            create_comment(self.author, '0', self.post_id, 'Comment %s' % i)
+        # Writers flush the full queue themselves
+        self.assertEqual(CommentHistory.objects.count(), 4)
+        self.assertEqual(history_queue.flush(), 1)
+        self.assertEqual(len(self.__download()), 5)
+
+    def test_middleware(self):
+        with self.settings(MIDDLEWARE_CLASSES=['main.middleware.HistoryFlushMiddleware'] +
+                           settings.MIDDLEWARE_CLASSES):
+            client = Client()
+            client.force_login(self.author)
+            res = client.post('/create_comment/', {'obj_type': '0', 'obj_id': self.post_id, 'text': 'Comment 1'})
+            self.assertNotIn('error', json.loads(str(res.content, encoding='utf8')))
+            self.assertEqual(CommentHistory.objects.count(), 1)
+            # A failed flush doesn't fail the request, its records are written later
+            with mock.patch.object(CommentHistory.objects, 'bulk_create', side_effect=OperationalError('Lost')):
+                with self.assertLogs('main.middleware', 'ERROR'):
+                    res = client.post('/create_comment/', {
+                        'obj_type': '0', 'obj_id': self.post_id, 'text': 'Comment 2'
+                    })
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn('error', json.loads(str(res.content, encoding='utf8')))
+            self.assertEqual(history_queue.flush(), 1)
+
+
+class TestConcurrentWrites(TransactionTestCase):
+    # Writes of one tree from two connections, they commit, so the test is not in a transaction
+    def setUp(self):
+        super(TestConcurrentWrites, self).setUp()
+        if connection.vendor != 'postgresql':
+            self.skipTest('Row locks are tested only on PostgreSQL')
+        self.author = User.objects.create(username='test')
+        self.post_id = BlogPost.objects.create(name='Blog post').pk
+
+    def __write(self, write, errors):
+        try:
+            for i in range(50):
+                write(i)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def test_lock_order(self):
+        comment = create_comment(self.author, '0', self.post_id, 'Comment 1')
+        parent = create_comment(self.author, 'c', comment.pk, 'Comment 2')
+
+        def reply(i):
+            create_comment(self.author, 'c', parent.pk, 'Reply %s' % i)
+
+        def reply_and_delete(i):
+            delete_comment(self.author, create_comment(self.author, 'c', parent.pk, 'Deleted reply %s' % i).pk)
+
+        # Replies lock the parent and deletions lock the reply, both lock the root first and can't deadlock
+        errors = []
+        writers = list(threading.Thread(target=self.__write, args=(write, errors))
+                       for write in [reply, reply_and_delete])
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Comment.objects.get(pk=parent.pk).child_count, 50)
+        self.assertEqual(CommentRoot.objects.get().comment_count, 52)
+        self.assertEqual(recount_comments(CommentRoot.objects.get()), 0)
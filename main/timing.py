@@ -0,0 +1,120 @@
+import threading
+import time
+from contextlib import contextmanager
+from django.db import connection
+from Comments.vars import TIMING_DURATION_BUCKETS, TIMING_QUERY_BUCKETS
+
+# Timer of the request that is handled by the current thread, see main.middleware.TimingMiddleware
+current = threading.local()
+
+
+class RequestTimer:
+    # Collects query count, database time and durations of timed sections of one request. The timer is active
+    # while the view works and while each chunk of a streamed response is produced.
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.total = 0.0
+        self.durations = {}
+        self.started = None
+        self.force_debug_cursor = False
+
+    def start(self):
+        # Queries with times are logged by the connection only with the debug cursor
+        self.force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        connection.queries_log.clear()
+        self.started = time.perf_counter()
+        current.timer = self
+
+    def stop(self):
+        self.total += time.perf_counter() - self.started
+        self.collect_queries()
+        connection.force_debug_cursor = self.force_debug_cursor
+        current.timer = None
+
+    def collect_queries(self):
+        # The log has limited size, so it is emptied each time
+        for query in connection.queries_log:
+            self.queries += 1
+            self.db_time += float(query['time'])
+        connection.queries_log.clear()
+
+    def add(self, name, duration):
+        self.durations[name] = self.durations.get(name, 0.0) + duration
+
+    def values(self):
+        # Durations in ms
+        values = {'total': self.total * 1000, 'db': self.db_time * 1000, 'queries': self.queries}
+        for name in self.durations:
+            values[name] = self.durations[name] * 1000
+        return values
+
+    def server_timing(self):
+        values = self.values()
+        metrics = ['db;dur=%.1f;desc="%s queries"' % (values.pop('db'), values.pop('queries'))]
+        metrics.extend('%s;dur=%.1f' % (name, values[name]) for name in sorted(values))
+        return ', '.join(metrics)
+
+
+@contextmanager
+def timing(name):
+    # Adds the duration of the block without its queries to the timer of the current request if it is timed
+    timer = getattr(current, 'timer', None)
+    if timer is None:
+        yield
+        return
+    timer.collect_queries()
+    db_time = timer.db_time
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        timer.collect_queries()
+        timer.add(name, max(duration - (timer.db_time - db_time), 0.0))
+
+
+class Histograms:
+    # Per-endpoint histograms of request metrics, they are kept in the memory of the process
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, values):
+        with self.lock:
+            metrics = self.endpoints.setdefault(endpoint, {})
+            for name in values:
+                buckets = TIMING_QUERY_BUCKETS if name == 'queries' else TIMING_DURATION_BUCKETS
+                if name not in metrics:
+                    metrics[name] = {'count': 0, 'sum': 0, 'buckets': [0] * (len(buckets) + 1)}
+                metric = metrics[name]
+                metric['count'] += 1
+                metric['sum'] += values[name]
+                # The last bucket is for values above all bounds
+                position = len(buckets)
+                for i, bound in enumerate(buckets):
+                    if values[name] <= bound:
+                        position = i
+                        break
+                metric['buckets'][position] += 1
+
+    def get_data(self):
+        with self.lock:
+            data = {}
+            for endpoint in self.endpoints:
+                data[endpoint] = {}
+                for name, metric in self.endpoints[endpoint].items():
+                    buckets = TIMING_QUERY_BUCKETS if name == 'queries' else TIMING_DURATION_BUCKETS
+                    data[endpoint][name] = {
+                        'count': metric['count'], 'sum': metric['sum'],
+                        'buckets': list(zip(list(buckets) + ['+Inf'], metric['buckets']))
+                    }
+            return data
+
+    def clear(self):
+        with self.lock:
+            self.endpoints = {}
+
+
+histograms = Histograms()
@@ -1,7 +1,34 @@
+import csv
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import os
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from json.encoder import encode_basestring_ascii
+from django.conf import settings
+from django.core.cache import cache
+from django.core import signing
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction
+from django.db.models import Q, F, Count, Max, Case, When, Value, TextField
+from django.db.models.functions import Length, Substr
+from django.utils.text import compress_sequence
 from django.utils.timezone import now, datetime, pytz
+from Comments.vars import TREE_CACHE_TIMEOUT, NUM_OF_COMMENTS_ON_PAGE, TREE_CHUNK_SIZE, STREAM_BUFFER_SIZE, \
+    MAX_COMMENTS_IN_BATCH, BULK_BATCH_SIZE, HISTORY_CHUNK_SIZE, HISTORY_CHECKPOINT_ROWS, EXPORT_CACHE_SIZE, \
+    DOWNLOADS_ON_PAGE, TREE_CHANGES_LAG
+from main.history import write_history, HISTORY_COLUMNS, is_snapshot, make_delta, chain_texts, texts_update, \
+    full_history_rows
 from main.models import *
+from main.partitions import read_history_archive, get_archived_end
+from main.timing import timing
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
 COMMENT_TABLES = {
     '0': BlogPost,
@@ -9,17 +36,168 @@ COMMENT_TABLES = {
     '2': AnotherObject
 }
 
+# Each comment adds a fixed-width base-36 step with its id to the path of its parent, so ordering by path gives
+# the depth-first display order and all descendants of a comment share its path as a prefix
+PATH_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+PATH_STEP_LENGTH = 6
+
+# PostgreSQL can't index values longer than about 2.7 KB, so paths are indexed by their first 400 levels with the
+# root (see migration 0013_comment_path_key). Queries by path also compare that key, comments of deeper levels are
+# found by the key of their ancestor and sorted by the whole path after the index (incremental sort).
+PATH_KEY_LENGTH = 400 * PATH_STEP_LENGTH
+
 
 def get_date_list(date):
     if date is None:
         return None
-    date = date.astimezone(pytz.timezone('Europe/Moscow'))
+    date = date.astimezone(MOSCOW_TZ)
     return [date.year, date.month, date.day, date.hour, date.minute, date.second, date.microsecond]
 
 
 def get_date_obj(date_list):
-    moscow_tz = pytz.timezone('Europe/Moscow')
-    return moscow_tz.localize(datetime(*date_list))
+    return MOSCOW_TZ.localize(datetime(*date_list))
+
+
+def get_path_step(pk):
+    step = ''
+    while pk > 0:
+        pk, rest = divmod(pk, len(PATH_DIGITS))
+        step = PATH_DIGITS[rest] + step
+    return step.rjust(PATH_STEP_LENGTH, '0')
+
+
+def get_path_ids(path):
+    return list(int(path[i:i + PATH_STEP_LENGTH], len(PATH_DIGITS)) for i in range(0, len(path), PATH_STEP_LENGTH))
+
+
+def get_next_path(path):
+    # The least path after the subtree of the comment with the path: its parent path with the next id. Paths have
+    # only digits and lowercase letters, so unlike a punctuation mark it's ordered the same way by all collations.
+    return path[:-PATH_STEP_LENGTH] + get_path_step(get_path_ids(path[-PATH_STEP_LENGTH:])[0] + 1)
+
+
+def get_path_key_length():
+    # Other databases index the whole path
+    return PATH_KEY_LENGTH if connection.vendor == 'postgresql' else None
+
+
+def with_path_key(comments):
+    # Comments ordered by path with 'path_key' for filter_path()
+    length = get_path_key_length()
+    key = Substr('path', 1, length) if length is not None else F('path')
+    return comments.annotate(path_key=key).order_by('path_key', 'path')
+
+
+def filter_path(comments, **lookups):
+    # Comparisons of paths ('gt', 'gte', 'lt' or 'lte') of comments from with_path_key(), the same comparisons of
+    # the keys let the database find them by the index
+    length = get_path_key_length()
+    keys = {}
+    for lookup, path in lookups.items():
+        op = lookup.split('__')[1]
+        keys['path_key__%s' % {'gt': 'gte', 'lt': 'lte'}.get(op, op)] = path[:length]
+    return comments.filter(**keys).filter(**lookups)
+
+
+def subtree_comments(comment):
+    return filter_path(with_path_key(Comment.objects.filter(root_id=comment.root_id)),
+                       path__gte=comment.path, path__lt=get_next_path(comment.path))
+
+
+def iterate_by_path(comments, chunk_size=TREE_CHUNK_SIZE):
+    # 'comments' are values lists ordered by path with path as the last value. They are read by chunks
+    # seeking from the last seen path, so neither database nor python side keeps more than a chunk in memory.
+    last_path = None
+    while True:
+        if last_path is None:
+            chunk = list(comments[:chunk_size])
+        else:
+            chunk = list(filter_path(comments, path__gt=last_path)[:chunk_size])
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            break
+        last_path = chunk[-1][-1]
+
+
+def iterate_chunks_by_date(history, chunk_size=HISTORY_CHUNK_SIZE):
+    # Like iterate_by_path() for values lists of history ordered by (date, id) that start with id and date,
+    # but yields whole chunks so they can be formatted at once
+    last_row = None
+    while True:
+        if last_row is None:
+            chunk = list(history[:chunk_size])
+        else:
+            chunk = list(history.filter(Q(date__gt=last_row[1]) | Q(date=last_row[1], id__gt=last_row[0]))[:chunk_size])
+        if len(chunk) > 0:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last_row = chunk[-1]
+
+
+def merge_chunks_by_date(chunks, rows, chunk_size=HISTORY_CHUNK_SIZE):
+    # Chunks of iterate_chunks_by_date() merged with other history rows ordered by (date, id), e.g. archived ones
+    merged = heapq.merge(itertools.chain.from_iterable(chunks), rows, key=lambda row: (row[1], row[0]))
+    while True:
+        chunk = list(itertools.islice(merged, chunk_size))
+        if len(chunk) > 0:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+
+
+def json_string(value):
+    # JSON of a text or None, it is what json.dumps() does for them without its overhead
+    return 'null' if value is None else encode_basestring_ascii(value)
+
+
+class BufferedContent:
+    # Base for iterable contents of streaming responses, they are written by small pieces and sent by big chunks
+    def __init__(self):
+        self.buffer = []
+        self.buffer_size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+
+    def is_full(self):
+        return self.buffer_size >= STREAM_BUFFER_SIZE
+
+    def flush(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        return data
+
+
+def gzip_content(content):
+    # Compresses the streamed content as it is produced
+    return compress_sequence(data.encode('utf8') if isinstance(data, str) else data for data in content)
+
+
+def iterate_file(fp, chunk_size=STREAM_BUFFER_SIZE):
+    try:
+        while True:
+            data = fp.read(chunk_size)
+            if len(data) == 0:
+                break
+            yield data
+    finally:
+        fp.close()
+
+
+def locked_comment(comment_id):
+    # The comment with 'root_obj_type' and 'root_obj_id' of its root, its row is locked until the end of the
+    # transaction. Fields of the root are read by subqueries, which unlike a join are not locked by FOR UPDATE:
+    # writes that lock the root do it before the comment, see update_root_counter().
+    subquery = 'SELECT {0} FROM %s WHERE %s.id = %s.root_id' % (
+        CommentRoot._meta.db_table, CommentRoot._meta.db_table, Comment._meta.db_table
+    )
+    return Comment.objects.select_for_update().filter(pk=comment_id).extra(select={
+        'root_obj_type': subquery.format('obj_type'), 'root_obj_id': subquery.format('obj_id')
+    })
 
 
 def create_comment(author, obj_type, obj_id, text):
@@ -27,55 +205,303 @@ def create_comment(author, obj_type, obj_id, text):
         obj_id = int(obj_id)
     except ValueError:
         raise ValueError('Wrong parent object id')
-    if obj_type in list(x[0] for x in OBJECT_TYPES):
-        try:
-            COMMENT_TABLES[obj_type].objects.get(pk=obj_id)
-        except ObjectDoesNotExist:
-            raise ValueError('The parent object was not found')
-        root = CommentRoot.objects.create(obj_type=obj_type, obj_id=obj_id)
-        comment = Comment.objects.create(root=root, author=author, text=text)
-        CommentHistory.objects.create(comment=comment, author=comment.author, new_text=comment.text, date=comment.date)
-    elif obj_type == 'c':
-        try:
-            parent_comment = Comment.objects.get(pk=obj_id)
-        except ObjectDoesNotExist:
-            raise ValueError('The parent comment was not found')
-        comment = Comment.objects.create(root=parent_comment.root, author=author, parent=parent_comment, text=text)
-        CommentHistory.objects.create(comment=comment, author=comment.author, new_text=comment.text, date=comment.date)
-    else:
+    if obj_type not in COMMENT_TABLES and obj_type != 'c':
         raise ValueError('Unsupported comment type')
+    with transaction.atomic():
+        if obj_type == 'c':
+            if update_root_counter(1, pk__in=Comment.objects.filter(pk=obj_id).values('root_id')) == 0:
+                raise ValueError('The parent comment was not found')
+            # The parent is locked, so it can't be deleted before the reply is created
+            parent = locked_comment(obj_id).values_list('root_id', 'path', 'root_obj_type', 'root_obj_id').first()
+            if parent is None:
+                raise ValueError('The parent comment was not found')
+            root_id, parent_path, root_type, root_obj_id = parent
+            parent_id = obj_id
+        else:
+            if not COMMENT_TABLES[obj_type].objects.filter(pk=obj_id).exists():
+                raise ValueError('The parent object was not found')
+            # Concurrent creation of the same root is resolved by the unique constraint
+            root_id = CommentRoot.objects.get_or_create(obj_type=obj_type, obj_id=obj_id)[0].pk
+            update_root_counter(1, pk=root_id)
+            parent_id, parent_path, root_type, root_obj_id = None, '', obj_type, obj_id
+        date = now()
+        comment = Comment.objects.create(
+            root_id=root_id, author=author, parent_id=parent_id, text=text, date=date, last_change=date
+        )
+        comment.path = parent_path + get_path_step(comment.pk)
+        Comment.objects.filter(pk=comment.pk).update(path=comment.path)
+        update_ancestor_counters(comment, 1)
+        write_history([CommentHistory(comment=comment, root_id=root_id, author=author, new_text=text, date=date)])
+    bump_tree_version(root_type, root_obj_id)
+    return comment
 
 
 def change_comment(author, comment_id, text):
     try:
-        comment = Comment.objects.get(pk=int(comment_id))
-    except ObjectDoesNotExist:
-        raise ValueError('The comment was not found')
+        comment_id = int(comment_id)
     except ValueError:
         raise ValueError('Wrong parent object id')
-    if comment.text != text:
-        old_text = comment.text
-        comment.text = text
-        comment.save()
-        # Update 'comment' so it has correct last_change date
-        comment = Comment.objects.get(pk=comment.pk)
-        CommentHistory.objects.create(
-            comment=comment, author=author, old_text=old_text, new_text=comment.text, date=comment.last_change
+    with transaction.atomic():
+        # Concurrent changes of the comment wait for each other, so old texts in the history make a chain
+        comment = locked_comment(comment_id)\
+            .values_list('root_id', 'text', 'root_obj_type', 'root_obj_id', 'edits', 'last_change').first()
+        if comment is None:
+            raise ValueError('The comment was not found')
+        root_id, old_text, root_type, root_obj_id, edits, last_change = comment
+        if old_text == text:
+            return
+        date = now()
+        Comment.objects.filter(pk=comment_id).update(text=text, last_change=date, edits=F('edits') + 1)
+        change = CommentHistory(
+            comment_id=comment_id, root_id=root_id, author=author, old_text=old_text, new_text=text, date=date
         )
+        # The previous version is the last change of the comment, its texts are restored by readers. Queued
+        # records may be lost (see settings.HISTORY_WRITE_BEHIND), so in write-behind mode edits are stored in full
+        # and a delta never follows a lost version.
+        if not settings.HISTORY_WRITE_BEHIND and not is_snapshot(edits + 1, last_change, date):
+            change.delta = make_delta(old_text, text)
+            if change.delta is not None:
+                change.old_text = change.new_text = None
+        write_history([change])
+    bump_tree_version(root_type, root_obj_id)
 
 
 def delete_comment(author, comment_id):
     try:
-        comment = Comment.objects.get(pk=int(comment_id))
-    except ObjectDoesNotExist:
-        raise ValueError('The comment was not found')
+        comment_id = int(comment_id)
     except ValueError:
         raise ValueError('Wrong parent object id')
-    if len(comment.children.all()) > 0:
-        raise ValueError("You can't delete comments with children")
-    old_text = comment.text
-    comment.delete()
-    CommentHistory.objects.create(author=author, old_text=old_text, date=now())
+    with transaction.atomic():
+        if update_root_counter(-1, pk__in=Comment.objects.filter(pk=comment_id).values('root_id')) == 0:
+            raise ValueError('The comment was not found')
+        # Replies to the locked comment can't be created until the transaction ends
+        try:
+            comment = locked_comment(comment_id).only(
+                'root_id', 'parent_id', 'path', 'text', 'child_count', 'edits'
+            ).get()
+        except ObjectDoesNotExist:
+            raise ValueError('The comment was not found')
+        if comment.child_count > 0:
+            raise ValueError("You can't delete comments with children")
+        update_ancestor_counters(comment, -1)
+        # Changes of a deleted comment can't be found by it, so its delta-encoded edits get full texts.
+        # The first edit is always stored in full.
+        changes = {'comment': None}
+        if comment.edits > 1:
+            texts = chain_texts(CommentHistory.objects.filter(comment_id=comment_id).order_by('date', 'id')
+                                .values_list('id', 'comment_id', 'new_text', 'delta'))
+            if len(texts) > 0:
+                changes.update(texts_update(texts))
+        CommentHistory.objects.filter(comment_id=comment_id).update(**changes)
+        # Model.delete() finds no changes of the comment left to detach and no replies
+        comment.delete()
+        # Deletions are read by get_tree_changes() and get_tree_validator(), so they are not queued: a client
+        # whose 'since' passed the date of a queued deletion would never get it
+        write_history([CommentHistory(
+            root_id=comment.root_id, deleted_comment=comment_id, author=author, old_text=comment.text, date=now()
+        )], queued=False)
+    bump_tree_version(comment.root_obj_type, comment.root_obj_id)
+
+
+def update_root_counter(delta, **lookups):
+    # Returns the number of updated roots. Writes that change counters update the root first, so its row is locked
+    # before any comment of the tree and concurrent writes of one tree take their locks in the same order.
+    return CommentRoot.objects.filter(**lookups).update(comment_count=F('comment_count') + delta)
+
+
+def update_ancestor_counters(comment, delta):
+    # Counters of all ancestors of the created (delta=1) or deleted (delta=-1) comment
+    if comment.parent_id is not None:
+        Comment.objects.filter(pk__in=get_path_ids(comment.path)[:-1]).update(
+            child_count=Case(When(pk=comment.parent_id, then=F('child_count') + delta), default=F('child_count')),
+            descendant_count=F('descendant_count') + delta
+        )
+
+
+def recount_comments(root):
+    # Returns the number of comments with fixed counters, the root's counter is fixed silently
+    rows = with_path_key(Comment.objects.filter(root=root)).order_by('-path_key', '-path')\
+        .values_list('id', 'parent_id', 'child_count', 'descendant_count')
+    children = {}
+    descendants = {}
+    fixed = 0
+    # All descendants of a comment are before it in reversed depth-first order
+    for c_id, p_id, child_count, descendant_count in rows.iterator():
+        if children.get(c_id, 0) != child_count or descendants.get(c_id, 0) != descendant_count:
+            Comment.objects.filter(pk=c_id).update(
+                child_count=children.get(c_id, 0), descendant_count=descendants.get(c_id, 0)
+            )
+            fixed += 1
+        if p_id is not None:
+            children[p_id] = children.get(p_id, 0) + 1
+            descendants[p_id] = descendants.get(p_id, 0) + descendants.get(c_id, 0) + 1
+        children.pop(c_id, None)
+        descendants.pop(c_id, None)
+    CommentRoot.objects.filter(pk=root.pk).update(comment_count=rows.count())
+    return fixed
+
+
+def insert_comments(comments, parent_paths):
+    # Django 1.9 bulk_create() doesn't set primary keys, so new comments get temporary unique paths to be found
+    # after the insert. Then real paths are written by one UPDATE for each BULK_BATCH_SIZE comments.
+    # Temporary paths are between '<marker>x' and '<marker>y' and are found by the index like real ones.
+    marker = uuid.uuid4().hex
+    for i in range(len(comments)):
+        comments[i].path = '%sx%s' % (marker, i)
+    Comment.objects.bulk_create(comments, batch_size=BULK_BATCH_SIZE)
+    ids = dict(filter_path(
+        with_path_key(Comment.objects.filter(root_id__in=set(c.root_id for c in comments))),
+        path__gt=marker + 'x', path__lt=marker + 'y'
+    ).values_list('path', 'id'))
+    for i in range(len(comments)):
+        comments[i].pk = ids['%sx%s' % (marker, i)]
+        comments[i].path = parent_paths[i] + get_path_step(comments[i].pk)
+    for start in range(0, len(comments), BULK_BATCH_SIZE):
+        chunk = comments[start:start + BULK_BATCH_SIZE]
+        Comment.objects.filter(pk__in=list(c.pk for c in chunk)).update(
+            path=Case(*list(When(pk=c.pk, then=Value(c.path)) for c in chunk), output_field=TextField())
+        )
+
+
+def increase_counters(comments):
+    # Counters of the roots and of all ancestors of just inserted comments, one UPDATE for each distinct increment
+    child_counts = {}
+    descendant_counts = {}
+    comment_counts = {}
+    for comment in comments:
+        comment_counts[comment.root_id] = comment_counts.get(comment.root_id, 0) + 1
+        ancestors = get_path_ids(comment.path)[:-1]
+        if len(ancestors) > 0:
+            child_counts[ancestors[-1]] = child_counts.get(ancestors[-1], 0) + 1
+        for a_id in ancestors:
+            descendant_counts[a_id] = descendant_counts.get(a_id, 0) + 1
+    increments = {}
+    for root_id in comment_counts:
+        increments.setdefault(comment_counts[root_id], []).append(root_id)
+    # Roots are updated before comments like by update_root_counter()
+    for comments_num, ids in increments.items():
+        update_root_counter(comments_num, pk__in=ids)
+    increments = {}
+    for c_id in set(child_counts) | set(descendant_counts):
+        increments.setdefault((child_counts.get(c_id, 0), descendant_counts.get(c_id, 0)), []).append(c_id)
+    for (children, descendants), ids in increments.items():
+        Comment.objects.filter(pk__in=ids).update(
+            child_count=F('child_count') + children, descendant_count=F('descendant_count') + descendants
+        )
+
+
+def create_comments(author, entries):
+    # Each entry is {'obj_type', 'obj_id', 'text'} like in create_comment() or {'parent', 'text'} where 'parent'
+    # is the index of an earlier entry. Returns ids of new comments in the same order and the list of
+    # [index, error] pairs; nothing is created if there are errors.
+    if not isinstance(entries, list) or len(entries) > MAX_COMMENTS_IN_BATCH:
+        raise ValueError('Wrong list of comments')
+    errors = {}
+    targets = {}
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not isinstance(entry.get('text'), str):
+            errors[i] = 'Wrong list of arguments'
+        elif 'parent' in entry:
+            if not isinstance(entry['parent'], int) or not 0 <= entry['parent'] < i:
+                errors[i] = 'Wrong parent index'
+        elif entry.get('obj_type') in COMMENT_TABLES or entry.get('obj_type') == 'c':
+            try:
+                entry['obj_id'] = int(entry.get('obj_id'))
+            except (TypeError, ValueError):
+                errors[i] = 'Wrong parent object id'
+                continue
+            targets.setdefault(entry['obj_type'], set()).add(entry['obj_id'])
+        else:
+            errors[i] = 'Unsupported comment type'
+
+    # One query for each type of commented objects
+    found = {}
+    for obj_type in targets:
+        if obj_type == 'c':
+            found[obj_type] = dict(
+                (c_id, (root_id, path)) for c_id, root_id, path
+                in Comment.objects.filter(pk__in=targets[obj_type]).values_list('id', 'root_id', 'path')
+            )
+        else:
+            found[obj_type] = set(
+                COMMENT_TABLES[obj_type].objects.filter(pk__in=targets[obj_type]).values_list('pk', flat=True)
+            )
+    levels = []
+    for i, entry in enumerate(entries):
+        if i in errors:
+            pass
+        elif 'parent' in entry:
+            if entry['parent'] in errors:
+                errors[i] = 'The parent comment is wrong'
+        elif entry['obj_id'] not in found[entry['obj_type']]:
+            if entry['obj_type'] == 'c':
+                errors[i] = 'The parent comment was not found'
+            else:
+                errors[i] = 'The parent object was not found'
+        levels.append(levels[entry['parent']] + 1 if i not in errors and 'parent' in entry else 0)
+    if len(errors) > 0:
+        return None, sorted([i, errors[i]] for i in errors)
+
+    date = now()
+    with transaction.atomic():
+        roots = {}
+        for obj_type in targets:
+            if obj_type != 'c':
+                roots.update(
+                    ((obj_type, obj_id), root_id) for root_id, obj_id
+                    in CommentRoot.objects.filter(obj_type=obj_type, obj_id__in=found[obj_type])
+                    .values_list('id', 'obj_id')
+                )
+        for entry in entries:
+            if 'parent' not in entry and entry['obj_type'] != 'c' and (entry['obj_type'], entry['obj_id']) not in roots:
+                roots[(entry['obj_type'], entry['obj_id'])] = CommentRoot.objects.get_or_create(
+                    obj_type=entry['obj_type'], obj_id=entry['obj_id']
+                )[0].pk
+
+        # Comments are inserted by levels, so parents from the same batch already have ids
+        created = [None] * len(entries)
+        for level in range(max(levels) + 1 if len(levels) > 0 else 0):
+            indexes = list(i for i in range(len(entries)) if levels[i] == level)
+            comments = []
+            parent_paths = []
+            for i in indexes:
+                entry = entries[i]
+                if 'parent' in entry:
+                    parent = created[entry['parent']]
+                    root_id, parent_id, parent_path = parent.root_id, parent.pk, parent.path
+                elif entry['obj_type'] == 'c':
+                    root_id, parent_path = found['c'][entry['obj_id']]
+                    parent_id = entry['obj_id']
+                else:
+                    root_id, parent_id, parent_path = roots[(entry['obj_type'], entry['obj_id'])], None, ''
+                comments.append(Comment(
+                    root_id=root_id, author=author, parent_id=parent_id, text=entry['text'], date=date,
+                    last_change=date
+                ))
+                parent_paths.append(parent_path)
+            insert_comments(comments, parent_paths)
+            for i, comment in zip(indexes, comments):
+                created[i] = comment
+        increase_counters(created)
+        write_history(list(
+            CommentHistory(comment_id=c.pk, root_id=c.root_id, author=author, new_text=c.text, date=c.date)
+            for c in created
+        ))
+    root_ids = set(c.root_id for c in created)
+    for root_type, root_id in CommentRoot.objects.filter(pk__in=root_ids).values_list('obj_type', 'obj_id'):
+        bump_tree_version(root_type, root_id)
+    return list(c.pk for c in created), []
+
+
+def get_root(obj_type, obj_id):
+    return CommentRoot.objects.filter(obj_type=obj_type, obj_id=obj_id).first()
+
+
+def root_comments(obj_type, obj_id):
+    root = get_root(obj_type, obj_id)
+    if root is None:
+        return Comment.objects.none()
+    return Comment.objects.filter(root_id=root.pk)
 
 
 def first_level_comments(obj_type, obj_id):
@@ -88,141 +514,602 @@ def first_level_comments(obj_type, obj_id):
             COMMENT_TABLES[obj_type].objects.get(pk=obj_id)
         except ObjectDoesNotExist:
             raise ValueError('The parent object was not found')
-        return Comment.objects.filter(parent=None, root__obj_id=obj_id, root__obj_type=obj_type).order_by('date')
+        return root_comments(obj_type, obj_id).filter(parent=None).order_by('date', 'id')
     elif obj_type == 'c':
         try:
             Comment.objects.get(pk=obj_id)
         except ObjectDoesNotExist:
             raise ValueError('The parent comment was not found')
-        return Comment.objects.filter(parent_id=obj_id)
+        return Comment.objects.filter(parent_id=obj_id).order_by('date', 'id')
     else:
         raise ValueError('Unsupported root type')
 
 
+def first_level_page(obj_type, obj_id, cursor=None):
+    # Keyset pagination: the cursor is the signed (date, id) of the last comment on the previous page and the
+    # position of the next one. Returns the comments, the position of the first one starting from 1 and the cursor.
+    comments = first_level_comments(obj_type, obj_id)
+    start = 1
+    if cursor is not None:
+        try:
+            date_list, last_id, start = signing.loads(cursor, salt='first_level')
+        except (signing.BadSignature, ValueError):
+            raise ValueError('Wrong cursor')
+        last_date = get_date_obj(date_list)
+        comments = comments.filter(Q(date__gt=last_date) | Q(date=last_date, id__gt=last_id))
+    comments = list(comments[:NUM_OF_COMMENTS_ON_PAGE + 1])
+    if len(comments) <= NUM_OF_COMMENTS_ON_PAGE:
+        return comments, start, None
+    comments = comments[:NUM_OF_COMMENTS_ON_PAGE]
+    return comments, start, signing.dumps(
+        [get_date_list(comments[-1].date), comments[-1].pk, start + len(comments)], salt='first_level'
+    )
+
+
 class CommentTree:
     def __init__(self, obj_type, obj_id):
         self.obj_id = int(obj_id)
         self.type = obj_type
-        self.comments_data = {}
-        self.hierarchy = {}
-        self.__get_comments()
+        self.root = None
+        # Path of the comment for 'c' trees
+        self.path = ''
+        self.queryset = self.__get_queryset()
+        # Only the needed columns, in depth-first order (see subtree_comments())
+        self.comments = self.__get_values(self.queryset)
 
-    def __get_comments(self):
+    def __get_queryset(self):
         if self.type in list(x[0] for x in OBJECT_TYPES):
             try:
                 COMMENT_TABLES[self.type].objects.get(pk=self.obj_id)
             except ObjectDoesNotExist:
                 raise ValueError('The parent object was not found')
-            comments = Comment.objects.filter(root__obj_id=self.obj_id, root__obj_type=self.type).order_by('date')
+            self.root = get_root(self.type, self.obj_id)
+            if self.root is None:
+                return Comment.objects.none()
+            return with_path_key(Comment.objects.filter(root_id=self.root.pk))
         elif self.type == 'c':
             try:
-                self.comments_data[self.obj_id] = Comment.objects.get(pk=self.obj_id)
+                comment = Comment.objects.get(pk=self.obj_id)
             except ObjectDoesNotExist:
                 raise ValueError('The parent comment was not found')
-            comments = Comment.objects.filter(
-                root__obj_id=self.comments_data[self.obj_id].root.obj_id,
-                root__obj_type=self.comments_data[self.obj_id].root.obj_type
-            ).order_by('date')
-        else:
-            raise ValueError('Unsupported root type')
-        for comment in comments:
-            self.comments_data[comment.pk] = comment
-            if comment.parent_id not in self.hierarchy:
-                self.hierarchy[comment.parent_id] = []
-            self.hierarchy[comment.parent_id].append(int(comment.pk))
-
-    def get_tree(self):
+            self.path = comment.path
+            return subtree_comments(comment)
+        raise ValueError('Unsupported root type')
+
+    def __get_values(self, queryset):
+        return queryset.values_list(
+            'id', 'parent_id', 'text', 'date', 'last_change', 'child_count', 'descendant_count', 'path'
+        )
+
+    def get_object_name(self):
+        # TODO: only objects with 'name' in table are supported
+        return COMMENT_TABLES[self.type].objects.get(pk=self.obj_id).name
+
+    def get_tree(self, max_depth=None, max_children=None):
+        # With limits only 'max_depth' levels and 'max_children' replies of each comment are returned. Comments
+        # with not returned replies and the tree with not returned first level comments have 'cursor' for
+        # expand_tree(). The comment of 'c' tree is the first level.
         if self.type != 'c':
-            # TODO: only objects with 'name' in table are supported
-            return {
-                'name': COMMENT_TABLES[self.type].objects.get(pk=self.obj_id).name,
+            with timing('build'):
+                tree, cursor = self.__build_tree(self.queryset, 0, None, max_depth, max_children)
+            tree = {
+                'name': self.get_object_name(),
                 'obj_type': OBJECT_TYPES[int(self.type)][1],
-                'comments': self.__get_children(None)
+                'comment_count': self.root.comment_count if self.root is not None else 0,
+                'comments': tree
             }
-        return {
-            'text': self.comments_data[self.obj_id].text,
-            'date': get_date_list(self.comments_data[self.obj_id].date),
-            'last_change': get_date_list(self.comments_data[self.obj_id].last_change),
-            'children': self.__get_children(self.obj_id),
-        }
-
-    def __get_children(self, p_id):
-        children = []
-        if p_id not in self.hierarchy:
-            return []
-        for c_id in self.hierarchy[p_id]:
-            children.append({
-                'text': self.comments_data[c_id].text,
-                'date': get_date_list(self.comments_data[c_id].date),
-                'last_change': get_date_list(self.comments_data[c_id].last_change),
-                'children': self.__get_children(c_id),
-            })
-        return children
+            if cursor is not None:
+                tree['cursor'] = cursor
+            return tree
+        with timing('build'):
+            tree = self.__build_tree(self.queryset, len(self.path) - PATH_STEP_LENGTH, None, max_depth, max_children)[0]
+        if len(tree) == 0:
+            raise ValueError('The parent comment was not found')
+        return tree[0]
+
+    def get_replies(self, after_path=None, max_depth=None, max_children=None):
+        # First level comments (or replies to the comment of 'c' tree) after the one with 'after_path' with their
+        # replies, the same limits as for get_tree() are applied. Returns them and the cursor of the rest.
+        queryset = self.queryset
+        if self.type == 'c':
+            queryset = filter_path(queryset, path__gt=self.path)
+        with timing('build'):
+            return self.__build_tree(queryset, len(self.path), after_path, max_depth, max_children)
+
+    def __build_tree(self, queryset, base_length, after_path, max_depth, max_children):
+        # Comments go in depth-first order, so the parent of each comment is on the stack of its ancestors.
+        # Levels below 'max_depth' are not selected, comments after 'max_children' replies are skipped with
+        # their subtrees by seeking to get_next_path() of their parent.
+        if max_depth is not None:
+            queryset = queryset.annotate(path_length=Length('path'))\
+                .filter(path_length__lte=base_length + max_depth * PATH_STEP_LENGTH)
+        comments = self.__get_values(queryset)
+        top = {'id': None, 'node': None, 'children': [], 'shown': 0, 'last_path': None, 'cursor': None}
+        ancestors = []
+        seek = {'path__gte': get_next_path(after_path)} if after_path is not None else {}
+        while True:
+            chunk = list(filter_path(comments, **seek)[:TREE_CHUNK_SIZE])
+            skipped = False
+            for c_id, p_id, text, date, last_change, child_count, descendant_count, path in chunk:
+                while len(ancestors) > 0 and ancestors[-1]['id'] != p_id:
+                    ancestors.pop()
+                parent = ancestors[-1] if len(ancestors) > 0 else top
+                if max_children is not None and parent['shown'] >= max_children:
+                    if parent is top:
+                        top['cursor'] = self.__get_cursor(self.type, self.obj_id, top['last_path'])
+                        return top['children'], top['cursor']
+                    parent['node']['cursor'] = self.__get_cursor('c', parent['id'], parent['last_path'])
+                    seek = {'path__gte': get_next_path(parent['node_path'])}
+                    skipped = True
+                    break
+                node = {
+                    'id': c_id,
+                    'text': text,
+                    'date': get_date_list(date),
+                    'last_change': get_date_list(last_change),
+                    'child_count': child_count,
+                    'descendant_count': descendant_count,
+                    'children': []
+                }
+                if max_depth is not None and child_count > 0 and \
+                        len(path) - base_length >= max_depth * PATH_STEP_LENGTH:
+                    node['cursor'] = self.__get_cursor('c', c_id, None)
+                parent['children'].append(node)
+                parent['shown'] += 1
+                parent['last_path'] = path
+                ancestors.append({
+                    'id': c_id, 'node': node, 'node_path': path, 'children': node['children'], 'shown': 0,
+                    'last_path': None
+                })
+            if skipped:
+                continue
+            if len(chunk) < TREE_CHUNK_SIZE:
+                return top['children'], None
+            seek = {'path__gt': chunk[-1][-1]}
+
+    def __get_cursor(self, obj_type, obj_id, after_path):
+        return signing.dumps([obj_type, obj_id, after_path], salt='comment_tree')
+
+
+def get_tree_validator(obj_type, obj_id):
+    # Comment count and date of the last change of the root of the tree, every creation, change and deletion of
+    # its comments changes one of them. Returns None if there is no such tree.
+    try:
+        obj_id = int(obj_id)
+    except ValueError:
+        return None
+    if obj_type == 'c':
+        roots = CommentRoot.objects.filter(pk__in=Comment.objects.filter(pk=obj_id).values('root_id'))
+    elif obj_type in list(x[0] for x in OBJECT_TYPES):
+        roots = CommentRoot.objects.filter(obj_type=obj_type, obj_id=obj_id)
+    else:
+        return None
+    # Two queries by indexes: the root with the last change of its comments and the last deletion
+    root = roots.annotate(last_change=Max('comment__last_change')).first()
+    if root is None:
+        return None
+    # Archived deletions are older than the end of the archive, so the date doesn't go back when they are archived
+    dates = [
+        root.last_change,
+        CommentHistory.objects.filter(root=root, deleted_comment__isnull=False).aggregate(date=Max('date'))['date'],
+        get_archived_end()
+    ]
+    dates = list(x for x in dates if x is not None)
+    if len(dates) == 0:
+        return None
+    return root.comment_count, max(dates)
+
+
+def get_tree_changes(obj_type, obj_id, since):
+    # Comments of the object that were created or changed after 'since' and ids of comments deleted after it.
+    # Returns them with the next 'since': the date of the last change, but not later than TREE_CHANGES_LAG seconds
+    # ago, as a change with an earlier date may still be committed. Applying the same change twice doesn't change
+    # the tree of the client.
+    if obj_type not in list(x[0] for x in OBJECT_TYPES):
+        raise ValueError('Unsupported root type')
+    try:
+        obj_id = int(obj_id)
+    except ValueError:
+        raise ValueError('Wrong parent object id')
+    root = get_root(obj_type, obj_id)
+    if root is None:
+        if not COMMENT_TABLES[obj_type].objects.filter(pk=obj_id).exists():
+            raise ValueError('The parent object was not found')
+        return {'comments': [], 'deleted': [], 'comment_count': 0, 'since': get_date_list(since)}
+    archived_end = get_archived_end()
+    if archived_end is not None and since < archived_end:
+        # Deletions after 'since' may be in archives of history
+        raise ValueError('Since is too old, reload the tree')
+    comments = Comment.objects.filter(root=root, last_change__gt=since).order_by('last_change', 'id').values_list(
+        'id', 'parent_id', 'text', 'date', 'last_change', 'child_count', 'descendant_count'
+    )
+    deleted = CommentHistory.objects.filter(root=root, date__gt=since, deleted_comment__isnull=False)\
+        .order_by('date', 'id').values_list('deleted_comment', 'date')
+    changes = {'comments': [], 'deleted': [], 'comment_count': root.comment_count}
+    for c_id, p_id, text, date, last_change, child_count, descendant_count in comments:
+        changes['comments'].append({
+            'id': c_id, 'parent': p_id, 'text': text, 'date': get_date_list(date),
+            'last_change': get_date_list(last_change), 'child_count': child_count,
+            'descendant_count': descendant_count
+        })
+        since = max(since, last_change)
+    for c_id, date in deleted:
+        changes['deleted'].append(c_id)
+        since = max(since, date)
+    changes['since'] = get_date_list(min(since, now() - timedelta(seconds=TREE_CHANGES_LAG)))
+    return changes
+
+
+def expand_tree(cursor, max_depth=None, max_children=None):
+    # Returns the next comments of a truncated tree or comment, see CommentTree.get_tree()
+    try:
+        obj_type, obj_id, after_path = signing.loads(cursor, salt='comment_tree')
+    except signing.BadSignature:
+        raise ValueError('Wrong cursor')
+    comments, cursor = CommentTree(obj_type, obj_id).get_replies(after_path, max_depth, max_children)
+    return {'comments': comments, 'cursor': cursor}
+
+
+def encode_tree(tree):
+    # The same JSON as json.dumps(tree) for results of CommentTree.get_tree() and expand_tree(). Comments with
+    # replies are opened by a loop instead of recursion, so trees of any depth can be encoded.
+    parts = []
+    # Items of the open dicts and lists with their closing brackets
+    stack = [(iter([(None, tree)]), '')]
+    first = True
+    while len(stack) > 0:
+        items, closing = stack[-1]
+        item = next(items, None)
+        if item is None:
+            stack.pop()
+            parts.append(closing)
+            first = False
+            continue
+        key, value = item
+        if not first:
+            parts.append(', ')
+        if key is not None:
+            parts.append(json.dumps(key) + ': ')
+        if isinstance(value, dict) and (len(value.get('children', [])) > 0 or 'comments' in value):
+            parts.append('{')
+            stack.append((iter(value.items()), '}'))
+            first = True
+        elif isinstance(value, list) and any(isinstance(x, dict) for x in value):
+            parts.append('[')
+            stack.append((((None, x) for x in value), ']'))
+            first = True
+        else:
+            # Comments without replies and other values are small
+            parts.append(json.dumps(value))
+            first = False
+    return ''.join(parts)
+
+
+class IterTree(BufferedContent):
+    # Encodes the same JSON as json.dumps(tree.get_tree()) piece by piece while comments are read from database
+    def __init__(self, tree, chunk_size=TREE_CHUNK_SIZE):
+        super(IterTree, self).__init__()
+        self.tree = tree
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        if self.tree.type != 'c':
+            self.write('{"name": %s, "obj_type": %s, "comment_count": %s, "comments": [' % (
+                json.dumps(self.tree.get_object_name()), json.dumps(OBJECT_TYPES[int(self.tree.type)][1]),
+                self.tree.root.comment_count if self.tree.root is not None else 0
+            ))
+        ancestors = []
+        need_comma = False
+        rows = iterate_by_path(self.tree.comments, self.chunk_size)
+        for c_id, p_id, text, date, last_change, child_count, descendant_count, path in rows:
+            # The comment is either the first child of the previous one or goes after closed comments
+            while len(ancestors) > 0 and ancestors[-1] != p_id:
+                ancestors.pop()
+                self.write(']}')
+                need_comma = True
+            if need_comma:
+                self.write(', ')
+            self.write(
+                '{"id": %s, "text": %s, "date": %s, "last_change": %s, "child_count": %s, "descendant_count": %s, '
+                '"children": [' % (
+                    c_id, json.dumps(text), json.dumps(get_date_list(date)), json.dumps(get_date_list(last_change)),
+                    child_count, descendant_count
+                )
+            )
+            ancestors.append(c_id)
+            need_comma = False
+            if self.is_full():
+                yield self.flush()
+        self.write(']}' * len(ancestors))
+        if self.tree.type != 'c':
+            self.write(']}')
+        yield self.flush()
+
+
+def get_tree_version(root_type, root_id):
+    key = 'comment_tree_version:%s:%s' % (root_type, root_id)
+    version = cache.get(key)
+    if version is None:
+        # The version may have been evicted, start from a value that was never used before
+        cache.add(key, int(time.time() * 1000000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_tree_version(root_type, root_id):
+    key = 'comment_tree_version:%s:%s' % (root_type, root_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000000), None)
+
+
+def increase_cache_counter(name):
+    key = 'comment_tree_cache:%s' % name
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def tree_cache_stats():
+    stats = cache.get_many(['comment_tree_cache:hits', 'comment_tree_cache:misses'])
+    return {
+        'hits': stats.get('comment_tree_cache:hits', 0),
+        'misses': stats.get('comment_tree_cache:misses', 0)
+    }
+
+
+def get_cached_tree(obj_type, obj_id, max_depth=None, max_children=None):
+    # Returns serialized tree of comments. Any comment write bumps the version of its root, so only trees
+    # that were built after the last change of the root can be found in cache.
+    obj_id = int(obj_id)
+    if obj_type == 'c':
+        root = Comment.objects.filter(pk=obj_id).values_list('root__obj_type', 'root__obj_id').first()
+        if root is None:
+            raise ValueError('The parent comment was not found')
+        version = get_tree_version(*root)
+    else:
+        version = get_tree_version(obj_type, obj_id)
+    key = 'comment_tree:%s:%s:%s' % (obj_type, obj_id, version)
+    if max_depth is not None or max_children is not None:
+        key += ':%s:%s' % (max_depth, max_children)
+    tree = cache.get(key)
+    if tree is not None:
+        increase_cache_counter('hits')
+        return tree
+    increase_cache_counter('misses')
+    tree = CommentTree(obj_type, obj_id).get_tree(max_depth, max_children)
+    with timing('encode'):
+        tree = encode_tree(tree)
+    cache.set(key, tree, TREE_CACHE_TIMEOUT)
+    return tree
 
 
 class DownloadCommentsHistory:
-    def __init__(self, user, target, from_date, to_date, file_type):
+    def __init__(self, user, target, from_date, to_date, file_type, download=None, position=None):
         self.user = user
         self.target = target
-        if from_date is not None:
-            self.from_date = get_date_obj(json.loads(from_date))
-        else:
-            self.from_date = None
-        if to_date is not None:
-            self.to_date = get_date_obj(json.loads(to_date))
+        # (date, id) of the last downloaded change for resumed downloads, see resume_comments_history()
+        self.position = position
+        if download is not None:
+            self.download = download
+            self.from_date = download.min_date
+            self.to_date = download.max_date
+            self.type = download.file_type
         else:
-            self.to_date = None
-        self.type = None
-        for x in COMMENT_HISTORY_TYPE:
-            if x[1] == file_type:
-                self.type = x[0]
-        if self.type is None:
-            raise ValueError('Wrong type')
+            if from_date is not None:
+                self.from_date = get_date_obj(json.loads(from_date))
+            else:
+                self.from_date = None
+            if to_date is not None:
+                self.to_date = get_date_obj(json.loads(to_date))
+            else:
+                self.to_date = None
+            self.type = None
+            for x in COMMENT_HISTORY_TYPE:
+                if x[1] == file_type:
+                    self.type = x[0]
+            if self.type is None:
+                raise ValueError('Wrong type')
+            self.download = self.__save_download()
         self.history = self.__get_history()
-        self.__save_download()
+        self.archives = self.__get_archives()
 
     def __get_history(self):
-        if self.from_date is None and self.to_date is None:
-            return CommentHistory.objects.filter(author=self.target).order_by('date')
-        elif self.from_date is not None and self.to_date is None:
-            return CommentHistory.objects.filter(author=self.target, date__gte=self.from_date).order_by('date')
-        elif self.from_date is None and self.to_date is not None:
-            return CommentHistory.objects.filter(author=self.target, date__lte=self.from_date).order_by('date')
-        return CommentHistory.objects.filter(
-            author=self.target, date__range=(self.from_date, self.to_date)
-        ).order_by('date')
+        history = CommentHistory.objects.filter(author=self.target)
+        if self.from_date is not None:
+            history = history.filter(date__gte=self.from_date)
+        if self.to_date is not None:
+            history = history.filter(date__lte=self.to_date)
+        if self.position is not None:
+            history = history.filter(Q(date__gt=self.position[0]) | Q(date=self.position[0], id__gt=self.position[1]))
+        # Only the exported columns and columns of deltas, see iterate_chunks_by_date() and full_history_rows()
+        return history.order_by('date', 'id').values_list(*HISTORY_COLUMNS)
+
+    def __get_archives(self):
+        # Archived months of history that intersect the range, see main.partitions.archive_history_partition()
+        archives = HistoryArchive.objects.all()
+        if self.from_date is not None:
+            archives = archives.filter(end__gt=self.from_date)
+        if self.to_date is not None:
+            archives = archives.filter(start__lte=self.to_date)
+        return list(archives.order_by('start'))
+
+    def get_archived_rows(self):
+        # Rows of archives in the same format and order as rows of 'history'
+        for archive in self.archives:
+            for row in read_history_archive(archive, self.target.pk, self.from_date, self.to_date, self.position):
+                yield row
+
+    def get_content(self, **kwargs):
+        # Content of the download with archived changes if there are any, see IterContent
+        archived = self.get_archived_rows() if len(self.archives) > 0 else None
+        return IterContent(self.type, self.history, archived=archived, **kwargs)
 
     def __save_download(self):
         dh_from = self.from_date
         dh_to = self.to_date
         if dh_from is None:
-            moscow_tz = pytz.timezone('Europe/Moscow')
-            dh_from = moscow_tz.localize(datetime(2016, 11, 20, 16))
+            dh_from = MOSCOW_TZ.localize(datetime(2016, 11, 20, 16))
         if dh_to is None:
             dh_to = now()
-        DownloadHistory.objects.create(
+        return DownloadHistory.objects.create(
             user=self.user, target=self.target, min_date=dh_from, max_date=dh_to, file_type=self.type
         )
 
+    def get_export_key(self):
+        # History is only appended, so the export is the same while the range has the same changes. Changes with
+        # earlier dates (e.g. imported or written behind) change the number of them and the last id.
+        stats = self.history.aggregate(count=Count('id'), last_id=Max('id'), last_date=Max('date'))
+        key_data = [
+            self.target.pk, get_date_list(self.from_date), get_date_list(self.to_date), self.type, stats['count'],
+            stats['last_id'], get_date_list(stats['last_date']), list(archive.pk for archive in self.archives)
+        ]
+        return '%s.%s' % (
+            hashlib.sha256(json.dumps(key_data).encode('utf8')).hexdigest(), self.download.get_file_type_display()
+        )
+
+
+def get_continue_token(download_id, ch_date, ch_id):
+    return signing.dumps([download_id, get_date_list(ch_date), ch_id], salt='download_history')
+
+
+def resume_comments_history(user, token):
+    # The resumed download has the same range and type and continues after the change from the token
+    try:
+        download_id, date_list, ch_id = signing.loads(token, salt='download_history')
+    except signing.BadSignature:
+        raise ValueError('Wrong continuation token')
+    try:
+        download = DownloadHistory.objects.select_related('target').get(pk=download_id, user=user)
+    except ObjectDoesNotExist:
+        raise ValueError('The download was not found')
+    return DownloadCommentsHistory(
+        user, download.target, None, None, None, download=download, position=(get_date_obj(date_list), ch_id)
+    )
+
+
+def get_cached_export(key):
+    # Returns the opened file of the cached export or None
+    if settings.EXPORT_CACHE_DIR is None:
+        return None
+    try:
+        fp = open(os.path.join(settings.EXPORT_CACHE_DIR, key), mode='rb')
+    except FileNotFoundError:
+        return None
+    # Modification time is the time of the last use for evict_exports()
+    os.utime(fp.fileno())
+    return fp
+
+
+def cache_export(key, content):
+    # Streams the content and saves it to the export cache, the file appears only if the whole content was sent
+    if settings.EXPORT_CACHE_DIR is None:
+        yield from content
+        return
+    os.makedirs(settings.EXPORT_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=settings.EXPORT_CACHE_DIR, prefix='.tmp-')
+    try:
+        with open(fd, mode='wb') as fp:
+            for data in content:
+                fp.write(data.encode('utf8'))
+                yield data
+        os.replace(tmp_path, os.path.join(settings.EXPORT_CACHE_DIR, key))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    evict_exports()
+
 
-class IterContent:
-    def __init__(self, ftype, history):
+def evict_exports(max_size=EXPORT_CACHE_SIZE):
+    # Removes least recently used exports while the cache is bigger than max_size bytes
+    exports = []
+    for entry in os.scandir(settings.EXPORT_CACHE_DIR):
+        if entry.name.startswith('.tmp-'):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        exports.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(x[1] for x in exports)
+    for mtime, size, path in sorted(exports):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+class IterContent(BufferedContent):
+    # With 'download' a checkpoint with continuation token is written after each HISTORY_CHECKPOINT_ROWS changes.
+    # A resumed download continues the content that was cut after a checkpoint, so it has no prefix.
+    # Rows with HISTORY_COLUMNS are formatted by batches between checkpoints, writers of the formats get lists of
+    # (id, date, old_text, new_text) with texts of delta-encoded edits. 'archived' rows ordered by (date, id) are
+    # merged with rows of 'history'.
+    def __init__(self, ftype, history, chunk_size=HISTORY_CHUNK_SIZE, download=None, resumed=False,
+                 checkpoint_rows=HISTORY_CHECKPOINT_ROWS, archived=None):
+        super(IterContent, self).__init__()
         self.type = ftype
         self.history = history
-        self.need_comma = False
+        self.archived = archived
+        self.chunk_size = chunk_size
+        self.download = download
+        self.checkpoint_rows = checkpoint_rows
+        self.resumed = resumed
+        self.need_comma = resumed
         self.separator = '=' * 50 + '\n'
         self.xml_pref = ' ' * 2
+        self.csv_file = io.StringIO()
+        self.csv_writer = csv.writer(self.csv_file, lineterminator='\n')
 
     def __iter__(self):
-        yield self.__prefix()
-        for ch in self.history:
-            if self.type == '0':
-                yield self.__txt_block(ch)
-            elif self.type == '1':
-                yield self.__json_block(ch)
-            elif self.type == '2':
-                yield self.__xml_block(ch)
-        yield self.__postfix()
+        write_rows = {
+            '0': self.__txt_rows, '1': self.__json_rows, '2': self.__xml_rows, '3': self.__ndjson_rows,
+            '4': self.__csv_rows
+        }[self.type]
+        if not self.resumed:
+            self.write(self.__prefix())
+        rows = 0
+        chunks = iterate_chunks_by_date(self.history, self.chunk_size)
+        if self.archived is not None:
+            chunks = merge_chunks_by_date(chunks, self.archived, self.chunk_size)
+        for chunk in chunks:
+            chunk = full_history_rows(chunk)
+            start = 0
+            while start < len(chunk):
+                end = len(chunk)
+                if self.download is not None:
+                    end = min(end, start + self.checkpoint_rows - rows % self.checkpoint_rows)
+                self.write(write_rows(chunk[start:end]))
+                rows += end - start
+                if self.download is not None and rows % self.checkpoint_rows == 0:
+                    self.__checkpoint(get_continue_token(self.download.pk, chunk[end - 1][1], chunk[end - 1][0]))
+                start = end
+            if self.is_full():
+                yield self.flush()
+        self.write(self.__postfix())
+        yield self.flush()
+
+    def __checkpoint(self, token):
+        if self.type == '0':
+            self.write('CHECKPOINT: %s\n' % token)
+            self.write(self.separator)
+        elif self.type == '1':
+            self.write(',\n')
+            self.write(json.dumps({'checkpoint': token}, indent=2))
+        elif self.type == '2':
+            self.write('\n' + self.xml_pref + '<checkpoint>%s</checkpoint>' % token)
+        elif self.type == '3':
+            self.write(json.dumps({'checkpoint': token}) + '\n')
+        elif self.type == '4':
+            # Checkpoint rows have the token in the last column
+            self.csv_writer.writerow(('', 'CHECKPOINT', '', token))
+            self.write(self.__csv_data())
 
     def __prefix(self):
         if self.type == '0':
@@ -231,46 +1118,69 @@ class IterContent:
             return '[\n'
         elif self.type == '2':
             return '<?xml version="1.0" encoding="UTF-8" ?>\n<history>'
+        elif self.type == '4':
+            return 'date,type,old_text,new_text\n'
+        return ''
 
-    def __txt_block(self, comment_change):
-        ch_date = comment_change.date.astimezone(pytz.timezone('Europe/Moscow'))
-        if comment_change.old_text is None:
-            change_block = 'TYPE: <CREATION>\n%s\nTEXT:\n%s\n' % (ch_date, comment_change.new_text)
-        elif comment_change.new_text is None:
-            change_block = 'TYPE: <DELETION>\n%s\nTEXT:\n%s\n' % (ch_date, comment_change.old_text)
-        else:
-            change_block = 'TYPE: <EDITION>\n%s\nOLD TEXT:\n%s\nNEW TEXT:\n%s\n' % (
-                ch_date, comment_change.old_text, comment_change.new_text
-            )
-        change_block += self.separator
-        return change_block
-
-    def __json_block(self, comment_change):
-        data_str = json.dumps({
-            'date': str(comment_change.date.astimezone(pytz.timezone('Europe/Moscow'))),
-            'old_text': comment_change.old_text, 'new_text': comment_change.new_text
-        }, indent=2)
+    def __txt_rows(self, rows):
+        blocks = []
+        for ch_id, ch_date, old_text, new_text in rows:
+            ch_date = ch_date.astimezone(MOSCOW_TZ)
+            if old_text is None:
+                blocks.append('TYPE: <CREATION>\n%s\nTEXT:\n%s\n' % (ch_date, new_text))
+            elif new_text is None:
+                blocks.append('TYPE: <DELETION>\n%s\nTEXT:\n%s\n' % (ch_date, old_text))
+            else:
+                blocks.append('TYPE: <EDITION>\n%s\nOLD TEXT:\n%s\nNEW TEXT:\n%s\n' % (ch_date, old_text, new_text))
+            blocks.append(self.separator)
+        return ''.join(blocks)
+
+    def __json_rows(self, rows):
+        # The same as json.dumps(..., indent=2) of each change without encoding dicts one by one
+        blocks = []
+        for ch_id, ch_date, old_text, new_text in rows:
+            blocks.append('{\n  "date": %s,\n  "old_text": %s,\n  "new_text": %s\n}' % (
+                json_string(str(ch_date.astimezone(MOSCOW_TZ))), json_string(old_text), json_string(new_text)
+            ))
+        data = ',\n'.join(blocks)
         if self.need_comma:
-            data_str = ',\n' + data_str
-        else:
-            self.need_comma = True
-        return data_str
-
-    def __xml_block(self, comment_change):
-        xml_block_data = ['<date>%s</date>' % str(comment_change.date.astimezone(pytz.timezone('Europe/Moscow')))]
-        if comment_change.old_text is None:
-            xml_block_data.append('<type>CREATION</type>')
-            xml_block_data.append('<comment>%s</comment>' % comment_change.new_text)
-        elif comment_change.new_text is None:
-            xml_block_data.append('<type>DELETION</type>')
-            xml_block_data.append('<comment>%s</comment>' % comment_change.old_text)
-        else:
-            xml_block_data.append('<type>EDITION</type>')
-            xml_block_data.append('<old>%s</old>' % comment_change.old_text)
-            xml_block_data.append('<new>%s</new>' % comment_change.new_text)
-        return '\n' + self.xml_pref + '<change>\n' \
-               + '\n'.join(list((self.xml_pref * 2 + x) for x in xml_block_data)) \
-               + '\n' + self.xml_pref + '</change>'
+            data = ',\n' + data
+        self.need_comma = True
+        return data
+
+    def __ndjson_rows(self, rows):
+        return ''.join('{"date": %s, "old_text": %s, "new_text": %s}\n' % (
+            json_string(str(ch_date.astimezone(MOSCOW_TZ))), json_string(old_text), json_string(new_text)
+        ) for ch_id, ch_date, old_text, new_text in rows)
+
+    def __xml_rows(self, rows):
+        pref = '\n' + self.xml_pref * 2
+        blocks = []
+        for ch_id, ch_date, old_text, new_text in rows:
+            blocks.append('\n' + self.xml_pref + '<change>' + pref + '<date>%s</date>' % ch_date.astimezone(MOSCOW_TZ))
+            if old_text is None:
+                blocks.append(pref + '<type>CREATION</type>' + pref + '<comment>%s</comment>' % new_text)
+            elif new_text is None:
+                blocks.append(pref + '<type>DELETION</type>' + pref + '<comment>%s</comment>' % old_text)
+            else:
+                blocks.append(pref + '<type>EDITION</type>' + pref + '<old>%s</old>' % old_text +
+                              pref + '<new>%s</new>' % new_text)
+            blocks.append('\n' + self.xml_pref + '</change>')
+        return ''.join(blocks)
+
+    def __csv_rows(self, rows):
+        self.csv_writer.writerows((
+            ch_date.astimezone(MOSCOW_TZ), 'CREATION' if old_text is None else
+            ('DELETION' if new_text is None else 'EDITION'), old_text, new_text
+        ) for ch_id, ch_date, old_text, new_text in rows)
+        return self.__csv_data()
+
+    def __csv_data(self):
+        # The writer formats rows into the reused in-memory file, it is emptied after each batch
+        data = self.csv_file.getvalue()
+        self.csv_file.seek(0)
+        self.csv_file.truncate()
+        return data
 
     def __postfix(self):
         if self.type == '0':
@@ -279,20 +1189,65 @@ class IterContent:
             return '\n]'
         elif self.type == '2':
             return '\n</history>'
+        return ''
 
 
 class UserDownloads:
-    def __init__(self, author):
+    # Downloads of the author ordered by date, one page of DOWNLOADS_ON_PAGE downloads after the cursor.
+    # The cursor of the next page is the signed (date, id) of the last download on this page.
+    def __init__(self, author, from_date=None, to_date=None, file_type=None, cursor=None):
         self.author = author
+        self.from_date = get_date_obj(json.loads(from_date)) if from_date is not None else None
+        self.to_date = get_date_obj(json.loads(to_date)) if to_date is not None else None
+        self.type = None
+        if file_type is not None:
+            for x in COMMENT_HISTORY_TYPE:
+                if x[1] == file_type:
+                    self.type = x[0]
+            if self.type is None:
+                raise ValueError('Wrong type')
+        self.position = None
+        if cursor is not None:
+            try:
+                date_list, dh_id = signing.loads(cursor, salt='user_downloads')
+            except signing.BadSignature:
+                raise ValueError('Wrong cursor')
+            self.position = (get_date_obj(date_list), dh_id)
         self.data = []
-        self.__get_data()
+        self.cursor = None
+        with timing('build'):
+            self.__get_data()
+
+    def __get_downloads(self):
+        downloads = DownloadHistory.objects.filter(user=self.author)
+        if self.from_date is not None:
+            downloads = downloads.filter(date__gte=self.from_date)
+        if self.to_date is not None:
+            downloads = downloads.filter(date__lte=self.to_date)
+        if self.type is not None:
+            downloads = downloads.filter(file_type=self.type)
+        if self.position is not None:
+            downloads = downloads.filter(
+                Q(date__gt=self.position[0]) | Q(date=self.position[0], id__gt=self.position[1])
+            )
+        # Usernames of targets are selected by the same query
+        return downloads.order_by('date', 'id').values_list(
+            'id', 'date', 'min_date', 'max_date', 'file_type', 'target_id', 'target__username'
+        )
 
     def __get_data(self):
-        for dh in DownloadHistory.objects.filter(user=self.author).order_by('date'):
+        type_names = dict(COMMENT_HISTORY_TYPE)
+        downloads = list(self.__get_downloads()[:DOWNLOADS_ON_PAGE + 1])
+        if len(downloads) > DOWNLOADS_ON_PAGE:
+            downloads = downloads[:DOWNLOADS_ON_PAGE]
+            self.cursor = signing.dumps(
+                [get_date_list(downloads[-1][1]), downloads[-1][0]], salt='user_downloads'
+            )
+        for dh_id, dh_date, min_date, max_date, file_type, target_id, target_name in downloads:
             self.data.append({
-                'target': [dh.target_id, dh.target.username],
-                'date': get_date_list(dh.date),
-                'date_from': get_date_list(dh.min_date),
-                'date_to': get_date_list(dh.max_date),
-                'file_type': dh.get_file_type_display()
+                'target': [target_id, target_name],
+                'date': get_date_list(dh_date),
+                'date_from': get_date_list(min_date),
+                'date_to': get_date_list(max_date),
+                'file_type': type_names[file_type]
             })
@@ -1,11 +1,22 @@
+import hashlib
 import mimetypes
+import re
+from functools import wraps
 from django.contrib.auth import authenticate, login
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator, EmptyPage
-from django.http import JsonResponse, StreamingHttpResponse
+from django.http import JsonResponse, StreamingHttpResponse, FileResponse
+from django.utils.cache import patch_vary_headers, patch_cache_control
+from django.views.decorators.http import condition
 from Comments.vars import NUM_OF_COMMENTS_ON_PAGE
+from main.timing import histograms
 from main.utils import *
 
+mimetypes.add_type('application/x-ndjson', '.ndjson')
+
+re_accepts_gzip = re.compile(r'\bgzip\b')
+
 
 def user_login(request):
     user = authenticate(username=request.POST.get('username'), password=request.POST.get('password'))
@@ -27,6 +38,21 @@ def create_comment_view(request):
     return JsonResponse({})
 
 
+@login_required
+def create_comments_view(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Wrong reqeust method'})
+    if 'comments' not in request.POST:
+        return JsonResponse({'error': 'Wrong list of arguments'})
+    try:
+        ids, errors = create_comments(request.user, json.loads(request.POST['comments']))
+    except Exception as e:
+        return JsonResponse({'error': str(e)})
+    if len(errors) > 0:
+        return JsonResponse({'errors': errors})
+    return JsonResponse({'ids': ids})
+
+
 @login_required
 def change_comment_view(request):
     if request.method != 'POST':
@@ -53,11 +79,49 @@ def delete_comment_view(request):
     return JsonResponse({})
 
 
-def first_level_list(request, page):
+def conditional_tree(type_param, id_param):
+    # Conditional GET for views of trees of comments, 304 Not Modified is sent before the view is called if the
+    # root of the tree wasn't changed (see get_tree_validator()). Responses to POST requests have no validators.
+    def get_validator(request):
+        if not hasattr(request, 'tree_validator'):
+            request.tree_validator = None
+            if request.method in ['GET', 'HEAD'] and type_param in request.GET and id_param in request.GET:
+                request.tree_validator = get_tree_validator(request.GET[type_param], request.GET[id_param])
+        return request.tree_validator
+
+    def get_etag(request, *args, **kwargs):
+        validator = get_validator(request)
+        if validator is None:
+            return None
+        # Each set of parameters is a different representation of the tree
+        return '%s-%s-%s' % (
+            validator[0], get_date_obj(get_date_list(validator[1])).timestamp(),
+            hashlib.md5(request.get_full_path().encode('utf8')).hexdigest()[:16]
+        )
+
+    def decorator(view):
+        # There is no Last-Modified, HTTP dates have only seconds and a change in the same second would be missed
+        view = condition(etag_func=get_etag)(view)
+
+        @wraps(view)
+        def conditional_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if response.has_header('ETag'):
+                # Caches have to check that the tree wasn't changed before they use the response
+                patch_cache_control(response, no_cache=True)
+            return response
+        return conditional_view
+    return decorator
+
+
+@conditional_tree('type', 'obj')
+def first_level_list(request, page=None):
     if request.method != 'GET':
         return JsonResponse({'error': 'Wrong reqeust method'})
     if any(x not in request.GET for x in ['obj', 'type']):
         return JsonResponse({'error': 'Wrong list of arguments'})
+    if page is None:
+        return first_level_cursor_list(request)
     page = int(page)
     try:
         all_comments = first_level_comments(request.GET['type'], request.GET['obj'])
@@ -70,45 +134,158 @@ def first_level_list(request, page):
         page = p.num_pages
         comments = p.page(p.num_pages)
     # TODO: add authors and dates of comments
-    comments = list([page + i, {'text': comments[i].text}] for i in range(len(comments)))
+    comments = list([page + i, get_comment_data(comments[i])] for i in range(len(comments)))
     return JsonResponse({'comments': json.dumps(comments)})
 
 
+def get_comment_data(comment):
+    return {
+        'id': comment.pk, 'text': comment.text, 'child_count': comment.child_count,
+        'descendant_count': comment.descendant_count
+    }
+
+
+def first_level_cursor_list(request):
+    try:
+        comments, start, cursor = first_level_page(request.GET['type'], request.GET['obj'], request.GET.get('cursor'))
+    except Exception as e:
+        return JsonResponse({'error': str(e)})
+    # Items are [position, data] like in pages
+    comments = list([start + i, get_comment_data(c)] for i, c in enumerate(comments))
+    return JsonResponse({'comments': json.dumps(comments), 'cursor': cursor})
+
+
+@conditional_tree('obj_type', 'obj_id')
 def get_tree(request):
-    if request.method != 'POST':
+    # GET requests can be cached, POST is kept for old clients
+    if request.method not in ['GET', 'POST']:
         return JsonResponse({'error': 'Wrong reqeust method'})
-    if any(x not in request.POST for x in ['obj_type', 'obj_id']):
+    params = request.GET if request.method == 'GET' else request.POST
+    if 'cursor' not in params and any(x not in params for x in ['obj_type', 'obj_id']):
         return JsonResponse({'error': 'Wrong list of arguments'})
     try:
-        comments = CommentTree(request.POST['obj_type'], request.POST['obj_id']).get_tree()
+        max_depth, max_children = get_tree_limits(params)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)})
+    if params.get('stream') == '1':
+        if max_depth is not None or max_children is not None:
+            return JsonResponse({'error': "Streamed trees can't be limited"})
+        return get_tree_stream(params)
+    try:
+        if 'cursor' in params:
+            # Expansion of a truncated comment or tree
+            comments = encode_tree(expand_tree(params['cursor'], max_depth, max_children))
+        else:
+            comments = get_cached_tree(params['obj_type'], params['obj_id'], max_depth, max_children)
     except Exception as e:
         print(e)
         return JsonResponse({'error': str(e)})
-    return JsonResponse({'comments': json.dumps(comments)})
+    return JsonResponse({'comments': comments})
 
 
-@login_required
-def download_history(request):
-    if request.method != 'POST':
+def tree_changes(request):
+    # Changes of the tree of comments after 'since', the date list from the previous response of the client
+    if request.method != 'GET':
         return JsonResponse({'error': 'Wrong reqeust method'})
-    if any(x not in request.POST for x in ['file_type', 'target_id']):
+    if any(x not in request.GET for x in ['obj_type', 'obj_id', 'since']):
         return JsonResponse({'error': 'Wrong list of arguments'})
     try:
-        target = User.objects.get(pk=request.POST['target_id'])
-    except ObjectDoesNotExist:
-        return JsonResponse({'error': 'The target was not found'})
+        since = get_date_obj(json.loads(request.GET['since']))
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'Wrong date'})
     try:
-        res = DownloadCommentsHistory(
-            request.user, target,
-            request.POST.get('date_from'),
-            request.POST.get('date_to'),
-            request.POST['file_type']
-        )
+        changes = get_tree_changes(request.GET['obj_type'], request.GET['obj_id'], since)
+    except Exception as e:
+        return JsonResponse({'error': str(e)})
+    return JsonResponse({'changes': json.dumps(changes)})
+
+
+def get_tree_limits(params):
+    limits = []
+    for name in ['max_depth', 'max_children']:
+        value = params.get(name)
+        if value is not None:
+            try:
+                value = int(value)
+            except ValueError:
+                value = 0
+            if value < 1:
+                raise ValueError('Wrong %s' % name)
+        limits.append(value)
+    return limits
+
+
+def get_tree_stream(params):
+    # Unlike get_tree() the response is the tree itself, it is encoded while comments are read from database
+    try:
+        tree = CommentTree(params['obj_type'], params['obj_id'])
     except Exception as e:
         return JsonResponse({'error': str(e)})
-    file_name = "history-%s.%s" % (res.target.pk, request.POST['file_type'])
-    response = StreamingHttpResponse(IterContent(res.type, res.history), content_type=mimetypes.guess_type(file_name)[0])
+    return StreamingHttpResponse(IterTree(tree), content_type='application/json')
+
+
+@login_required
+def download_history(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Wrong reqeust method'})
+    if 'continue' not in request.POST and any(x not in request.POST for x in ['file_type', 'target_id']):
+        return JsonResponse({'error': 'Wrong list of arguments'})
+    if request.POST.get('compress') not in [None, 'gzip']:
+        return JsonResponse({'error': 'Unsupported compression'})
+    if 'continue' in request.POST:
+        # Continuation of a resumable download, it isn't saved as a new download
+        try:
+            res = resume_comments_history(request.user, request.POST['continue'])
+        except Exception as e:
+            return JsonResponse({'error': str(e)})
+    else:
+        try:
+            target = User.objects.get(pk=request.POST['target_id'])
+        except ObjectDoesNotExist:
+            return JsonResponse({'error': 'The target was not found'})
+        try:
+            res = DownloadCommentsHistory(
+                request.user, target,
+                request.POST.get('date_from'),
+                request.POST.get('date_to'),
+                request.POST['file_type']
+            )
+        except Exception as e:
+            return JsonResponse({'error': str(e)})
+    file_name = "history-%s.%s" % (res.target.pk, res.download.get_file_type_display())
+    content_type = mimetypes.guess_type(file_name)[0]
+    # The file is compressed with compress=gzip, otherwise only the transfer is compressed if the client accepts it
+    compress = request.POST.get('compress') == 'gzip'
+    content_encoding = None
+    if compress:
+        file_name += '.gz'
+        content_type = 'application/gzip'
+    elif re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        content_encoding = 'gzip'
+
+    cached_file = None
+    if 'continue' in request.POST or request.POST.get('resumable') == '1':
+        content = res.get_content(download=res.download, resumed=res.position is not None)
+    else:
+        # Complete exports are cached until a new change of the target gets into the range
+        export_key = res.get_export_key()
+        cached_file = get_cached_export(export_key)
+        if cached_file is None:
+            content = cache_export(export_key, res.get_content())
+        else:
+            content = iterate_file(cached_file)
+
+    if cached_file is not None and not compress and content_encoding is None:
+        # Sent with wsgi.file_wrapper (sendfile) if the server supports it
+        response = FileResponse(cached_file, content_type=content_type)
+    else:
+        if compress or content_encoding is not None:
+            content = gzip_content(content)
+        response = StreamingHttpResponse(content, content_type=content_type)
     response['Content-Disposition'] = "attachment; filename=%s" % file_name
+    if content_encoding is not None:
+        response['Content-Encoding'] = content_encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
     return response
 
 
@@ -122,4 +299,19 @@ def user_downloads(request):
         author = User.objects.get(pk=request.POST['user_id'])
     except ObjectDoesNotExist:
         return JsonResponse({'error': 'User was not found'})
-    return JsonResponse({'data': json.dumps(UserDownloads(author).data)})
+    try:
+        downloads = UserDownloads(
+            author, request.POST.get('date_from'), request.POST.get('date_to'), request.POST.get('file_type'),
+            request.POST.get('cursor')
+        )
+    except Exception as e:
+        return JsonResponse({'error': str(e)})
+    with timing('encode'):
+        data = json.dumps(downloads.data)
+    return JsonResponse({'data': data, 'cursor': downloads.cursor})
+
+
+@staff_member_required
+def metrics(request):
+    # Histograms of main.middleware.TimingMiddleware of this process, empty if the middleware is disabled
+    return JsonResponse({'endpoints': histograms.get_data()})